@@ -0,0 +1,99 @@
+"""工具路由的微基准：比较逐个关键词扫描 + 正则的旧做法与预编译的 ToolRouter
+
+用法: python bench_routing.py [每个问题的重复次数]
+"""
+import re
+import sys
+import time
+
+from merged import ToolRouter
+
+QUESTIONS = [
+    "你好",
+    "北京天气怎么样",
+    "上海今天天气",
+    "London weather forecast",
+    "什么是量子计算",
+    "帮我读取 C:/docs/report.pdf 的内容",
+    "北京天气 and read C:/data/notes.txt",
+    "为什么天空是蓝色的",
+    "介绍一下你自己",
+    "最新的人工智能新闻有哪些？",
+    "写一首关于春天的诗，要求押韵，每句七个字，一共四句",
+    "打开 D:/work/plan.docx 告诉我里面的内容",
+]
+
+
+def legacy_route(text):
+    """旧的路由方式：三个判断函数各自扫描关键词并调用正则，之后再次正则提取参数"""
+    routes = {}
+    search_keywords = ["搜索", "查询", "查找", "最新", "新闻", "资讯", "信息", "知识", "了解", "什么是",
+                       "是谁", "哪里", "何时", "为什么", "怎么样", "告诉我", "是啥"]
+    question_patterns = [
+        r'^[\u4e00-\u9fa5a-zA-Z0-9\s]*[?？]$',
+        r'^什么是[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+        r'^谁是[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+        r'^为什么[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+        r'^如何[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+        r'^怎样[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+        r'^哪里[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+        r'^何时[\u4e00-\u9fa5a-zA-Z0-9\s]+$',
+    ]
+    if any(keyword in text for keyword in search_keywords) or any(re.match(p, text) for p in question_patterns):
+        query = text
+        for prefix in ["搜索", "查询", "查找", "告诉我", "了解", "什么是", "是谁", "哪里", "何时", "为什么", "怎么样"]:
+            if query.startswith(prefix):
+                query = query[len(prefix):].strip()
+                break
+        routes["search"] = {"query": query}
+
+    weather_keywords = ["天气", "温度", "气象", "预报", "晴", "雨", "风", "多云", "湿度", "气候", "weather",
+                        "temperature", "weather forecast", "sunny", "rain", "wind", "cloudy", "humidity"]
+    if any(keyword in text for keyword in weather_keywords):
+        if re.search(r'([\u4e00-\u9fa5]{2,5}(市|县|区|镇|村|乡)?|[A-Za-z]+)\s*(天气|气候|weather|forecast)', text):
+            match = re.search(r'([\u4e00-\u9fa5]{2,8}(市|县|区|镇|村|乡)?|[A-Za-z]+)\s*(天气|气候|weather|forecast)', text)
+            routes["weather"] = {"location": match.group(1)}
+
+    file_keywords = ["文件", "读取", "打开", "内容", "路径", "目录", ".txt", ".doc", ".pdf", ".docx"]
+    if any(keyword in text for keyword in file_keywords):
+        if re.search(r'([\w\s/\\().+?\-]+?\.(txt|docx|pdf|md|doc))', text, re.IGNORECASE):
+            match = re.search(r'([\w\s/\\().+?:\-]+?\.(txt|docx|pdf|md|doc))', text, re.IGNORECASE)
+            file_path = match.group(1)
+            idx = file_path.find(":")
+            if idx == -1 or idx == 0:
+                routes["file"] = {"error": "文件路径格式错误"}
+            else:
+                routes["file"] = {"file_path": file_path[idx-1:]}
+    return routes
+
+
+def bench(route, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for question in QUESTIONS:
+            route(question)
+    return (time.perf_counter() - start) / (repeat * len(QUESTIONS)) * 1e6
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    start = time.perf_counter()
+    router = ToolRouter()
+    build_us = (time.perf_counter() - start) * 1e6
+
+    # 两种方式的路由结果必须一致
+    for question in QUESTIONS:
+        expected, actual = legacy_route(question), router.route(question)
+        if expected != actual:
+            raise AssertionError(f"路由结果不一致: {question}: {expected} != {actual}")
+
+    legacy_us = bench(legacy_route, repeat)
+    router_us = bench(router.route, repeat)
+    print(f"ToolRouter 编译耗时: {build_us:.0f}us")
+    print(f"旧的逐个扫描:   {legacy_us:.2f}us/问题")
+    print(f"ToolRouter:     {router_us:.2f}us/问题 ({legacy_us / router_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,104 @@
 import tkinter as tk
 from tkinter import scrolledtext, ttk, messagebox, Scale, Menu, filedialog
 import threading
-from openai import OpenAI
+import multiprocessing
+import itertools
+import queue
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, CancelledError, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from openai import OpenAI, AsyncOpenAI, OpenAIError
 import time
 import jsonschema
 import json
 import base64
+import codecs
 import os
 import re
 from PIL import Image, ImageTk
 import numpy as np
 from datetime import datetime
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 import chardet
-import PyPDF2  # 确保已安装 PyPDF2
 import jieba  # 中文分词库
 from rich.console import Console
 from rich.markdown import Markdown
+from rich.errors import MarkupError
 import sys
 import os
+import shutil
+import hashlib
+import zlib
+import sqlite3
+from collections import OrderedDict, deque
 import yaml
 import fitz  # PyMuPDF
 import requests
 import json
-from urllib.parse import urljoin, urlencode
+from urllib.parse import urljoin, urlencode, urlparse
+import random
+import bisect
+from collections.abc import Sequence
+# 程序所在目录，本地缓存和索引都放在这里，与启动时的工作目录无关
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 # 工具配置文件路径
 TOOL_CONFIG_FILE = "tool_config.yaml"
+# 知识库持久化目录
+KNOWLEDGE_INDEX_DIR = os.path.join(APP_DIR, "knowledge_index")
+# 分词缓存的磁盘层
+TOKEN_CACHE_FILE = "token_cache.sqlite3"
+# LLM响应缓存的磁盘层
+RESPONSE_CACHE_FILE = "response_cache.sqlite3"
+# 网络搜索结果缓存（位于程序目录下）
+SEARCH_CACHE_FILE = "search_cache.sqlite3"
+
+# 工具名 -> (显示名称, 成功时的提示前缀, 失败时的提示前缀)
+TOOL_LABELS = {
+    "search": ("网络搜索", "根据网络搜索结果", "网络搜索失败"),
+    "weather": ("天气查询", "根据当前天气信息", "天气查询失败"),
+    "file": ("文件读取", "根据文件内容", "文件读取失败"),
+}
+
+# 函数调用模式下提供给模型的工具定义：函数名 -> (工具名, 参数名, 定义)
+TOOL_DEFINITIONS = {
+    "web_search": ("search", "query", {
+        "type": "function",
+        "function": {
+            "name": "web_search",
+            "description": "在互联网上搜索最新信息、新闻或模型不知道的事实",
+            "parameters": {
+                "type": "object",
+                "properties": {"query": {"type": "string", "description": "搜索关键词"}},
+                "required": ["query"]
+            }
+        }
+    }),
+    "get_weather": ("weather", "location", {
+        "type": "function",
+        "function": {
+            "name": "get_weather",
+            "description": "查询某个城市当前的天气",
+            "parameters": {
+                "type": "object",
+                "properties": {"location": {"type": "string", "description": "城市名，如 北京市 或 London"}},
+                "required": ["location"]
+            }
+        }
+    }),
+    "read_file": ("file", "file_path", {
+        "type": "function",
+        "function": {
+            "name": "read_file",
+            "description": "读取用户指定路径的本地文件内容",
+            "parameters": {
+                "type": "object",
+                "properties": {"file_path": {"type": "string", "description": "文件的完整路径"}},
+                "required": ["file_path"]
+            }
+        }
+    }),
+}
 
 # 定义输入数据的JSON Schema
 console = Console()
@@ -75,12 +147,2757 @@ OUTPUT_SCHEMA = {
         },
         "tool_used": {
             "type": "string",
-            "enum": ["none", "file", "weather", "search"]
+            "enum": ["none", "file", "weather", "search", "multiple"]
         }
     },
     "required": ["status", "content", "timestamp", "model", "tool_used"]
 }
 
+class IncrementalTfidfIndex:
+    """增量TF-IDF索引：新增片段时只统计新片段的词频，IDF在查询时按需重算
+
+    打分方式与 TfidfVectorizer 默认参数一致（smooth_idf、L2归一化），
+    因此检索排序与全量重新 fit 的结果相同。
+    """
+
+    def __init__(self):
+        self.vocabulary = {}  # 词 -> 列号
+        self.n_docs = 0
+        self._df = np.zeros(1024, dtype=np.int64)  # 每个词出现的片段数（按容量增长）
+        # 已合并的CSR数组（加载后可能是内存映射），保存原始词频
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._data = np.zeros(0, dtype=np.float32)
+        # 尚未合并的新增行
+        self._indices_parts = []
+        self._data_parts = []
+        self._row_lengths = []
+        # 查询时才计算的缓存，新增片段后失效
+        self._idf = None
+        self._matrix = None
+
+    def __len__(self):
+        return self.n_docs
+
+    @property
+    def df(self):
+        """每个词的文档频率"""
+        return self._df[:len(self.vocabulary)]
+
+    def clear(self):
+        """清空索引"""
+        self.__init__()
+
+    def _invalidate(self):
+        self._idf = None
+        self._matrix = None
+
+    def _term_id(self, token):
+        """返回词的列号，新词自动加入词表"""
+        col = self.vocabulary.get(token)
+        if col is None:
+            col = len(self.vocabulary)
+            self.vocabulary[token] = col
+            if col >= len(self._df):
+                grown = np.zeros(len(self._df) * 2, dtype=np.int64)
+                grown[:len(self._df)] = self._df
+                self._df = grown
+        return col
+
+    def add_documents(self, token_lists):
+        """追加已分词的片段，只更新词表和文档频率"""
+        for tokens in token_lists:
+            counts = {}
+            for token in tokens:
+                col = self._term_id(token)
+                counts[col] = counts.get(col, 0) + 1
+            cols = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            self._df[cols] += 1
+            self._indices_parts.append(cols)
+            self._data_parts.append(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            self._row_lengths.append(len(counts))
+            self.n_docs += 1
+        self._invalidate()
+
+    def _consolidate(self):
+        """把新增行合并进CSR数组"""
+        if not self._row_lengths:
+            return
+        lengths = np.asarray(self._row_lengths, dtype=np.int64)
+        self._indptr = np.concatenate([self._indptr, self._indptr[-1] + np.cumsum(lengths)])
+        self._indices = np.concatenate([self._indices] + self._indices_parts)
+        self._data = np.concatenate([self._data] + self._data_parts)
+        self._indices_parts = []
+        self._data_parts = []
+        self._row_lengths = []
+
+    def remove_documents(self, rows):
+        """删除指定行的片段，并回退它们贡献的文档频率"""
+        rows = np.asarray(sorted(set(rows)), dtype=np.int64)
+        if not len(rows):
+            return
+        self._consolidate()
+        row_ids = np.repeat(np.arange(self.n_docs), np.diff(self._indptr))
+        removed = np.isin(row_ids, rows)
+        np.subtract.at(self._df, self._indices[removed], 1)
+
+        keep_rows = np.ones(self.n_docs, dtype=bool)
+        keep_rows[rows] = False
+        lengths = np.diff(self._indptr)[keep_rows]
+        self._indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self._indices = self._indices[~removed]
+        self._data = self._data[~removed]
+        self.n_docs = int(keep_rows.sum())
+        self._invalidate()
+
+    def _compute_idf(self):
+        """按 sklearn 的 smooth_idf 公式计算IDF"""
+        if self._idf is None:
+            df = self.df.astype(np.float64)
+            self._idf = np.log((1.0 + self.n_docs) / (1.0 + df)) + 1.0
+        return self._idf
+
+    def _weighted_matrix(self):
+        """构建按行L2归一化的TF-IDF稀疏矩阵"""
+        if self._matrix is not None:
+            return self._matrix
+
+        self._consolidate()
+        idf = self._compute_idf()
+        indptr, indices = self._indptr, self._indices
+        weighted = self._data * idf[indices]
+        row_ids = np.repeat(np.arange(self.n_docs), np.diff(indptr))
+        norms = np.sqrt(np.bincount(row_ids, weights=weighted ** 2, minlength=self.n_docs))
+        if len(weighted):
+            weighted /= norms[row_ids]
+
+        self._matrix = sparse.csr_matrix(
+            (weighted, indices, indptr), shape=(self.n_docs, len(self.vocabulary))
+        )
+        return self._matrix
+
+    def similarities(self, tokens):
+        """计算查询与每个片段的余弦相似度"""
+        if self.n_docs == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        counts = {}
+        for token in tokens:
+            col = self.vocabulary.get(token)
+            if col is not None:
+                counts[col] = counts.get(col, 0) + 1
+        if not counts:
+            return np.zeros(self.n_docs, dtype=np.float64)
+
+        # 查询向量预先归一化，文档行已归一化，点积即为余弦相似度
+        idf = self._compute_idf()
+        cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts)) * idf[cols]
+        weights /= np.sqrt(np.dot(weights, weights))
+
+        query_vec = np.zeros(len(self.vocabulary), dtype=np.float64)
+        query_vec[cols] = weights
+        # 一次稀疏矩阵-向量乘法
+        return self._weighted_matrix().dot(query_vec)
+
+    def term_idf(self, tokens):
+        """返回各词的IDF，未登录词按只出现在0个片段计算"""
+        idf = self._compute_idf()
+        unseen = np.log(1.0 + self.n_docs) + 1.0
+        return np.array([
+            idf[self.vocabulary[token]] if token in self.vocabulary else unseen
+            for token in tokens
+        ], dtype=np.float64)
+
+    def search(self, tokens, top_k):
+        """返回得分最高的 top_k 个片段的 (行号, 得分)"""
+        scores = self.similarities(tokens)
+        rows = top_k_indices(scores, top_k)
+        return rows, scores[rows]
+
+    def save(self, directory):
+        """把索引保存为可内存映射的原始数组"""
+        self._consolidate()
+        os.makedirs(directory, exist_ok=True)
+        # 先把内存映射的数组复制到内存并释放映射（包括缓存的矩阵），
+        # 否则 Windows 上无法替换正在映射的文件
+        self._indptr = np.array(self._indptr, dtype=np.int64)
+        self._indices = np.array(self._indices, dtype=np.int32)
+        self._data = np.array(self._data, dtype=np.float32)
+        self._invalidate()
+        arrays = {
+            "indptr": self._indptr,
+            "indices": self._indices,
+            "data": self._data,
+            "df": np.array(self.df, dtype=np.int64),
+        }
+        for name, array in arrays.items():
+            _atomic_write(os.path.join(directory, f"{name}.npy"), lambda f, a=array: np.save(f, a))
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        _atomic_write(
+            os.path.join(directory, "vocab.json"),
+            lambda f: f.write(json.dumps(terms, ensure_ascii=False).encode("utf-8"))
+        )
+
+    @classmethod
+    def load(cls, directory):
+        """以内存映射方式加载索引，不需要重新分词"""
+        index = cls()
+        with open(os.path.join(directory, "vocab.json"), "r", encoding="utf-8") as f:
+            terms = json.load(f)
+        index.vocabulary = {term: col for col, term in enumerate(terms)}
+        df = np.load(os.path.join(directory, "df.npy"))
+        index._df = np.zeros(max(1024, len(df) * 2), dtype=np.int64)
+        index._df[:len(df)] = df
+        index._indptr = np.load(os.path.join(directory, "indptr.npy"), mmap_mode="r")
+        index._indices = np.load(os.path.join(directory, "indices.npy"), mmap_mode="r")
+        index._data = np.load(os.path.join(directory, "data.npy"), mmap_mode="r")
+        index.n_docs = len(index._indptr) - 1
+        return index
+
+
+class BM25Index:
+    """基于倒排索引的BM25检索
+
+    每个词对应一组按片段号升序排列的倒排数组（片段号、词频），查询时只访问
+    查询词的倒排表，并用 MaxScore 方式提前终止：剩余词的得分上界不足以进入
+    top_k 时，不再接收新的候选片段，只给已有候选补分。
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}  # 词 -> 词号
+        self.n_docs = 0
+        self._doc_len = np.zeros(1024, dtype=np.float32)
+        self._total_len = 0.0
+        self._max_tf = np.zeros(1024, dtype=np.float32)  # 每个词的最大词频，用于得分上界
+        # 已合并的倒排表（加载后可能是内存映射）：_base_ptr[t]:_base_ptr[t+1] 为词t的区间
+        self._base_ptr = np.zeros(1, dtype=np.int64)
+        self._base_docs = np.zeros(0, dtype=np.int32)
+        self._base_tfs = np.zeros(0, dtype=np.float32)
+        self._postings = {}  # 合并过新增数据的词 -> (片段号数组, 词频数组)
+        self._pending = {}  # 尚未合并的新增倒排项：词 -> ([片段号], [词频])
+
+    def __len__(self):
+        return self.n_docs
+
+    def clear(self):
+        """清空索引"""
+        self.__init__(self.k1, self.b)
+
+    @staticmethod
+    def _grow(array, size):
+        if size <= len(array):
+            return array
+        grown = np.zeros(max(size, len(array) * 2), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add_documents(self, token_lists):
+        """追加已分词的片段，新增项先放入待合并列表"""
+        for tokens in token_lists:
+            counts = {}
+            for token in tokens:
+                term = self.vocabulary.get(token)
+                if term is None:
+                    term = len(self.vocabulary)
+                    self.vocabulary[token] = term
+                counts[term] = counts.get(term, 0) + 1
+            self._max_tf = self._grow(self._max_tf, len(self.vocabulary))
+            doc_id = self.n_docs
+            for term, tf in counts.items():
+                pending = self._pending.setdefault(term, ([], []))
+                pending[0].append(doc_id)
+                pending[1].append(tf)
+                self._max_tf[term] = max(self._max_tf[term], tf)
+            self._doc_len = self._grow(self._doc_len, doc_id + 1)
+            self._doc_len[doc_id] = len(tokens)
+            self._total_len += len(tokens)
+            self.n_docs += 1
+
+    def postings(self, term):
+        """返回词的倒排数组 (片段号, 词频)，按需合并新增项"""
+        if term in self._postings:
+            docs, tfs = self._postings[term]
+        elif term + 1 < len(self._base_ptr):
+            start, end = self._base_ptr[term], self._base_ptr[term + 1]
+            docs, tfs = self._base_docs[start:end], self._base_tfs[start:end]
+        else:
+            docs, tfs = self._base_docs[:0], self._base_tfs[:0]
+
+        pending = self._pending.pop(term, None)
+        if pending is not None:
+            docs = np.concatenate([docs, np.asarray(pending[0], dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.asarray(pending[1], dtype=np.float32)])
+            self._postings[term] = (docs, tfs)
+        return docs, tfs
+
+    def _flatten(self):
+        """把全部倒排表合并成连续数组 (ptr, docs, tfs)"""
+        lists = [self.postings(term) for term in range(len(self.vocabulary))]
+        lengths = np.fromiter((len(docs) for docs, _ in lists), dtype=np.int64, count=len(lists))
+        ptr = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=ptr[1:])
+        if lists:
+            docs = np.concatenate([docs for docs, _ in lists]).astype(np.int32)
+            tfs = np.concatenate([tfs for _, tfs in lists]).astype(np.float32)
+        else:
+            docs = np.zeros(0, dtype=np.int32)
+            tfs = np.zeros(0, dtype=np.float32)
+        return ptr, docs, tfs
+
+    def remove_documents(self, rows):
+        """删除指定行的片段，其余片段重新编号"""
+        rows = np.asarray(sorted(set(rows)), dtype=np.int64)
+        if not len(rows):
+            return
+        ptr, docs, tfs = self._flatten()
+        keep_rows = np.ones(self.n_docs, dtype=bool)
+        keep_rows[rows] = False
+        new_ids = np.cumsum(keep_rows) - 1
+
+        keep = keep_rows[docs]
+        terms = np.repeat(np.arange(len(self.vocabulary)), np.diff(ptr))[keep]
+        docs, tfs = new_ids[docs[keep]].astype(np.int32), tfs[keep]
+        self._base_ptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.vocabulary)), out=self._base_ptr[1:])
+        self._base_docs, self._base_tfs = docs, tfs
+        self._postings = {}
+
+        self._max_tf = np.zeros(len(self._max_tf), dtype=np.float32)
+        np.maximum.at(self._max_tf, terms, tfs)
+        doc_len = self._doc_len[:self.n_docs][keep_rows]
+        self._doc_len = self._grow(np.array(doc_len, dtype=np.float32), 1024)
+        self._total_len = float(doc_len.sum())
+        self.n_docs = len(doc_len)
+
+    def search(self, tokens, top_k):
+        """返回BM25得分最高的 top_k 个片段的 (行号, 得分)"""
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+        if self.n_docs == 0 or top_k <= 0:
+            return empty
+
+        query_tf = {}
+        for token in tokens:
+            term = self.vocabulary.get(token)
+            if term is not None:
+                query_tf[term] = query_tf.get(term, 0) + 1
+
+        k1, b = self.k1, self.b
+        avgdl = self._total_len / self.n_docs or 1.0
+        terms = []
+        for term, qtf in query_tf.items():
+            docs, tfs = self.postings(term)
+            if not len(docs):
+                continue
+            df = len(docs)
+            idf = np.log(1.0 + (self.n_docs - df + 0.5) / (df + 0.5))
+            # 文档长度取0时分母最小，得到该词得分的上界
+            max_tf = float(self._max_tf[term])
+            upper = qtf * idf * (k1 + 1) * max_tf / (max_tf + k1 * (1 - b))
+            terms.append((upper, qtf * idf, docs, tfs))
+        if not terms:
+            return empty
+
+        # 上界大的词先处理，阈值能更快抬高
+        terms.sort(key=lambda item: item[0], reverse=True)
+        # remaining_bounds[i]：处理完第i个词后，剩余各词得分上界之和
+        uppers = np.array([item[0] for item in terms])
+        remaining_bounds = np.append(np.cumsum(uppers[::-1])[::-1][1:], 0.0)
+        cand_docs = np.zeros(0, dtype=np.int64)
+        cand_scores = np.zeros(0, dtype=np.float64)
+        pruning = False
+
+        for (upper, weight, docs, tfs), remaining in zip(terms, remaining_bounds):
+            if not pruning:
+                doc_len = self._doc_len[docs]
+                scores = weight * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_len / avgdl))
+                cand_docs, inverse = np.unique(
+                    np.concatenate([cand_docs, docs]), return_inverse=True
+                )
+                cand_scores = np.bincount(
+                    inverse, weights=np.concatenate([cand_scores, scores]), minlength=len(cand_docs)
+                )
+            elif len(cand_docs):
+                # 只给已有候选补分：在倒排表中二分查找候选片段
+                pos = np.minimum(np.searchsorted(docs, cand_docs), len(docs) - 1)
+                hit = docs[pos] == cand_docs
+                hit_tfs = tfs[pos[hit]]
+                doc_len = self._doc_len[cand_docs[hit]]
+                cand_scores[hit] += weight * hit_tfs * (k1 + 1) / (
+                    hit_tfs + k1 * (1 - b + b * doc_len / avgdl)
+                )
+
+            if len(cand_docs) >= top_k:
+                threshold = np.partition(cand_scores, len(cand_scores) - top_k)[len(cand_scores) - top_k]
+                if remaining < threshold:
+                    # 新片段的得分不可能超过阈值，进入只补分阶段并丢弃无望的候选
+                    pruning = True
+                    keep = cand_scores + remaining >= threshold
+                    cand_docs, cand_scores = cand_docs[keep], cand_scores[keep]
+
+        order = top_k_indices(cand_scores, top_k)
+        return cand_docs[order], cand_scores[order]
+
+    def save(self, directory):
+        """把倒排表保存为可内存映射的原始数组"""
+        os.makedirs(directory, exist_ok=True)
+        ptr, docs, tfs = self._flatten()
+        arrays = {
+            "ptr": ptr,
+            "docs": docs,
+            "tfs": tfs,
+            "doc_len": np.array(self._doc_len[:self.n_docs], dtype=np.float32),
+            "max_tf": np.array(self._max_tf[:len(self.vocabulary)], dtype=np.float32),
+        }
+        # 改为引用内存中的数组，避免覆盖正在映射的文件
+        self._base_ptr, self._base_docs, self._base_tfs = ptr, docs, tfs
+        self._postings = {}
+        for name, array in arrays.items():
+            _atomic_write(os.path.join(directory, f"{name}.npy"), lambda f, a=array: np.save(f, a))
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        _atomic_write(
+            os.path.join(directory, "vocab.json"),
+            lambda f: f.write(json.dumps(
+                {"k1": self.k1, "b": self.b, "terms": terms}, ensure_ascii=False
+            ).encode("utf-8"))
+        )
+
+    @classmethod
+    def load(cls, directory):
+        """以内存映射方式加载倒排表"""
+        with open(os.path.join(directory, "vocab.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(meta["k1"], meta["b"])
+        index.vocabulary = {term: i for i, term in enumerate(meta["terms"])}
+        index._base_ptr = np.load(os.path.join(directory, "ptr.npy"), mmap_mode="r")
+        index._base_docs = np.load(os.path.join(directory, "docs.npy"), mmap_mode="r")
+        index._base_tfs = np.load(os.path.join(directory, "tfs.npy"), mmap_mode="r")
+        doc_len = np.load(os.path.join(directory, "doc_len.npy"))
+        max_tf = np.load(os.path.join(directory, "max_tf.npy"))
+        index.n_docs = len(doc_len)
+        index._doc_len = cls._grow(np.array(doc_len, dtype=np.float32), 1024)
+        index._total_len = float(doc_len.sum())
+        index._max_tf = cls._grow(np.array(max_tf, dtype=np.float32), 1024)
+        return index
+
+
+def top_k_indices(scores, k):
+    """选出得分最高的k个下标：先部分划分，再只对胜出者排序"""
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _atomic_write(path, write_func):
+    """先写临时文件再替换，避免中途失败留下损坏的文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write_func(f)
+    os.replace(tmp_path, path)
+
+
+def _save_strings(directory, name, strings):
+    """把字符串列表保存为 UTF-8 字节数组和偏移数组"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    _atomic_write(os.path.join(directory, f"{name}.npy"), lambda f: np.save(f, data))
+    _atomic_write(os.path.join(directory, f"{name}_offsets.npy"), lambda f: np.save(f, offsets))
+
+
+def _load_strings(directory, name, mmap_mode=None):
+    """读取 _save_strings 保存的字节数组和偏移数组"""
+    data = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(directory, f"{name}_offsets.npy"))
+    return data, offsets
+
+
+def _decode_strings(data, offsets):
+    """把字节数组按偏移切分解码成字符串列表"""
+    raw = data.tobytes()
+    return [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+class KnowledgeChunks(Sequence):
+    """知识库片段列表
+
+    已保存的片段以原始数组存放：正文按 UTF-8 拼接成一个字节数组（加载时内存映射），
+    starts/ends 记录每个片段的字节范围，file_ids 指向源文件表，pages 记录起始页码
+    （0 表示没有页码）。按下标访问时才解码
+    对应的片段，加载耗时与片段数量无关。新增的片段先放在内存中，保存时再合并。
+    """
+
+    def __init__(self):
+        self._files = []  # 文件号 -> (来源名, 路径)
+        self._file_ids = {}  # 路径 -> 文件号
+        self._text = np.zeros(0, dtype=np.uint8)
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._ends = np.zeros(0, dtype=np.int64)
+        self._doc_files = np.zeros(0, dtype=np.int32)
+        self._pages = np.zeros(0, dtype=np.int32)
+        self._added = []  # 尚未保存的片段
+
+    def __len__(self):
+        return len(self._starts) + len(self._added)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("片段下标超出范围")
+        if index >= len(self._starts):
+            return self._added[index - len(self._starts)]
+        content, source, path = self._raw(index)
+        doc = {"source": source, "path": path, "content": content.decode("utf-8")}
+        if self._pages[index]:
+            doc["page"] = int(self._pages[index])
+        return doc
+
+    def _raw(self, row):
+        """返回已保存片段的正文字节、来源名和路径"""
+        source, path = self._files[self._doc_files[row]]
+        return self._text[self._starts[row]:self._ends[row]].tobytes(), source, path
+
+    def append(self, doc):
+        self._added.append(doc)
+
+    def sources(self):
+        """所有片段的来源名集合，不需要解码正文"""
+        names = {self._files[file_id][0] for file_id in np.unique(self._doc_files)}
+        names.update(doc["source"] for doc in self._added)
+        return names
+
+    def remove_path(self, path):
+        """移除某个源文件的全部片段，返回被移除片段原来的下标"""
+        saved = len(self._starts)
+        rows = []
+        file_id = self._file_ids.get(path)
+        if file_id is not None:
+            removed = self._doc_files == file_id
+            rows = np.flatnonzero(removed).tolist()
+            keep = ~removed
+            self._starts = self._starts[keep]
+            self._ends = self._ends[keep]
+            self._doc_files = self._doc_files[keep]
+            self._pages = self._pages[keep]
+        rows.extend(saved + i for i, doc in enumerate(self._added) if doc.get("path") == path)
+        self._added = [doc for doc in self._added if doc.get("path") != path]
+        return rows
+
+    def save(self, directory):
+        """把片段合并写成可内存映射的原始数组"""
+        os.makedirs(directory, exist_ok=True)
+        parts, files, file_ids = [], [], {}
+        doc_files = np.zeros(len(self), dtype=np.int32)
+        pages = np.zeros(len(self), dtype=np.int32)
+        pages[:len(self._pages)] = self._pages
+        for row in range(len(self)):
+            if row < len(self._starts):
+                content, source, path = self._raw(row)
+            else:
+                doc = self._added[row - len(self._starts)]
+                content, source, path = doc["content"].encode("utf-8"), doc["source"], doc["path"]
+                pages[row] = doc.get("page") or 0
+            if path not in file_ids:
+                file_ids[path] = len(files)
+                files.append((source, path))
+            doc_files[row] = file_ids[path]
+            parts.append(content)
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in parts], out=offsets[1:])
+
+        # 先换成内存中的数组，释放对旧文件的映射，否则 Windows 上无法替换文件
+        self._text = np.frombuffer(b"".join(parts), dtype=np.uint8)
+        self._starts, self._ends = offsets[:-1], offsets[1:]
+        self._doc_files = doc_files
+        self._pages = pages
+        self._files, self._file_ids, self._added = files, file_ids, []
+
+        _atomic_write(os.path.join(directory, "content.npy"), lambda f: np.save(f, self._text))
+        _atomic_write(os.path.join(directory, "content_offsets.npy"), lambda f: np.save(f, offsets))
+        _atomic_write(os.path.join(directory, "file_ids.npy"), lambda f: np.save(f, doc_files))
+        _atomic_write(os.path.join(directory, "pages.npy"), lambda f: np.save(f, pages))
+        _save_strings(directory, "file_sources", [source for source, _ in files])
+        _save_strings(directory, "file_paths", [path for _, path in files])
+
+    @classmethod
+    def load(cls, directory):
+        """以内存映射方式加载片段"""
+        chunks = cls()
+        chunks._text, offsets = _load_strings(directory, "content", mmap_mode="r")
+        chunks._starts, chunks._ends = offsets[:-1], offsets[1:]
+        chunks._doc_files = np.load(os.path.join(directory, "file_ids.npy"))
+        chunks._pages = np.load(os.path.join(directory, "pages.npy"))
+        sources = _decode_strings(*_load_strings(directory, "file_sources"))
+        paths = _decode_strings(*_load_strings(directory, "file_paths"))
+        chunks._files = list(zip(sources, paths))
+        chunks._file_ids = {path: file_id for file_id, path in enumerate(paths)}
+        return chunks
+
+
+class HashingEmbedder:
+    """确定性的本地哈希向量化：字符/单词及相邻二元组做带符号特征哈希
+
+    不依赖网络和模型文件，未配置嵌入模型时使用。
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts):
+        """返回按行L2归一化的 float32 矩阵"""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            units = re.findall(r"[a-z0-9]+|[一-鿿]", text.lower())
+            features = units + [a + b for a, b in itertools.pairwise(units)]
+            if not features:
+                continue
+            hashes = np.fromiter(
+                (zlib.crc32(feature.encode("utf-8")) for feature in features),
+                dtype=np.uint32, count=len(features)
+            )
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+            vectors[row] = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class EmbeddingUnavailableError(Exception):
+    """嵌入接口暂时不可用（重试用尽或仍在暂停期内）"""
+
+
+class RemoteEmbedder:
+    """通过 OpenAI 兼容的 /embeddings 接口获取向量
+
+    每批请求失败时按指数退避重试；重试用尽后抛出 EmbeddingUnavailableError，
+    并在 cooldown 秒内直接失败，不再请求接口。
+    """
+
+    def __init__(self, client, model, batch_size=32, retries=2, backoff=0.5, cooldown=30):
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.name = f"remote-{model}"
+        self._paused_until = 0.0
+
+    def embed(self, texts):
+        """返回按行L2归一化的 float32 矩阵，接口不可用时抛出 EmbeddingUnavailableError"""
+        if time.monotonic() < self._paused_until:
+            raise EmbeddingUnavailableError("嵌入接口最近调用失败，暂停请求")
+        batches = [
+            self._embed_batch(list(texts[start:start + self.batch_size]))
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        vectors = np.vstack(batches)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _embed_batch(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.client.embeddings.create(model=self.model, input=batch)
+                return np.asarray([item.embedding for item in response.data], dtype=np.float32)
+            except OpenAIError as e:
+                if attempt == self.retries:
+                    self._paused_until = time.monotonic() + self.cooldown
+                    raise EmbeddingUnavailableError(f"嵌入接口调用失败: {e}") from e
+                time.sleep(self.backoff * 2 ** attempt)
+
+
+class DenseVectorIndex:
+    """稠密向量的近似最近邻索引（IVF倒排聚类）
+
+    向量按行连续存放在 float32 数组中，也可量化为 int8（每行一个缩放系数）。
+    片段数达到 ivf_min_size 后用球面 k-means 训练聚类中心，查询时只扫描与
+    查询最接近的 nprobe 个簇；数量较少时直接暴力计算。
+    """
+
+    ALLOW_PARTIAL = True  # 可以只覆盖知识库的前若干个片段（按需补建）
+
+    def __init__(self, quantize="float32", ivf_min_size=20000, nprobe=8):
+        self.quantize = quantize
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self.embedder_name = None  # 构建索引所用的向量化方式，查询必须一致
+        self.dim = 0
+        self.n_docs = 0
+        self._vectors = None  # float32 向量或 int8 编码
+        self._scales = None  # int8 量化时每行的缩放系数
+        self._centroids = None
+        self._assign = np.zeros(0, dtype=np.int32)  # 每行所属的簇
+        self._trained_size = 0
+        self._list_order = None  # 按簇排序后的行号（惰性构建）
+        self._list_ptr = None
+
+    def __len__(self):
+        return self.n_docs
+
+    def clear(self):
+        """清空索引"""
+        self.__init__(self.quantize, self.ivf_min_size, self.nprobe)
+
+    def _encode(self, vectors):
+        if self.quantize != "int8":
+            return vectors.astype(np.float32), None
+        scales = np.abs(vectors).max(axis=1)
+        scales[scales == 0] = 1.0
+        codes = np.round(vectors / scales[:, None] * 127).astype(np.int8)
+        return codes, (scales / 127).astype(np.float32)
+
+    def _grow(self, size):
+        capacity = 0 if self._vectors is None else len(self._vectors)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, 1024)
+        dtype = np.int8 if self.quantize == "int8" else np.float32
+        vectors = np.zeros((capacity, self.dim), dtype=dtype)
+        scales = np.zeros(capacity, dtype=np.float32)
+        assign = np.zeros(capacity, dtype=np.int32)
+        if self.n_docs:
+            vectors[:self.n_docs] = self._vectors[:self.n_docs]
+            assign[:self.n_docs] = self._assign[:self.n_docs]
+            if self._scales is not None:
+                scales[:self.n_docs] = self._scales[:self.n_docs]
+        self._vectors, self._scales, self._assign = vectors, scales, assign
+
+    def add_vectors(self, vectors, embedder_name):
+        """追加一批已归一化的向量"""
+        if not len(vectors):
+            return
+        if self.embedder_name is None:
+            self.embedder_name = embedder_name
+            self.dim = vectors.shape[1]
+        elif embedder_name != self.embedder_name or vectors.shape[1] != self.dim:
+            raise ValueError(f"向量化方式不一致: {embedder_name} / {self.embedder_name}")
+
+        start = self.n_docs
+        self._grow(start + len(vectors))
+        codes, scales = self._encode(vectors)
+        self._vectors[start:start + len(vectors)] = codes
+        if scales is not None:
+            self._scales[start:start + len(vectors)] = scales
+        self.n_docs += len(vectors)
+
+        # 数量明显增长后重新训练聚类，否则只把新向量分到最近的簇
+        if self.n_docs >= self.ivf_min_size and self.n_docs >= self._trained_size * 4:
+            self._train()
+        elif self._centroids is not None:
+            self._assign[start:self.n_docs] = self._nearest_centroids(vectors)
+        self._list_order = None
+
+    def _decode(self, rows):
+        vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self.quantize == "int8":
+            vectors *= self._scales[rows][:, None]
+        return vectors
+
+    def _scores(self, rows, query):
+        """计算指定行与查询向量的内积；rows 为 None 表示全部"""
+        if rows is None:
+            vectors = self._vectors[:self.n_docs]
+            scales = None if self.quantize != "int8" else self._scales[:self.n_docs]
+        else:
+            vectors = self._vectors[rows]
+            scales = None if self.quantize != "int8" else self._scales[rows]
+        query = query.astype(np.float32)
+        if scales is None:
+            return np.asarray(vectors).dot(query)
+        return np.asarray(vectors, dtype=np.float32).dot(query) * scales
+
+    def _nearest_centroids(self, vectors, batch_size=65536):
+        assign = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch_size):
+            assign[start:start + batch_size] = np.argmax(
+                vectors[start:start + batch_size].dot(self._centroids.T), axis=1
+            )
+        return assign
+
+    def _train(self, iterations=8, seed=0):
+        """在采样上训练球面 k-means 聚类中心，并重新分配全部向量"""
+        rng = np.random.default_rng(seed)
+        n_lists = int(min(1024, max(16, np.sqrt(self.n_docs))))
+        sample_rows = rng.choice(self.n_docs, size=min(self.n_docs, n_lists * 32), replace=False)
+        sample = self._decode(np.sort(sample_rows))
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample.dot(centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # 空簇重新随机取一个样本作为中心
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+        self._centroids = centroids.astype(np.float32)
+
+        for start in range(0, self.n_docs, 65536):
+            rows = np.arange(start, min(start + 65536, self.n_docs))
+            self._assign[rows] = self._nearest_centroids(self._decode(rows))
+        self._trained_size = self.n_docs
+        self._list_order = None
+
+    def _lists(self):
+        """按簇分组的行号 (order, ptr)，簇c的行为 order[ptr[c]:ptr[c+1]]"""
+        if self._list_order is None:
+            assign = self._assign[:self.n_docs]
+            self._list_order = np.argsort(assign, kind="stable")
+            self._list_ptr = np.zeros(len(self._centroids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assign, minlength=len(self._centroids)), out=self._list_ptr[1:])
+        return self._list_order, self._list_ptr
+
+    def search(self, query, top_k):
+        """返回与查询向量内积最高的 top_k 个片段的 (行号, 得分)"""
+        if self.n_docs == 0 or top_k <= 0 or query is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        if self._centroids is None:
+            scores = self._scores(None, query)
+            rows = top_k_indices(scores, top_k)
+            return rows, scores[rows]
+
+        # 只扫描最接近的若干个簇，候选不足时扩大探测范围
+        order, ptr = self._lists()
+        probes = np.argsort(-self._centroids.dot(query))
+        nprobe = self.nprobe
+        while True:
+            selected = probes[:nprobe]
+            candidates = np.concatenate([order[ptr[c]:ptr[c + 1]] for c in selected])
+            if len(candidates) >= top_k or nprobe >= len(probes):
+                break
+            nprobe *= 2
+        candidates = np.sort(candidates)
+        scores = self._scores(candidates, query)
+        best = top_k_indices(scores, top_k)
+        return candidates[best], scores[best]
+
+    def remove_documents(self, rows):
+        """删除指定行的向量；超出索引范围的行（尚未向量化）忽略"""
+        rows = np.asarray(sorted(set(rows)), dtype=np.int64)
+        rows = rows[rows < self.n_docs]
+        if not len(rows):
+            return
+        keep = np.ones(self.n_docs, dtype=bool)
+        keep[rows] = False
+        self._vectors = np.array(self._vectors[:self.n_docs][keep])
+        self._assign = np.array(self._assign[:self.n_docs][keep])
+        if self._scales is not None:
+            self._scales = np.array(self._scales[:self.n_docs][keep])
+        self.n_docs = int(keep.sum())
+        self._list_order = None
+
+    def save(self, directory):
+        """保存为可内存映射的原始数组"""
+        os.makedirs(directory, exist_ok=True)
+        arrays = {"vectors": np.array(self._vectors[:self.n_docs]) if self.n_docs else np.zeros((0, self.dim), np.float32),
+                  "assign": np.array(self._assign[:self.n_docs])}
+        if self.quantize == "int8":
+            arrays["scales"] = np.array(self._scales[:self.n_docs])
+        if self._centroids is not None:
+            arrays["centroids"] = self._centroids
+        # 改为引用内存中的数组，避免覆盖正在映射的文件
+        self._vectors, self._assign = arrays["vectors"], arrays["assign"]
+        if "scales" in arrays:
+            self._scales = arrays["scales"]
+        for name, array in arrays.items():
+            _atomic_write(os.path.join(directory, f"{name}.npy"), lambda f, a=array: np.save(f, a))
+        meta = {
+            "embedder": self.embedder_name, "dim": self.dim, "quantize": self.quantize,
+            "ivf_min_size": self.ivf_min_size, "nprobe": self.nprobe,
+            "trained_size": self._trained_size
+        }
+        _atomic_write(os.path.join(directory, "meta.json"), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    @classmethod
+    def load(cls, directory):
+        """以内存映射方式加载向量"""
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(meta["quantize"], meta["ivf_min_size"], meta["nprobe"])
+        index.embedder_name = meta["embedder"]
+        index.dim = meta["dim"]
+        index._trained_size = meta["trained_size"]
+        index._vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        index._assign = np.load(os.path.join(directory, "assign.npy"))
+        if meta["quantize"] == "int8":
+            index._scales = np.load(os.path.join(directory, "scales.npy"))
+        centroids_path = os.path.join(directory, "centroids.npy")
+        if os.path.exists(centroids_path):
+            index._centroids = np.load(centroids_path)
+        index.n_docs = len(index._vectors)
+        return index
+
+
+def reciprocal_rank_fusion(rankings, k=60, limit=None):
+    """倒数排名融合：片段得分为其在各路排名中 1/(k+名次) 之和
+
+    rankings 为若干个按得分降序排列的行号序列，返回融合后的 (行号, 得分)。
+    """
+    fused = {}
+    for rows in rankings:
+        for rank, row in enumerate(rows):
+            fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (k + rank + 1)
+    # 同分时保留先出现的顺序
+    ordered = sorted(fused.items(), key=lambda item: -item[1])[:limit]
+    rows = np.array([row for row, _ in ordered], dtype=np.int64)
+    scores = np.array([score for _, score in ordered], dtype=np.float64)
+    return rows, scores
+
+
+class LocalReranker:
+    """对少量候选片段做精排的本地打分器
+
+    综合查询字符二元组的覆盖率（对中文改写问法更稳健）、按IDF加权的
+    查询词覆盖率和第一阶段的融合得分，不需要额外的模型。
+    """
+
+    def __init__(self, bigram_weight=0.5, term_weight=0.3, prior_weight=0.2):
+        self.bigram_weight = bigram_weight
+        self.term_weight = term_weight
+        self.prior_weight = prior_weight
+
+    @staticmethod
+    def _bigrams(text):
+        units = re.findall(r"[a-z0-9]+|[一-鿿]", text.lower())
+        return {a + b for a, b in itertools.pairwise(units)} or set(units)
+
+    def rerank(self, query, query_tokens, token_weights, contents, priors, deadline=None):
+        """返回候选的新顺序（候选列表中的下标）
+
+        超过 deadline（time.perf_counter 时刻）后，未打分的候选保持原有顺序排在后面。
+        """
+        bigrams = self._bigrams(query)
+        total_weight = float(np.sum(token_weights)) or 1.0
+        priors = np.asarray(priors, dtype=np.float64)
+        if len(priors) and priors.max() > 0:
+            priors = priors / priors.max()
+
+        scores = []
+        for i, content in enumerate(contents):
+            if deadline is not None and i % 16 == 0 and time.perf_counter() > deadline:
+                break
+            content = content.lower()
+            bigram_score = sum(1 for gram in bigrams if gram in content) / len(bigrams) if bigrams else 0.0
+            term_score = sum(
+                weight for token, weight in zip(query_tokens, token_weights) if token in content
+            ) / total_weight
+            scores.append(
+                self.bigram_weight * bigram_score
+                + self.term_weight * term_score
+                + self.prior_weight * priors[i]
+            )
+
+        scored = sorted(range(len(scores)), key=lambda i: -scores[i])
+        return scored + list(range(len(scores), len(contents)))
+
+
+class KnowledgeIndexStore:
+    """知识库的本地持久化目录
+
+    目录结构：
+        meta.json      版本号和片段数
+        chunks/        片段正文（UTF-8 字节数组 + 偏移）、所属源文件和页码
+        sources/       源文件清单，按列存放（路径、mtime、大小、内容哈希、文本编码）
+        tfidf/         TF-IDF索引的原始数组
+        bm25/          BM25倒排表的原始数组
+        dense/         稠密向量及IVF聚类中心
+    """
+
+    VERSION = 3
+    # 源文件清单的列及类型
+    SOURCE_FIELDS = (
+        ("mtime", np.float64), ("size", np.int64), ("sha1", str),
+        ("encoding", str), ("encoding_key", str),
+    )
+    INDEX_TYPES = (("tfidf", IncrementalTfidfIndex), ("bm25", BM25Index), ("dense", DenseVectorIndex))
+
+    def __init__(self, directory=KNOWLEDGE_INDEX_DIR):
+        self.directory = directory
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.directory, "meta.json"))
+
+    def load(self):
+        """加载片段、源文件清单和索引，缺失或不一致的索引不会返回"""
+        with open(os.path.join(self.directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != self.VERSION:
+            raise ValueError(f"知识库索引版本不兼容: {meta.get('version')}")
+        chunks = KnowledgeChunks.load(os.path.join(self.directory, "chunks"))
+        sources = self._load_sources(os.path.join(self.directory, "sources"))
+        indexes = {}
+        for name, index_type in self.INDEX_TYPES:
+            index_dir = os.path.join(self.directory, name)
+            if not os.path.isdir(index_dir):
+                continue
+            index = index_type.load(index_dir)
+            partial_ok = getattr(index_type, "ALLOW_PARTIAL", False) and len(index) < len(chunks)
+            if len(index) != len(chunks) and not partial_ok:
+                print(f"KnowledgeIndexStore.load: {name} 索引与片段数量不一致，忽略")
+                continue
+            indexes[name] = index
+        return chunks, sources, indexes
+
+    def save(self, chunks, sources, indexes):
+        """保存片段、源文件清单和各检索索引"""
+        os.makedirs(self.directory, exist_ok=True)
+        for name, index in indexes.items():
+            index.save(os.path.join(self.directory, name))
+        chunks.save(os.path.join(self.directory, "chunks"))
+        self._save_sources(os.path.join(self.directory, "sources"), sources)
+        # meta.json 最后写入，作为保存完成的标记
+        meta = {"version": self.VERSION, "chunks": len(chunks), "saved_at": time.time()}
+        _atomic_write(
+            os.path.join(self.directory, "meta.json"),
+            lambda f: f.write(json.dumps(meta).encode("utf-8"))
+        )
+
+    def _save_sources(self, directory, sources):
+        os.makedirs(directory, exist_ok=True)
+        paths = list(sources)
+        _save_strings(directory, "path", paths)
+        for key, dtype in self.SOURCE_FIELDS:
+            if dtype is str:
+                # 缺少的字段存为空串
+                _save_strings(directory, key, [sources[path].get(key) or "" for path in paths])
+            else:
+                column = np.array([sources[path][key] for path in paths], dtype=dtype)
+                _atomic_write(os.path.join(directory, f"{key}.npy"), lambda f, a=column: np.save(f, a))
+
+    def _load_sources(self, directory):
+        paths = _decode_strings(*_load_strings(directory, "path"))
+        sources = {path: {} for path in paths}
+        for key, dtype in self.SOURCE_FIELDS:
+            # 后来新增的列在旧目录里不存在，按缺失处理
+            if not os.path.exists(os.path.join(directory, f"{key}.npy")):
+                continue
+            if dtype is str:
+                values = _decode_strings(*_load_strings(directory, key))
+            else:
+                values = np.load(os.path.join(directory, f"{key}.npy")).tolist()
+            for path, value in zip(paths, values):
+                if value != "":
+                    sources[path][key] = value
+        return sources
+
+    def clear(self):
+        """删除持久化目录"""
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+    @staticmethod
+    def file_digest(path, block_size=1024 * 1024):
+        """计算文件内容的SHA1"""
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+class TokenCache:
+    """分词结果缓存：按内容哈希做键，内存LRU淘汰，可选SQLite磁盘层"""
+
+    def __init__(self, max_entries=20000, disk_path=None, namespace=""):
+        self.max_entries = max_entries
+        self.namespace = namespace  # 分词规则（如停用词表）变化时区分缓存
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_path = disk_path
+        self._db = None
+
+    def _connection(self, create=True):
+        """返回磁盘层连接，第一次调用时打开（调用方持有锁）
+
+        create 为 False 且数据库文件不存在时返回 None。
+        """
+        if self._db is None and self.disk_path:
+            if not create and not os.path.exists(self.disk_path):
+                return None
+            self._db = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT)")
+            self._db.commit()
+        return self._db
+
+    def _key(self, text):
+        return hashlib.sha1((self.namespace + "\0" + text).encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        """查找缓存，未命中返回None"""
+        key = self._key(text)
+        with self._lock:
+            tokens = self._memory.get(key)
+            if tokens is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return tokens
+            db = self._connection(create=False)
+            if db is not None:
+                row = db.execute("SELECT tokens FROM tokens WHERE key = ?", (key,)).fetchone()
+                if row:
+                    tokens = json.loads(row[0])
+                    self._remember(key, tokens)
+                    self.hits += 1
+                    return tokens
+            self.misses += 1
+            return None
+
+    def put(self, text, tokens):
+        """写入缓存"""
+        key = self._key(text)
+        with self._lock:
+            self._remember(key, tokens)
+            db = self._connection()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO tokens (key, tokens) VALUES (?, ?)",
+                    (key, json.dumps(tokens, ensure_ascii=False))
+                )
+                db.commit()
+
+    def put_many(self, items):
+        """批量写入 (文本, 分词结果)，磁盘层只提交一次"""
+        with self._lock:
+            rows = []
+            for text, tokens in items:
+                key = self._key(text)
+                self._remember(key, tokens)
+                rows.append((key, json.dumps(tokens, ensure_ascii=False)))
+            db = self._connection() if rows else None
+            if db is not None:
+                db.executemany("INSERT OR REPLACE INTO tokens (key, tokens) VALUES (?, ?)", rows)
+                db.commit()
+
+    def _remember(self, key, tokens):
+        self._memory[key] = tokens
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get_or_compute(self, text, tokenize):
+        """命中则直接返回，否则调用 tokenize 分词并写入缓存"""
+        tokens = self.get(text)
+        if tokens is None:
+            tokens = tokenize(text)
+            self.put(text, tokens)
+        return tokens
+
+class ResponseCache:
+    """LLM响应缓存：相同请求直接重放之前的流式输出
+
+    按模型、温度、规范化后的消息列表和RAG上下文的哈希做键，内存LRU淘汰，
+    条目超过 ttl 秒后失效，可选SQLite磁盘层（重启后仍可命中）。磁盘层在
+    第一次读写时才打开，缓存未启用时不会创建数据库文件。
+    """
+
+    def __init__(self, max_entries=500, ttl=3600, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self._memory = OrderedDict()  # 键 -> (写入时间, 流式片段列表)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+
+    def _connection(self, create=True):
+        """返回磁盘层连接，第一次调用时打开（调用方持有锁）
+
+        create 为 False 且数据库文件不存在时返回 None。
+        """
+        if self._db is None and self.disk_path:
+            if not create and not os.path.exists(self.disk_path):
+                return None
+            self._db = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, chunks TEXT, created REAL, accessed REAL)"
+            )
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def make_key(model, temperature, messages, rag_context=""):
+        """由请求参数计算缓存键，消息内容中的空白差异不影响命中"""
+        normalized = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                content = re.sub(r"\s+", " ", content).strip()
+            normalized.append([message["role"], content])
+        payload = json.dumps({
+            "model": model,
+            "temperature": round(float(temperature), 3),
+            "messages": normalized,
+            "rag": hashlib.sha1((rag_context or "").encode("utf-8")).hexdigest()
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """查找未过期的缓存，未命中返回None"""
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._memory[key]
+                entry = None
+            if entry is None and db is not None:
+                row = db.execute(
+                    "SELECT created, chunks FROM responses WHERE key = ? AND created >= ?",
+                    (key, now - self.ttl)
+                ).fetchone()
+                if row:
+                    entry = (row[0], json.loads(row[1]))
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._memory.move_to_end(key)
+            if db is not None:
+                db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                db.commit()
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, chunks):
+        """写入一次完整响应的流式片段"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, (now, list(chunks)))
+            db = self._connection()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, chunks, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(list(chunks), ensure_ascii=False), now, now)
+                )
+                # 磁盘层同样只保留最近使用的 max_entries 条
+                db.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+                db.commit()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """清空缓存和计数"""
+        with self._lock:
+            self._memory.clear()
+            self.hits = 0
+            self.misses = 0
+            db = self._connection(create=False)
+            if db is not None:
+                db.execute("DELETE FROM responses")
+                db.commit()
+
+
+# 语义缓存比较问题时忽略的口语化词
+SEMANTIC_FILLER_WORDS = frozenset({"怎么样", "如何", "怎样", "今天", "现在", "目前", "请问", "一下", "告诉我"})
+
+
+class SemanticCache:
+    """语义缓存：措辞不同但意思相近的问题复用已有回答
+
+    问题向量按行存放在固定大小的矩阵中，查找时与上下文键相同的条目逐一
+    计算内积；容量满时淘汰最久未使用的条目。每次命中的相似度记录在
+    hit_log 中，便于调整阈值。
+    """
+
+    def __init__(self, max_entries=256, threshold=0.9, ttl=1800):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.embedder_name = None
+        self._vectors = None
+        self._entries = [None] * max_entries  # 每行的 {question, chunks, context_key, created, used}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_log = deque(maxlen=200)  # (时间, 问题, 命中的问题, 相似度)
+
+    def __len__(self):
+        return sum(1 for entry in self._entries if entry is not None)
+
+    def lookup(self, vector, context_key, question="", embedder_name=None):
+        """返回 (缓存的流式片段, 相似度)，未命中时片段为None"""
+        now = time.time()
+        with self._lock:
+            best_row, best_score = -1, 0.0
+            if self._vectors is not None and embedder_name == self.embedder_name:
+                rows = [
+                    row for row, entry in enumerate(self._entries)
+                    if entry is not None and entry["context_key"] == context_key
+                    and now - entry["created"] <= self.ttl
+                ]
+                if rows:
+                    scores = self._vectors[rows].dot(vector)
+                    best = int(np.argmax(scores))
+                    best_row, best_score = rows[best], float(scores[best])
+            if best_row < 0 or best_score < self.threshold:
+                self.misses += 1
+                return None, best_score
+            entry = self._entries[best_row]
+            entry["used"] = now
+            self.hits += 1
+            self.hit_log.append((now, question, entry["question"], best_score))
+            return entry["chunks"], best_score
+
+    def add(self, vector, question, chunks, context_key, embedder_name):
+        """写入一条回答，容量满时替换最久未使用的条目"""
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or embedder_name != self.embedder_name or len(vector) != self._vectors.shape[1]:
+                # 向量化方式变化后旧向量不可比较
+                self.embedder_name = embedder_name
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self._entries = [None] * self.max_entries
+            free = [row for row, entry in enumerate(self._entries) if entry is None]
+            if free:
+                row = free[0]
+            else:
+                row = min(range(self.max_entries), key=lambda r: self._entries[r]["used"])
+            self._vectors[row] = vector
+            self._entries[row] = {
+                "question": question, "chunks": list(chunks),
+                "context_key": context_key, "created": now, "used": now
+            }
+
+    def clear(self):
+        """清空缓存和计数"""
+        with self._lock:
+            self._vectors = None
+            self._entries = [None] * self.max_entries
+            self.hits = 0
+            self.misses = 0
+            self.hit_log.clear()
+
+
+class TTLCache:
+    """带过期时间的内存缓存，合并并发的相同请求
+
+    同一个键同时只有一个请求在执行，其余调用等待它的结果。开启
+    stale_while_revalidate 时，过期但未超过 stale_ttl 的数据立即返回，
+    同时在后台刷新。
+    """
+
+    def __init__(self, ttl=600, stale_ttl=0, max_entries=1000, stale_while_revalidate=False):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl  # 过期后仍可临时返回的时长
+        self.max_entries = max_entries
+        self.stale_while_revalidate = stale_while_revalidate
+        self._entries = OrderedDict()  # 键 -> (值, 获取时间)
+        self._inflight = {}  # 键 -> 正在执行的请求
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "stale": 0, "miss": 0, "coalesced": 0}
+
+    def get_or_fetch(self, key, fetch, should_cache=None):
+        """返回 (值, 状态)，状态为 hit / stale / miss / coalesced
+
+        should_cache(值) 为 False 的结果（如请求失败）不写入缓存。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = time.time() - entry[1]
+                if age <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hit"] += 1
+                    return entry[0], "hit"
+                if self.stale_while_revalidate and age <= self.ttl + self.stale_ttl:
+                    self.stats["stale"] += 1
+                    if key not in self._inflight:
+                        future = self._inflight[key] = Future()
+                        threading.Thread(
+                            target=self._run_fetch, args=(key, fetch, should_cache, future), daemon=True
+                        ).start()
+                    return entry[0], "stale"
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = Future()
+                leader = True
+                self.stats["miss"] += 1
+            else:
+                leader = False
+                self.stats["coalesced"] += 1
+
+        if leader:
+            self._run_fetch(key, fetch, should_cache, future)
+            return future.result(), "miss"
+        return future.result(), "coalesced"
+
+    def _run_fetch(self, key, fetch, should_cache, future):
+        try:
+            value = fetch()
+        except Exception as e:
+            # 等待同一请求的线程收到同样的异常，失败结果不缓存
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if should_cache is None or should_cache(value):
+                self._entries[key] = (value, time.time())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            self._inflight.pop(key, None)
+        future.set_result(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SearchResultStore:
+    """网络搜索结果的SQLite缓存
+
+    只保存标题、链接和摘要；结果按链接去重，不同查询命中同一网页时共用
+    一行，查询记录只保存链接顺序。查询记录超过 ttl 秒后失效。数据库在第一次
+    使用时才打开（并清理过期记录），不搜索时不会创建文件。
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+
+    def _connection(self, create=True):
+        """返回数据库连接，第一次调用时打开（调用方持有锁）
+
+        create 为 False 且数据库文件不存在时返回 None。
+        """
+        if self._db is None:
+            if not create and not os.path.exists(self.path):
+                return None
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(url TEXT PRIMARY KEY, title TEXT, snippet TEXT, updated REAL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS queries "
+                "(key TEXT PRIMARY KEY, provider TEXT, query TEXT, num_results INTEGER, urls TEXT, created REAL)"
+            )
+            self._prune(self._db)
+        return self._db
+
+    @staticmethod
+    def normalize_query(query):
+        """查询规范化：小写、合并空白、去掉首尾标点"""
+        query = re.sub(r"\s+", " ", query.lower()).strip()
+        return query.strip("?？!！。.,，")
+
+    def _key(self, provider, query, num_results):
+        return hashlib.sha1(
+            json.dumps([provider, self.normalize_query(query), num_results], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, provider, query, num_results):
+        """返回未过期的结果列表 [{title, link, snippet}]，未命中返回None"""
+        key = self._key(provider, query, num_results)
+        with self._lock:
+            db = self._connection()
+            row = db.execute(
+                "SELECT urls FROM queries WHERE key = ? AND created >= ?", (key, time.time() - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            urls = json.loads(row[0])
+            found = {
+                url: (title, snippet)
+                for url, title, snippet in db.execute(
+                    f"SELECT url, title, snippet FROM results WHERE url IN ({','.join('?' * len(urls))})", urls
+                )
+            } if urls else {}
+            self.hits += 1
+            return [
+                {"title": found[url][0], "link": url, "snippet": found[url][1]}
+                for url in urls if url in found
+            ]
+
+    def put(self, provider, query, num_results, items):
+        """保存一次搜索的结果，返回按链接去重后的列表"""
+        unique = []
+        seen = set()
+        for item in items:
+            url = item.get("link", "")
+            if not url or url in seen:
+                continue
+            seen.add(url)
+            unique.append({"title": item.get("title", ""), "link": url, "snippet": item.get("snippet", "")})
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.executemany(
+                "INSERT OR REPLACE INTO results (url, title, snippet, updated) VALUES (?, ?, ?, ?)",
+                [(item["link"], item["title"], item["snippet"], now) for item in unique]
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO queries (key, provider, query, num_results, urls, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(provider, query, num_results), provider, self.normalize_query(query),
+                 num_results, json.dumps([item["link"] for item in unique]), now)
+            )
+            db.commit()
+        return unique
+
+    def prune(self):
+        """删除过期的查询，以及不再被任何查询引用的结果"""
+        with self._lock:
+            db = self._connection(create=False)
+            if db is not None:
+                self._prune(db)
+
+    def _prune(self, db):
+        expired = time.time() - self.ttl
+        db.execute("DELETE FROM queries WHERE created < ?", (expired,))
+        db.execute(
+            "DELETE FROM results WHERE updated < ? AND url NOT IN "
+            "(SELECT value FROM queries, json_each(queries.urls))",
+            (expired,)
+        )
+        db.commit()
+
+    def clear(self):
+        with self._lock:
+            db = self._connection(create=False)
+            if db is not None:
+                db.execute("DELETE FROM queries")
+                db.execute("DELETE FROM results")
+                db.commit()
+
+
+class ResponseAccumulator:
+    """流式响应的累加器
+
+    增量文本按到达顺序追加到列表中，正文（content）和推理过程（reasoning_content）
+    分开保存，整段文本只在需要时拼接一次。渲染器和缓存通过 since() 和 content
+    直接读取增量片段，不复制整段文本。同时记录字符数、首字延迟和输出速度。
+    """
+
+    def __init__(self, counter=None):
+        self.counter = counter  # TokenCounter，用于估算输出token数
+        self.content = []  # 正文增量片段
+        self.reasoning = []  # 推理过程增量片段
+        self._tool_calls = {}  # 序号 -> 模型请求的函数调用（参数分段到达）
+        self.content_chars = 0
+        self.reasoning_chars = 0
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._text = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """请求发出时调用，首字延迟从这里开始计时"""
+        self.started_at = time.perf_counter()
+
+    def add(self, content=None, reasoning=None):
+        """追加一段增量，返回本次追加的正文（没有时为None）"""
+        if not content and not reasoning:
+            return None
+        with self._lock:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            if reasoning:
+                self.reasoning.append(reasoning)
+                self.reasoning_chars += len(reasoning)
+            if content:
+                self.content.append(content)
+                self.content_chars += len(content)
+        return content or None
+
+    def add_delta(self, delta):
+        """从接口返回的 delta 中取出正文、推理过程和函数调用并追加"""
+        for part in getattr(delta, "tool_calls", None) or []:
+            with self._lock:
+                index = part.index if getattr(part, "index", None) is not None else len(self._tool_calls)
+                call = self._tool_calls.setdefault(index, {"id": "", "name": "", "arguments": ""})
+                if part.id:
+                    call["id"] = part.id
+                function = getattr(part, "function", None)
+                if function is not None:
+                    call["name"] += function.name or ""
+                    call["arguments"] += function.arguments or ""
+        return self.add(getattr(delta, "content", None), getattr(delta, "reasoning_content", None))
+
+    @property
+    def tool_calls(self):
+        """模型请求的函数调用 [{"id", "name", "arguments"}]，按序号排列"""
+        return [self._tool_calls[index] for index in sorted(self._tool_calls)]
+
+    def since(self, index):
+        """返回第 index 个片段之后的正文片段和是否已结束"""
+        with self._lock:
+            return self.content[index:], self.finished_at is not None
+
+    def finish(self):
+        with self._lock:
+            if self.finished_at is None:
+                self.finished_at = time.perf_counter()
+        return self.stats()
+
+    def text(self):
+        """完整正文，结束后只拼接一次"""
+        if self._text is not None:
+            return self._text
+        text = "".join(self.content)
+        if self.finished_at is not None:
+            self._text = text
+        return text
+
+    def reasoning_text(self):
+        return "".join(self.reasoning)
+
+    def stats(self):
+        """首字延迟（秒）、字符数、输出token数和每秒token数"""
+        started = self.started_at if self.started_at is not None else self.first_token_at
+        end = self.finished_at or time.perf_counter()
+        if self.counter:
+            tokens = self.counter.count(self.text()) + self.counter.count(self.reasoning_text())
+        else:
+            tokens = len(self.content) + len(self.reasoning)
+        ttft = None if self.first_token_at is None or started is None else self.first_token_at - started
+        duration = end - self.first_token_at if self.first_token_at is not None else 0.0
+        return {
+            "ttft": ttft,
+            "chars": self.content_chars,
+            "reasoning_chars": self.reasoning_chars,
+            "tokens": tokens,
+            "tokens_per_second": tokens / duration if duration > 0 else 0.0,
+            "total": end - started if started is not None else 0.0,
+        }
+
+
+async def stream_chat_completion(client, accumulator, on_content=None, **request):
+    """用异步客户端流式请求模型，增量写入 accumulator 并返回它
+
+    on_content 在每段新正文到达时调用。请求被取消或超时时关闭流，
+    连接归还连接池。request 为 chat.completions.create 的参数。
+    """
+    response = None
+    try:
+        response = await client.chat.completions.create(stream=True, **request)
+        async for chunk in response:
+            if hasattr(chunk, "choices") and chunk.choices:
+                content = accumulator.add_delta(chunk.choices[0].delta)
+                if content and on_content:
+                    on_content(content)
+    finally:
+        if response is not None:
+            await response.close()
+    return accumulator
+
+
+class StreamRenderer:
+    """流式输出的批量渲染器
+
+    工作线程把增量文本追加到 ResponseAccumulator，界面线程按固定帧间隔读取
+    上一帧之后的新片段并合并成一次插入，避免每个token都排队一次界面更新。
+    """
+
+    def __init__(self, root, flush_callback, interval_ms=40, counter=None, on_finish=None, accumulator=None):
+        self.root = root
+        self.flush_callback = flush_callback  # 在界面线程中调用，参数为合并后的文本
+        self.interval_ms = interval_ms
+        self.on_finish = on_finish  # 最后一帧写入后在界面线程中调用
+        self.accumulator = accumulator or ResponseAccumulator(counter)
+        self._cursor = 0  # 已写入界面的片段数
+
+    def start(self):
+        """开始一次响应（请求发出时调用），首字延迟从这里开始计时"""
+        self.accumulator.start()
+        self.root.after(self.interval_ms, self._flush)
+
+    def push(self, delta):
+        """工作线程调用：追加一段增量文本"""
+        self.accumulator.add(delta)
+
+    def finish(self):
+        """工作线程调用：输出结束，剩余内容在下一帧写入；返回统计信息"""
+        return self.accumulator.finish()
+
+    def _flush(self):
+        pending, finished = self.accumulator.since(self._cursor)
+        if pending:
+            self._cursor += len(pending)
+            self.flush_callback("".join(pending))
+        if not finished:
+            self.root.after(self.interval_ms, self._flush)
+        elif self.on_finish:
+            self.on_finish()
+
+    def stats(self):
+        return self.accumulator.stats()
+
+
+class ConsoleSink:
+    """控制台镜像输出：消息放进队列，由后台线程用rich渲染
+
+    调用方（界面线程或工作线程）只做一次非阻塞的入队，Markdown解析和终端写入
+    都在后台线程完成。verbosity 控制输出的内容：0 不输出，1 输出对话和错误，
+    2 及以上额外输出检索到的RAG上下文。队列满时丢弃新消息而不是阻塞调用方。
+    """
+
+    _STOP = object()
+
+    def __init__(self, console=None, verbosity=1, enabled=True, max_pending=10000):
+        self.console = console or Console()
+        self.verbosity = verbosity
+        self.enabled = enabled
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="console-sink", daemon=True)
+        self._thread.start()
+
+    def emit(self, kind, text, level=1):
+        """非阻塞地提交一条输出
+
+        kind: "markdown" 按Markdown渲染，"markup" 按rich标记渲染，
+        "stream" 原样写出且不换行（用于流式输出的增量文本）。
+        """
+        if not self.enabled or level > self.verbosity:
+            return
+        try:
+            self._queue.put_nowait((kind, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """等待已提交的输出全部写出"""
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self, timeout=2):
+        """写出剩余输出并停止后台线程"""
+        self._queue.put((self._STOP, None))
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            kind, text = self._queue.get()
+            if kind is self._STOP:
+                return
+            try:
+                if kind == "flush":
+                    text.set()
+                elif kind == "markdown":
+                    self.console.print(Markdown(text))
+                elif kind == "stream":
+                    self.console.print(text, end="", markup=False, highlight=False, soft_wrap=True)
+                else:
+                    self.console.print(text)
+            except (OSError, ValueError, MarkupError) as e:
+                # 后台线程不能因为一条输出失败而退出
+                print(f"ConsoleSink: 输出失败: {e}")
+
+
+class TranscriptView:
+    """聊天记录的虚拟化显示
+
+    完整的消息列表只保存在内存模型中（标题、标签和正文片段），Text控件里只渲染
+    一个窗口内的消息。滚动到窗口顶部或底部附近时按页加载更早或更新的消息，
+    并从另一端移除多余的消息，控件中的内容量保持不变。每条已渲染消息的起点用
+    mark 标记，便于按消息删除。
+    """
+
+    def __init__(self, text, window=200, page=50, threshold=0.05):
+        self.text = text
+        self.window = window  # 控件中最多渲染的消息数
+        self.page = page  # 每次按需加载的消息数
+        self.threshold = threshold  # 滚动条距两端多近时加载
+        self.entries = []  # [标题, 标题标签, 正文标签, 正文片段列表]
+        self.first = 0  # 已渲染消息的范围 [first, last)
+        self.last = 0
+        self._loading = False
+        self._scrollbar_set = text.vbar.set if hasattr(text, "vbar") else None
+        text.configure(yscrollcommand=self._on_scroll)
+
+    def add(self, header, header_tag, body, body_tag):
+        """追加一条消息并滚动到底部"""
+        self.entries.append([header, header_tag, body_tag, [body] if body else []])
+        if self.last != len(self.entries) - 1:
+            # 当前没有显示最新的消息，直接跳到末尾
+            self._render_tail()
+        else:
+            self._edit(lambda: self._insert_entries(self.last, self.last + 1, tk.END))
+            self.last += 1
+            self._trim_top(self.last - self.window)
+        self._scroll_to_end()
+
+    def extend_last(self, body):
+        """向最后一条消息追加正文（流式输出）"""
+        if not self.entries:
+            return
+        self.entries[-1][3].append(body)
+        if self.last == len(self.entries):
+            self._edit(lambda: self.text.insert(tk.END, body, self.entries[-1][2]))
+            self._scroll_to_end()
+
+    def load(self, entries):
+        """替换全部消息，只渲染最后一个窗口"""
+        self.entries = [[header, header_tag, body_tag, [body] if body else []]
+                        for header, header_tag, body, body_tag in entries]
+        self._render_tail()
+        self._scroll_to_end()
+
+    def clear(self):
+        self.entries = []
+        self._edit(self._delete_all)
+        self.first = self.last = 0
+
+    def _render_tail(self):
+        def render():
+            self._delete_all()
+            self.first = max(0, len(self.entries) - self.window)
+            self.last = len(self.entries)
+            self._insert_entries(self.first, self.last, tk.END)
+        self._edit(render)
+
+    def _delete_all(self):
+        for name in self.text.mark_names():
+            if name.startswith("msg"):
+                self.text.mark_unset(name)
+        self.text.delete("1.0", tk.END)
+
+    def _insert_entries(self, start, stop, index):
+        """把 [start, stop) 的消息按顺序插入到 index 处，返回插入内容的末尾位置"""
+        self.text.mark_set("transcript_insert", index)
+        self.text.mark_gravity("transcript_insert", tk.RIGHT)
+        for i in range(start, stop):
+            header, header_tag, body_tag, parts = self.entries[i]
+            mark = f"msg{i}"
+            self.text.mark_set(mark, "transcript_insert")
+            self.text.mark_gravity(mark, tk.LEFT)
+            if header:
+                self.text.insert("transcript_insert", header, header_tag)
+            if parts:
+                self.text.insert("transcript_insert", "".join(parts), body_tag)
+        end = self.text.index("transcript_insert")
+        self.text.mark_unset("transcript_insert")
+        return end
+
+    def _trim_top(self, new_first):
+        """移除 new_first 之前已渲染的消息"""
+        if new_first <= self.first:
+            return
+        def trim():
+            self.text.delete("1.0", f"msg{new_first}")
+            for i in range(self.first, new_first):
+                self.text.mark_unset(f"msg{i}")
+            self.first = new_first
+        self._edit(trim)
+
+    def _trim_bottom(self, new_last):
+        """移除 new_last 及之后已渲染的消息"""
+        if new_last >= self.last:
+            return
+        def trim():
+            self.text.delete(f"msg{new_last}", tk.END)
+            for i in range(new_last, self.last):
+                self.text.mark_unset(f"msg{i}")
+            self.last = new_last
+        self._edit(trim)
+
+    def _on_scroll(self, top, bottom):
+        if self._scrollbar_set:
+            self._scrollbar_set(top, bottom)
+        if self._loading:
+            return
+        if float(top) <= self.threshold and self.first > 0:
+            self._loading = True
+            self.text.after_idle(self._load_older)
+        elif float(bottom) >= 1 - self.threshold and self.last < len(self.entries):
+            self._loading = True
+            self.text.after_idle(self._load_newer)
+
+    def _load_older(self):
+        """在顶部插入更早的一页消息，保持当前可见位置不变"""
+        try:
+            start = max(0, self.first - self.page)
+            self.text.mark_set("transcript_view", "@0,0")
+            self.text.mark_gravity("transcript_view", tk.RIGHT)
+            old_first = self.first
+            def render():
+                end = self._insert_entries(start, old_first, "1.0")
+                # 原来第一条消息的 mark 留在了 1.0 处，移到新插入内容之后
+                self.text.mark_set(f"msg{old_first}", end)
+            self._edit(render)
+            self.first = start
+            self._trim_bottom(self.first + self.window)
+            self.text.yview("transcript_view")
+            self.text.mark_unset("transcript_view")
+        finally:
+            self._loading = False
+
+    def _load_newer(self):
+        """在底部追加更新的一页消息，并移除顶部多余的消息"""
+        try:
+            stop = min(len(self.entries), self.last + self.page)
+            old_last = self.last
+            self._edit(lambda: self._insert_entries(old_last, stop, tk.END))
+            self.last = stop
+            self.text.mark_set("transcript_view", "@0,0")
+            self.text.mark_gravity("transcript_view", tk.LEFT)
+            self._trim_top(self.last - self.window)
+            self.text.yview("transcript_view")
+            self.text.mark_unset("transcript_view")
+        finally:
+            self._loading = False
+
+    def _edit(self, func):
+        self.text.config(state=tk.NORMAL)
+        try:
+            func()
+        finally:
+            self.text.config(state=tk.DISABLED)
+
+    def _scroll_to_end(self):
+        self.text.see(tk.END)
+
+
+class ChatSession:
+    """一个对话标签页：对话历史、聊天记录显示和进行中的请求"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, transcript, frame):
+        self.id = next(self._ids)
+        self.name = f"对话 {self.id}"
+        self.history = []  # 对话历史
+        self.question = ""  # 正在回答的问题
+        self.transcript = transcript
+        self.frame = frame  # 标签页对应的控件
+        self.future = None  # 进行中的请求（concurrent.futures.Future）
+        self.last_stream_stats = {}  # 最近一次响应的首字延迟和输出速度
+
+    @property
+    def waiting(self):
+        return self.future is not None and not self.future.done()
+
+
+# ================= 工具调用的HTTP客户端 =================
+
+class CircuitOpenError(Exception):
+    """熔断期间拒绝请求"""
+
+
+class CircuitBreaker:
+    """单个工具的熔断器：连续失败达到阈值后暂停请求，冷却后放行一次试探"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """是否允许发出请求；半开状态同时只放行一个试探请求"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class LatencyHistogram:
+    """请求耗时直方图（毫秒），按固定分桶计数"""
+
+    BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.total = 0
+        self.errors = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms, ok=True):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, elapsed_ms)] += 1
+            self.total += 1
+            self.errors += 0 if ok else 1
+            self.sum_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, p):
+        """由分桶估算百分位数，返回所在桶的上界"""
+        with self._lock:
+            if not self.total:
+                return 0.0
+            target = p / 100.0 * self.total
+            seen = 0
+            for bound, count in zip(self.BUCKETS, self.counts):
+                seen += count
+                if seen >= target:
+                    return min(bound, self.max_ms)
+            return self.max_ms
+
+
+class HttpClient:
+    """所有工具共用的HTTP客户端
+
+    每个主机一个保持连接的会话（连接池），请求带连接/读取超时，网络错误
+    和可重试的状态码按带抖动的指数退避有限次重试，重试等待不超过 deadline；
+    每个工具有独立的熔断器和耗时直方图。verbosity 为 1 及以上时输出每次重试。
+    """
+
+    RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, connect_timeout=3.05, read_timeout=15, retries=2, backoff=0.5,
+                 pool_size=10, failure_threshold=5, reset_timeout=30, deadline=None,
+                 verbosity=0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline  # 单次 get（含重试）的总时限（秒），None 表示不限
+        self.pool_size = pool_size
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.verbosity = verbosity
+        self._sessions = {}  # 主机 -> requests.Session
+        self.breakers = {}  # 工具 -> CircuitBreaker
+        self.histograms = {}  # 工具 -> LatencyHistogram
+        self._lock = threading.Lock()
+
+    def _session(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def _tool_state(self, tool):
+        with self._lock:
+            if tool not in self.breakers:
+                self.breakers[tool] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.histograms[tool] = LatencyHistogram()
+            return self.breakers[tool], self.histograms[tool]
+
+    def get(self, tool, url, params=None, **kwargs):
+        """发出GET请求，返回 requests.Response
+
+        重试耗尽或超过 deadline 后返回最后一次的响应或抛出最后一次的异常；
+        熔断期间抛出 CircuitOpenError。其它异常同样记为一次失败后抛出，
+        半开状态的试探请求不会一直占着。
+        """
+        breaker, histogram = self._tool_state(tool)
+        if not breaker.allow():
+            raise CircuitOpenError(f"{tool} 服务连续失败，暂停请求 {breaker.reset_timeout} 秒")
+        give_up = None if self.deadline is None else time.perf_counter() + self.deadline
+        session = self._session(url)
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                response = session.get(url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                histogram.record((time.perf_counter() - start) * 1000, ok=False)
+                error = e
+            except Exception:
+                histogram.record((time.perf_counter() - start) * 1000, ok=False)
+                breaker.record_failure()
+                raise
+            else:
+                error = None
+                ok = response.status_code not in self.RETRY_STATUS
+                histogram.record((time.perf_counter() - start) * 1000, ok=ok)
+                if ok:
+                    breaker.record_success()
+                    return response
+                retry_after = response.headers.get("Retry-After")
+            remaining = None if give_up is None else give_up - time.perf_counter()
+            if attempt == self.retries or (remaining is not None and remaining <= 0):
+                breaker.record_failure()
+                if error is not None:
+                    raise error
+                return response
+            # 带抖动的指数退避，服务端给出 Retry-After 时优先使用（最多等10秒），不超过剩余时间
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                delay = min(float(retry_after), 10.0)
+            if remaining is not None:
+                delay = min(delay, remaining)
+            if self.verbosity >= 1:
+                print(f"HttpClient.get: {tool} 第{attempt + 1}次请求失败，{delay:.2f}秒后重试")
+            time.sleep(delay)
+
+    def stats(self):
+        """各工具的请求统计：次数、失败数、耗时百分位、分桶计数和熔断状态"""
+        with self._lock:
+            tools = list(self.histograms)
+        return {
+            tool: {
+                "count": self.histograms[tool].total,
+                "errors": self.histograms[tool].errors,
+                "avg_ms": self.histograms[tool].sum_ms / max(1, self.histograms[tool].total),
+                "p50_ms": self.histograms[tool].percentile(50),
+                "p95_ms": self.histograms[tool].percentile(95),
+                "p99_ms": self.histograms[tool].percentile(99),
+                "buckets": list(zip(LatencyHistogram.BUCKETS, self.histograms[tool].counts)),
+                "breaker": self.breakers[tool].state,
+            }
+            for tool in tools
+        }
+
+
+# ================= 异步请求引擎 =================
+
+class RequestEngine:
+    """在后台线程中运行的 asyncio 事件循环
+
+    每次提问是事件循环中的一个任务，按会话登记，可以从任意线程按会话取消。
+    多个会话的请求在同一个循环中并发执行，共用同一个 AsyncOpenAI 客户端的连接池。
+    每个请求有截止时间，超时后任务被取消并抛出 asyncio.TimeoutError。
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline  # 默认的单次请求截止时间（秒），None 表示不限
+        self.loop = asyncio.new_event_loop()
+        self._tasks = {}  # 会话ID -> 进行中的任务集合（只在事件循环线程中访问）
+        self._thread = threading.Thread(target=self._run_loop, name="request-engine", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, session_id, coro, deadline=None):
+        """提交一个协程，返回 concurrent.futures.Future"""
+        deadline = self.deadline if deadline is None else deadline
+        return asyncio.run_coroutine_threadsafe(self._run(session_id, coro, deadline), self.loop)
+
+    async def _run(self, session_id, coro, deadline):
+        task = asyncio.current_task()
+        self._tasks.setdefault(session_id, set()).add(task)
+        try:
+            if deadline:
+                return await asyncio.wait_for(coro, deadline)
+            return await coro
+        finally:
+            tasks = self._tasks.get(session_id, set())
+            tasks.discard(task)
+            if not tasks:
+                self._tasks.pop(session_id, None)
+
+    def cancel(self, session_id):
+        """取消会话中所有进行中的请求（可在任意线程调用）"""
+        def cancel():
+            for task in list(self._tasks.get(session_id, ())):
+                task.cancel()
+        self.loop.call_soon_threadsafe(cancel)
+
+    def close(self, timeout=2):
+        """取消所有请求并停止事件循环"""
+        def stop():
+            for tasks in list(self._tasks.values()):
+                for task in tasks:
+                    task.cancel()
+            self.loop.call_later(0.1, self.loop.stop)
+        self.loop.call_soon_threadsafe(stop)
+        self._thread.join(timeout)
+
+
+# ================= 工具路由 =================
+
+class AhoCorasick:
+    """多关键词匹配自动机：对文本扫描一遍即可找出出现的全部关键词
+
+    构建时把失败指针展开成完整的状态转移表，扫描时每个字符只查一次字典。
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        goto = [{}]
+        outputs = [set()]
+        for index, keyword in enumerate(self.keywords):
+            node = 0
+            for ch in keyword:
+                if ch not in goto[node]:
+                    goto.append({})
+                    outputs.append(set())
+                    goto[node][ch] = len(goto) - 1
+                node = goto[node][ch]
+            outputs[node].add(index)
+
+        # 按层构建失败指针，并把失败状态的转移和输出合并进来
+        fail = [0] * len(goto)
+        self._delta = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            delta = dict(self._delta[fail[node]])
+            for ch, child in goto[node].items():
+                fail[child] = self._delta[fail[node]].get(ch, 0)
+                delta[ch] = child
+                queue.append(child)
+            self._delta[node] = delta
+            outputs[node] |= outputs[fail[node]]
+        self._outputs = [frozenset(out) for out in outputs]
+
+    def find(self, text):
+        """返回文本中出现的关键词下标集合"""
+        delta = self._delta
+        outputs = self._outputs
+        node = 0
+        found = set()
+        for ch in text:
+            node = delta[node].get(ch, 0)
+            if outputs[node]:
+                found |= outputs[node]
+        return found
+
+
+# 路由规则表：关键词（命中任一即候选）、触发所需的正则、参数提取方式
+ROUTING_TABLE = {
+    "search": {
+        "keywords": ["搜索", "查询", "查找", "最新", "新闻", "资讯", "信息", "知识", "了解", "什么是",
+                     "是谁", "哪里", "何时", "为什么", "怎么样", "告诉我", "是啥"],
+        # 没有关键词时，简单疑问句也触发搜索
+        "fallback_pattern": r'^(?:[\u4e00-\u9fa5a-zA-Z0-9\s]*[?？]'
+                            r'|(?:什么是|谁是|为什么|如何|怎样|哪里|何时)[\u4e00-\u9fa5a-zA-Z0-9\s]+)$',
+        "strip_prefixes": ["搜索", "查询", "查找", "告诉我", "了解", "什么是", "是谁", "哪里", "何时", "为什么", "怎么样"],
+    },
+    "weather": {
+        "keywords": ["天气", "温度", "气象", "预报", "晴", "雨", "风", "多云", "湿度", "气候", "weather",
+                     "temperature", "weather forecast", "sunny", "rain", "wind", "cloudy", "humidity"],
+        # 命中关键词后还需要识别出地点
+        "pattern": r'([\u4e00-\u9fa5]{2,8}(市|县|区|镇|村|乡)?|[A-Za-z]+)\s*(天气|气候|weather|forecast)',
+    },
+    "file": {
+        "keywords": ["文件", "读取", "打开", "内容", "路径", "目录", ".txt", ".doc", ".pdf", ".docx"],
+        # 命中关键词后还需要识别出文件路径
+        "pattern": r'([\w\s/\\().+?:\-]+?\.(txt|docx|pdf|md|doc))',
+        "pattern_flags": re.IGNORECASE,
+    },
+}
+
+
+class ToolRouter:
+    """由规则表一次编译的工具路由
+
+    所有工具的关键词合并进同一个 Aho-Corasick 自动机，扫描一遍问题得到
+    候选工具，再只对候选工具运行预编译的正则并提取参数。
+    """
+
+    def __init__(self, table=ROUTING_TABLE):
+        keywords = []
+        self._keyword_tools = []
+        self._rules = {}
+        for tool, rule in table.items():
+            for keyword in rule["keywords"]:
+                keywords.append(keyword)
+                self._keyword_tools.append(tool)
+            self._rules[tool] = {
+                "pattern": re.compile(rule["pattern"], rule.get("pattern_flags", 0)) if "pattern" in rule else None,
+                "fallback_pattern": re.compile(rule["fallback_pattern"]) if "fallback_pattern" in rule else None,
+                "strip_prefixes": tuple(rule.get("strip_prefixes", ())),
+            }
+        self._automaton = AhoCorasick(keywords)
+
+    def route(self, text, enabled=None):
+        """返回 {工具名: 参数}，enabled 为启用的工具集合（None 表示全部）
+
+        参数：search -> {"query"}，weather -> {"location"}（未规范化），
+        file -> {"file_path"}，路径格式错误时为 {"error"}。
+        """
+        candidates = {self._keyword_tools[i] for i in self._automaton.find(text)}
+        routes = {}
+        for tool, rule in self._rules.items():
+            if enabled is not None and tool not in enabled:
+                continue
+            if tool == "search":
+                if tool in candidates or rule["fallback_pattern"].match(text):
+                    routes[tool] = {"query": self._strip_prefix(text, rule["strip_prefixes"])}
+            elif tool in candidates:
+                match = rule["pattern"].search(text)
+                if match is None:
+                    continue
+                if tool == "weather":
+                    routes[tool] = {"location": match.group(1)}
+                else:
+                    routes[tool] = self._file_args(match.group(1))
+        return routes
+
+    @staticmethod
+    def _strip_prefix(text, prefixes):
+        """移除可能的搜索指令前缀"""
+        for prefix in prefixes:
+            if text.startswith(prefix):
+                return text[len(prefix):].strip()
+        return text
+
+    @staticmethod
+    def _file_args(file_path):
+        """从匹配结果中取出盘符开头的路径"""
+        idx = file_path.find(":")
+        if idx == -1 or idx == 0:
+            return {"error": "文件路径格式错误"}
+        return {"file_path": file_path[idx-1:]}
+
+
+# ================= 知识文档导入（可在子进程中运行） =================
+
+def filter_words(words, stopwords):
+    """过滤停用词和单字"""
+    return [
+        word for word in words
+        if (word not in stopwords) and (len(word) > 1)
+    ]
+
+
+# 句末标点，分块时优先在这些位置切分
+SENTENCE_ENDINGS = frozenset("。！？；!?;\n")
+
+
+def iter_chunks(pages, chunk_size=500, overlap=0, stopwords=None, sentence_aware=True):
+    """流式分块：惰性消费 jieba.cut 的结果，片段填满即产出
+
+    pages 为 (页码, 文本) 的可迭代对象，纯文本文件的页码为 None。
+    产出 {"content", "tokens", "page"}；未给出 stopwords 时 tokens 为 None。
+    overlap 为相邻片段重叠的字符数（不超过 chunk_size 的一半）；sentence_aware
+    为 True 时优先在当前片段后半段的最后一个句末标点处切分。
+    内存占用只与 chunk_size 和单页长度有关，与文档总长度无关。
+    """
+    overlap = max(0, min(overlap, chunk_size // 2))
+    min_split = chunk_size // 2  # 句末位置至少达到的长度，避免切出过短的片段
+    words = []  # 当前片段的 (词, 页码)
+    length = 0
+    carried = 0  # words 开头从上一片段带过来的词数
+    boundary = 0  # 最近一个可切分的句末位置（词下标之后）
+
+    def make_chunk(part):
+        content = "".join(word for word, _ in part)
+        tokens = None
+        if stopwords is not None:
+            # 与 chinese_tokenizer(content.lower()) 的结果一致
+            tokens = filter_words((word.lower() for word, _ in part), stopwords)
+        return {"content": content, "tokens": tokens, "page": part[0][1]}
+
+    def find_boundary(part):
+        position, total = 0, 0
+        for i, (word, _) in enumerate(part):
+            total += len(word)
+            if word[-1] in SENTENCE_ENDINGS and total >= min_split:
+                position = i + 1
+        return position
+
+    for page_number, text in pages:
+        for word in jieba.cut(text):
+            # 如果当前块长度加上新词长度超过阈值，并且当前块不为空
+            while length + len(word) > chunk_size and words:
+                if carried >= len(words):
+                    # 只剩从上一片段带过来的重叠部分，丢弃以免产出重复片段
+                    words, length, carried, boundary = [], 0, 0, 0
+                    break
+                # 切分点必须在重叠部分之后，保证每个片段都有新内容
+                split = boundary if sentence_aware and boundary > carried else len(words)
+                emitted = words[:split]
+                yield make_chunk(emitted)
+
+                # 已产出片段末尾不超过 overlap 个字符的词作为下一片段的开头，
+                # 至少留下第一个词不带走，保证分块总能向前推进
+                carry = []
+                carry_length = 0
+                for item in reversed(emitted[1:]):
+                    if carry_length + len(item[0]) > overlap:
+                        break
+                    carry.append(item)
+                    carry_length += len(item[0])
+                carry.reverse()
+
+                words = carry + words[split:]
+                carried = len(carry)
+                length = sum(len(w) for w, _ in words)
+                boundary = find_boundary(words) if sentence_aware else 0
+
+            words.append((word, page_number))
+            length += len(word)
+            if sentence_aware and word[-1] in SENTENCE_ENDINGS and length >= min_split:
+                boundary = len(words)
+
+    # 添加最后一个块
+    if words:
+        yield make_chunk(words)
+
+
+# 编码检测的采样大小：文件头 + 若干内部窗口
+ENCODING_HEAD_BYTES = 64 * 1024
+ENCODING_WINDOW_BYTES = 16 * 1024
+ENCODING_WINDOWS = 3
+# BOM 优先于采样检测（UTF-32 需在 UTF-16 之前判断）
+ENCODING_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+# 采样指纹 -> 编码，同一进程内重复导入时跳过检测
+_encoding_cache = OrderedDict()
+
+
+def _is_utf8_sample(sample, interior):
+    """判断采样是否为合法UTF-8；内部窗口可能没有换行可对齐，尾部可能被截断"""
+    if interior:
+        skip = 0
+        while skip < 3 and skip < len(sample) and 0x80 <= sample[skip] <= 0xBF:
+            skip += 1
+        sample = sample[skip:]
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def detect_encoding(f, size, known=None):
+    """采样检测已打开二进制文件的编码，返回 (编码, 采样指纹)
+
+    先看BOM，再检查文件头和几个内部窗口是否为合法UTF-8，都不是时才把采样交给
+    chardet。known 为清单中的旧记录，采样指纹相同时直接沿用旧的编码。
+    """
+    f.seek(0)
+    head = f.read(ENCODING_HEAD_BYTES)
+    samples = [head]
+    if size > ENCODING_HEAD_BYTES + ENCODING_WINDOW_BYTES:
+        step = (size - ENCODING_HEAD_BYTES) // (ENCODING_WINDOWS + 1)
+        for i in range(1, ENCODING_WINDOWS + 1):
+            f.seek(ENCODING_HEAD_BYTES + step * i)
+            window = f.read(ENCODING_WINDOW_BYTES)
+            # 从换行之后开始，避免窗口从多字节字符中间切入
+            newline = window.find(b"\n")
+            samples.append(window[newline + 1:] if newline != -1 else window)
+    f.seek(0)
+
+    fingerprint = hashlib.sha1(str(size).encode("ascii"))
+    for sample in samples:
+        fingerprint.update(sample)
+    key = fingerprint.hexdigest()
+    if known and known.get("encoding_key") == key:
+        return known["encoding"], key
+    if key in _encoding_cache:
+        _encoding_cache.move_to_end(key)
+        return _encoding_cache[key], key
+
+    encoding = None
+    for bom, name in ENCODING_BOMS:
+        if head.startswith(bom):
+            encoding = name
+            break
+    if encoding is None:
+        if all(_is_utf8_sample(sample, i > 0) for i, sample in enumerate(samples)):
+            encoding = "utf-8"
+        else:
+            # 各采样截到最后一个换行再拼接，避免截断的多字节字符干扰 chardet
+            trimmed = [sample[:sample.rfind(b"\n") + 1] or sample for sample in samples]
+            detected = chardet.detect(b"".join(trimmed))["encoding"] or "utf-8"
+            # GB2312/GBK 统一用超集 GB18030 解码
+            encoding = "gb18030" if detected.lower() in ("gb2312", "gbk") else detected
+
+    _encoding_cache[key] = encoding
+    while len(_encoding_cache) > 1024:
+        _encoding_cache.popitem(last=False)
+    return encoding, key
+
+
+def iter_text_pages(filename, info, known=None, block_size=256 * 1024):
+    """边读边解码文本文件，按块产出 (None, 文本)
+
+    检测出的 encoding、encoding_key 写入 info。
+    每块在最后一个换行或句末处断开，余下部分并入下一块，避免把词切开。
+    """
+    with open(filename, 'rb') as f:
+        encoding, key = detect_encoding(f, os.fstat(f.fileno()).st_size, known)
+        info["encoding"] = encoding
+        info["encoding_key"] = key
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        pending = ""
+        for block in iter(lambda: f.read(block_size), b""):
+            text = pending + decoder.decode(block)
+            cut = max(text.rfind("\n"), text.rfind("。")) + 1
+            if cut == 0 and len(text) < block_size * 4:
+                pending = text
+                continue
+            if cut == 0:
+                cut = len(text)
+            pending = text[cut:]
+            yield None, text[:cut]
+        text = pending + decoder.decode(b"", final=True)
+        if text:
+            yield None, text
+
+
+def iter_document_pages(filename, info=None, known=None):
+    """逐页产出知识文档的 (页码, 文本)，PDF 每次只保留一页文本
+
+    纯文本文件流式解码，检测出的编码信息写入 info。
+    """
+    if filename.lower().endswith('.pdf'):
+        # PDF文件处理：PyMuPDF 按页提取
+        with fitz.open(filename) as doc:
+            for page_index, page in enumerate(doc):
+                yield page_index + 1, page.get_text() + "\n"
+        return
+
+    # 文本文件处理
+    yield from iter_text_pages(filename, info if info is not None else {}, known)
+
+
+def ingest_knowledge_file(path, known=None, chunk_size=500, overlap=0, stopwords=frozenset()):
+    """读取、分块并分词单个知识文档，返回可直接合并进知识库的结果
+
+    只依赖模块级函数，可以交给进程池执行。known 为清单中该文件的旧记录，
+    分块前先对原始字节计算哈希，未变时直接返回 unchanged。
+    """
+    result = {"path": path, "source": os.path.basename(path), "status": "ok", "chunks": []}
+    try:
+        stat = os.stat(path)
+        result["mtime"] = stat.st_mtime
+        result["size"] = stat.st_size
+        result["sha1"] = KnowledgeIndexStore.file_digest(path)
+        if known and known.get("sha1") == result["sha1"]:
+            # 只有 mtime 变化，沿用已记录的编码信息
+            result["status"] = "unchanged"
+            result.update({key: known[key] for key in ("encoding", "encoding_key") if key in known})
+            return result
+
+        # 页文本直接流入分块器，不拼接整篇文档
+        chunks = iter_chunks(iter_document_pages(path, result, known), chunk_size, overlap, stopwords)
+        result["chunks"] = list(chunks)
+    except (OSError, ValueError, RuntimeError) as e:
+        # PyMuPDF 打不开或解析失败时抛出 RuntimeError 的子类
+        result["status"] = "error"
+        result["error"] = str(e)
+    return result
+
+
+# 各模型分词器的粗略换算比例：每个中文字符的token数、其他字符每个token的字符数
+DEFAULT_TOKEN_PROFILE = {"cjk_tokens": 1.0, "chars_per_token": 4.0, "context_window": 32768}
+MODEL_TOKEN_PROFILES = {model: dict(DEFAULT_TOKEN_PROFILE) for model in INPUT_SCHEMA["properties"]["model"]["enum"]}
+MODEL_TOKEN_PROFILES["Pro/deepseek-ai/DeepSeek-R1"].update(cjk_tokens=0.6, chars_per_token=3.5, context_window=65536)
+MODEL_TOKEN_PROFILES["Qwen/QVQ-72B-Preview"].update(cjk_tokens=0.7, chars_per_token=3.8, context_window=32768)
+
+CJK_PATTERN = re.compile(r"[　-〿一-鿿＀-￯]")
+
+
+class TokenCounter:
+    """按模型的换算比例估算token数，不依赖具体模型的分词器"""
+
+    MESSAGE_OVERHEAD = 4  # 每条消息的角色和分隔符开销
+
+    def __init__(self, model):
+        self.model = model
+        self.profile = MODEL_TOKEN_PROFILES.get(model, DEFAULT_TOKEN_PROFILE)
+
+    def count(self, text):
+        if not text:
+            return 0
+        cjk = len(CJK_PATTERN.findall(text))
+        other = len(text) - cjk
+        return int(np.ceil(cjk * self.profile["cjk_tokens"] + other / self.profile["chars_per_token"]))
+
+    def count_message(self, message):
+        return self.count(message["content"]) + self.MESSAGE_OVERHEAD
+
+    def truncate(self, text, max_tokens, marker="…（已截断）"):
+        """截断到不超过 max_tokens 个token，保留开头部分"""
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        if max_tokens <= self.count(marker):
+            return ""
+        cut = int(len(text) * max_tokens / total)
+        while cut > 0 and self.count(text[:cut]) + self.count(marker) > max_tokens:
+            cut = int(cut * 0.9)
+        return text[:cut] + marker
+
+
+class ContextPacker:
+    """按token预算和优先级组装发送给模型的消息
+
+    优先级：问题本身 > 系统/RAG上下文 > 工具结果 > 最近的对话（由新到旧）。
+    放不下的RAG片段从排名靠后的开始丢弃，工具结果截断，较早的对话
+    压缩成一条摘要。
+    """
+
+    def __init__(self, model, budget=8000, rag_ratio=0.5, tool_ratio=0.3, summary_chars=40):
+        self.counter = TokenCounter(model)
+        self.budget = min(budget, int(self.counter.profile["context_window"] * 0.75))
+        self.rag_ratio = rag_ratio  # RAG上下文最多占预算的比例
+        self.tool_ratio = tool_ratio  # 工具结果最多占预算的比例
+        self.summary_chars = summary_chars  # 摘要中每条旧消息保留的字符数
+        self.usage = {}
+
+    def pack(self, question, history, rag_context="", tool_result=None):
+        """返回 (messages, 实际使用的RAG上下文)
+
+        question 中的 "{tool_result}" 占位符会替换为（可能截断后的）工具结果；
+        各部分使用的token数记录在 self.usage 中。
+        """
+        counter = self.counter
+        usage = {"budget": self.budget, "rag": 0, "tool": 0, "history": 0, "summary": 0, "dropped_turns": 0}
+        question_tokens = counter.count(question.replace("{tool_result}", "")) + counter.MESSAGE_OVERHEAD
+        usage["question"] = question_tokens
+        remaining = self.budget - question_tokens
+
+        # 系统/RAG上下文：按排名依次放入片段
+        rag_message = None
+        if rag_context:
+            header = "根据以下上下文回答问题:\n"
+            footer = "\n\n如果上下文没有相关信息，请根据你的知识回答。"
+            limit = min(remaining, int(self.budget * self.rag_ratio))
+            used = counter.count(header + footer) + counter.MESSAGE_OVERHEAD
+            kept = []
+            for piece in re.split(r"\n\n(?=来源: )", rag_context):
+                cost = counter.count(piece) + 1
+                if used + cost > limit:
+                    if not kept:
+                        # 第一条片段也放不下时截断它
+                        piece = counter.truncate(piece, limit - used)
+                        if piece:
+                            kept.append(piece)
+                            used += counter.count(piece) + 1
+                    break
+                kept.append(piece)
+                used += cost
+            rag_context = "\n\n".join(kept)
+            if rag_context:
+                rag_message = {"role": "system", "content": header + rag_context + footer}
+                usage["rag"] = used
+                remaining -= used
+            else:
+                rag_context = ""
+
+        # 工具结果：超出上限时截断
+        if "{tool_result}" in question:
+            result = counter.truncate(tool_result or "", max(0, min(remaining, int(self.budget * self.tool_ratio))))
+            usage["tool"] = counter.count(result)
+            remaining -= usage["tool"]
+            question = question.replace("{tool_result}", result, 1)
+
+        # 最近的对话：由新到旧放入，放不下的旧消息压缩成摘要
+        kept = []
+        dropped = []
+        for message in reversed(history):
+            message = {"role": message["role"], "content": message["content"]}
+            cost = counter.count_message(message)
+            if not dropped and cost <= remaining:
+                kept.append(message)
+                remaining -= cost
+                usage["history"] += cost
+            else:
+                dropped.append(message)
+        kept.reverse()
+        dropped.reverse()
+
+        messages = []
+        if rag_message:
+            messages.append(rag_message)
+        if dropped:
+            usage["dropped_turns"] = sum(1 for message in dropped if message["role"] == "user")
+            # 摘要优先保留离当前较近的消息
+            header = "较早的对话摘要:"
+            available = remaining - counter.MESSAGE_OVERHEAD - counter.count(header)
+            lines = []
+            for message in reversed(dropped):
+                line = f"{'用户' if message['role'] == 'user' else '助手'}: {message['content'][:self.summary_chars]}"
+                cost = counter.count(line) + 1
+                if cost > available:
+                    break
+                lines.append(line)
+                available -= cost
+            if lines:
+                summary = {"role": "system", "content": header + "\n" + "\n".join(reversed(lines))}
+                usage["summary"] = counter.count_message(summary)
+                messages.append(summary)
+        messages.extend(kept)
+        messages.append({"role": "user", "content": question})
+
+        usage["total"] = sum(usage[key] for key in ("question", "rag", "tool", "history", "summary"))
+        self.usage = usage
+        return messages, rag_context
+
+    def fit_tool_results(self, results, used=0):
+        """把函数调用的多个工具结果截断到工具预算内，返回截断后的文本列表
+
+        used 为已组装消息的token数；每条结果平分 min(剩余预算, 工具预算)，
+        每条 tool 消息的开销也计算在内。
+        """
+        counter = self.counter
+        limit = max(0, min(self.budget - used, int(self.budget * self.tool_ratio)))
+        share = limit // max(1, len(results)) - counter.MESSAGE_OVERHEAD
+        texts = [counter.truncate(text, max(0, share)) for text in results]
+        self.usage = {"budget": self.budget, "tool": sum(counter.count(text) + counter.MESSAGE_OVERHEAD for text in texts)}
+        return texts
+
+
 class ChatApp:
     def __init__(self, root:tk.Tk):
         self.root = root
@@ -97,19 +2914,23 @@ class ChatApp:
         self.current_image = None
         self.image_preview = None
         self.image_path = None
-        # 聊天历史和当前状态
-        self.chat_history = []  # 完整对话历史
-        self.current_question = ""
+        # 对话会话和当前状态（每个标签页一个会话，对话历史保存在会话中）
+        self.sessions = []
+        self.session = None  # 当前显示的会话
         self.current_model = "Pro/deepseek-ai/DeepSeek-R1"
         self.current_temperature = 0.7
-        self.is_waiting_response = False
         self.max_history_length = 5  # 保留的最大对话轮数
         
         # RAG知识库
-        self.knowledge_base = []  # 存储知识库文档
-        self.vectorizer = TfidfVectorizer()  # 用于文本向量化
-        self.tfidf_matrix = None  # 存储向量化后的文档
-        self.doc_embeddings = {}  # 存储文档向量
+        self.knowledge_base = KnowledgeChunks()  # 存储知识库文档
+        self.vector_index = IncrementalTfidfIndex()  # 增量TF-IDF索引
+        self.bm25_index = BM25Index()  # BM25倒排索引
+        self.knowledge_sources = {}  # 已加载的源文件清单（路径 -> mtime/大小/哈希）
+        self.knowledge_store = KnowledgeIndexStore()  # 知识库持久化目录
+        self.knowledge_lock = threading.RLock()  # 知识库与索引的读写锁
+        self.ingest_thread = None  # 后台导入线程
+        self.ingest_cancel = threading.Event()  # 取消导入的标记
+        self.dense_sync_lock = threading.Lock()  # 同一时间只有一个线程补齐稠密索引
         
         # 添加文件列表状态
         self.file_list_var = tk.StringVar(value="")
@@ -118,10 +2939,67 @@ class ChatApp:
         jieba.initialize()  # 初始化分词器
         self.stopwords = self._load_stopwords()  # 加载停用词
         self.tool_config = self._load_tool_config()
+        rag_config = self.tool_config.get("rag", {})
+        self.chunk_size = rag_config.get("chunk_size", 500)  # 知识片段长度（字符）
+        self.chunk_overlap = rag_config.get("chunk_overlap", 0)  # 相邻片段重叠的字符数
+        self.token_cache = TokenCache(
+            max_entries=rag_config.get("token_cache_size", 20000),
+            disk_path=os.path.join(APP_DIR, TOKEN_CACHE_FILE) if rag_config.get("token_cache_disk", False) else None,
+            namespace=hashlib.sha1("\n".join(sorted(self.stopwords)).encode("utf-8")).hexdigest()
+        )
         self.client = OpenAI(
         api_key=self.tool_config.get("openai", {}).get("api_key", ""),
         base_url=self.tool_config.get("openai", {}).get("base_url", "https://api.siliconflow.cn/v1")
     )
+        # 对话请求使用异步客户端，所有会话共用一个连接池
+        self.async_client = AsyncOpenAI(
+            api_key=self.tool_config.get("openai", {}).get("api_key", ""),
+            base_url=self.tool_config.get("openai", {}).get("base_url", "https://api.siliconflow.cn/v1")
+        )
+        embedding_config = self.tool_config.get("embedding", {})
+        self.dense_enabled = embedding_config.get("enabled", True)  # 是否维护稠密向量索引
+        self.dense_index = DenseVectorIndex(
+            quantize=embedding_config.get("quantize", "float32"),
+            ivf_min_size=embedding_config.get("ivf_min_size", 20000),
+            nprobe=embedding_config.get("nprobe", 8)
+        )
+        self.embedder = self._create_embedder(embedding_config)
+        self.embed_executor = ThreadPoolExecutor(max_workers=2)  # 检索时计算查询向量，不占用知识库锁
+        # 混合检索：多路召回 + 倒数排名融合 + 本地精排，各阶段有独立的耗时预算
+        self.rrf_k = rag_config.get("rrf_k", 60)
+        self.candidate_k = rag_config.get("candidate_k", 100)  # 每路召回的候选数
+        self.rerank_candidates = rag_config.get("rerank_candidates", 200)  # 进入精排的候选数
+        self.candidate_budget_ms = rag_config.get("candidate_budget_ms", 50)
+        self.rerank_budget_ms = rag_config.get("rerank_budget_ms", 30)
+        self.reranker = LocalReranker()
+        self.last_retrieval_timings = {}  # 最近一次检索各阶段耗时（毫秒）
+        self.last_context_usage = {}  # 最近一次请求各部分的token用量
+        self.stream_stats_log = deque(maxlen=100)  # 最近若干次响应的统计
+        self.stream_frame_ms = self.tool_config.get("ui", {}).get("stream_frame_ms", 40)  # 流式输出的刷新间隔
+        # 天气查询缓存：按规范化后的地点缓存，过期后可先返回旧数据再后台刷新
+        weather_config = self.tool_config.get("weather", {})
+        self.weather_cache = TTLCache(
+            ttl=weather_config.get("cache_ttl", 600),
+            stale_ttl=weather_config.get("stale_ttl", 1800),
+            stale_while_revalidate=weather_config.get("stale_while_revalidate", True)
+        )
+        # 响应缓存（默认关闭）：相同请求直接重放之前的输出
+        cache_config = self.tool_config.get("response_cache", {})
+        self.response_cache = ResponseCache(
+            max_entries=cache_config.get("max_entries", 500),
+            ttl=cache_config.get("ttl", 3600),
+            disk_path=os.path.join(APP_DIR, RESPONSE_CACHE_FILE) if cache_config.get("disk", True) else None
+        )
+        self.response_cache_enabled = tk.BooleanVar(value=cache_config.get("enabled", False))
+        self.cache_replay_interval = cache_config.get("replay_interval_ms", 15) / 1000.0  # 重放时每个片段的间隔
+        # 语义缓存（默认关闭）：意思相近的问题在工具结果、RAG上下文和对话历史相同时复用回答
+        semantic_config = self.tool_config.get("semantic_cache", {})
+        self.semantic_cache = SemanticCache(
+            max_entries=semantic_config.get("max_entries", 256),
+            threshold=semantic_config.get("threshold", 0.9),
+            ttl=semantic_config.get("ttl", 1800)
+        )
+        self.semantic_cache_enabled = tk.BooleanVar(value=semantic_config.get("enabled", False))
         # 工具开关
         self.file_enabled = self.tool_config.get("file", {}).get("enabled", True)
         self.weather_enabled = self.tool_config.get("weather", {}).get("enabled", True)
@@ -129,6 +3007,41 @@ class ChatApp:
         self.weather_api_key = self.tool_config.get("weather", {}).get("api_key", "3ff5728d11250231a38d33b333fc3a3b")
         self.search_api_key = self.tool_config.get("search", {}).get("api_key", "")
         self.search_provider = self.tool_config.get("search", {}).get("provider", "google")
+        # 调试输出级别：0 只输出关键信息，1 输出搜索结果和网络重试，2 及以上输出完整的API响应
+        self.verbosity = self.tool_config.get("debug", {}).get("verbosity", 0)
+        # 工具并行执行的线程池和全局截止时间
+        tools_config = self.tool_config.get("tools", {})
+        self.tool_executor = ThreadPoolExecutor(max_workers=tools_config.get("max_workers", 4))
+        self.tool_deadline = tools_config.get("deadline", 20)  # 秒
+        self.tool_router = ToolRouter()  # 关键词规则在启动时编译一次
+        # 工具路由：heuristic 关键词规则 / function_calling 由模型决定 / hybrid 规则预筛选后由模型决定
+        self.tool_router_var = tk.StringVar(value=tools_config.get("router", "heuristic"))
+        http_config = self.tool_config.get("http", {})
+        self.http = HttpClient(
+            connect_timeout=http_config.get("connect_timeout", 3.05),
+            read_timeout=http_config.get("read_timeout", 15),
+            retries=http_config.get("retries", 2),
+            backoff=http_config.get("backoff", 0.5),
+            pool_size=http_config.get("pool_size", 10),
+            failure_threshold=http_config.get("failure_threshold", 5),
+            reset_timeout=http_config.get("reset_timeout", 30),
+            # 单次请求（含重试）默认不超过工具的截止时间
+            deadline=http_config.get("deadline", self.tool_deadline),
+            verbosity=self.verbosity
+        )
+        # 对话请求在后台的事件循环中执行，可以按会话停止，每个请求有截止时间
+        self.request_deadline = self.tool_config.get("requests", {}).get("deadline", 300)  # 秒
+        self.engine = RequestEngine(deadline=self.request_deadline)
+        self.search_store = SearchResultStore(
+            os.path.join(APP_DIR, SEARCH_CACHE_FILE), ttl=self.tool_config.get("search", {}).get("cache_ttl", 3600)
+        )
+        # 控制台镜像：在后台线程渲染，不占用界面线程
+        console_config = self.tool_config.get("console", {})
+        self.console_sink = ConsoleSink(
+            console,
+            verbosity=console_config.get("verbosity", 1),
+            enabled=console_config.get("enabled", True)
+        )
         print(f"ChatApp init: file_enabled={self.file_enabled}, weather_enabled={self.weather_enabled}, search_enabled={self.search_enabled}")        
         
         # 创建UI组件
@@ -137,6 +3050,23 @@ class ChatApp:
         # 初始化文件列表
         self.refresh_file_list()
         
+        # 加载持久化的知识库索引
+        self._load_knowledge_index()
+        
+    @property
+    def chat_history(self):
+        """当前会话的对话历史"""
+        return self.session.history
+    
+    @chat_history.setter
+    def chat_history(self, history):
+        self.session.history = history
+    
+    @property
+    def transcript(self):
+        """当前会话的聊天记录显示"""
+        return self.session.transcript
+    
     def _load_tool_config(self):
         """加载工具配置（新增搜索配置）"""
         try:
@@ -180,15 +3110,12 @@ class ChatApp:
         return stopwords
     
     def chinese_tokenizer(self, text):
-        """中文分词函数，用于TF-IDF向量化"""
-        # 使用jieba进行分词
-        words = jieba.cut(text)
-        # 过滤停用词和单字
-        filtered_words = [
-            word for word in words 
-            if (word not in self.stopwords) and (len(word) > 1)
-        ]
-        return filtered_words
+        """中文分词函数，用于检索索引；结果经过缓存，调用方不要修改返回的列表"""
+        return self.token_cache.get_or_compute(text, lambda t: self._filter_words(jieba.cut(t)))
+    
+    def _filter_words(self, words):
+        """过滤停用词和单字"""
+        return filter_words(words, self.stopwords)
     
     def _create_ui(self):
         # 创建主Canvas用于滚动
@@ -259,7 +3186,18 @@ class ChatApp:
         menubar.add_cascade(label="工具", menu=tool_menu)
         tool_menu.add_command(label="配置文件读取", command=self.run_file_config_gui)
         tool_menu.add_command(label="配置天气查询", command=self.run_weather_config_gui)
-        tool_menu.add_command(label="配置网络搜索", command=self.run_search_config_gui)        
+        tool_menu.add_command(label="配置网络搜索", command=self.run_search_config_gui)
+        tool_menu.add_command(label="网络请求统计", command=self.view_http_stats)
+        router_menu = Menu(tool_menu, tearoff=0)
+        tool_menu.add_cascade(label="工具路由", menu=router_menu)
+        for value, label in (("heuristic", "关键词规则"), ("function_calling", "模型函数调用"), ("hybrid", "规则预筛选 + 模型决定")):
+            router_menu.add_radiobutton(label=label, value=value, variable=self.tool_router_var)        
+        # 添加"对话"菜单
+        session_menu = Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="对话", menu=session_menu)
+        session_menu.add_command(label="新建对话", command=self.new_session)
+        session_menu.add_command(label="关闭当前对话", command=self.close_session)
+        session_menu.add_command(label="停止生成", command=self.stop_response)
         # 添加"记忆"菜单
         memory_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="记忆管理", menu=memory_menu)
@@ -267,11 +3205,16 @@ class ChatApp:
         memory_menu.add_command(label="保存记忆", command=self.save_memory)
         memory_menu.add_command(label="加载记忆", command=self.load_memory_dialog)
         memory_menu.add_command(label="查看保存的记忆", command=self.view_saved_memories)
+        memory_menu.add_separator()
+        memory_menu.add_checkbutton(label="启用响应缓存", variable=self.response_cache_enabled)
+        memory_menu.add_checkbutton(label="启用语义缓存", variable=self.semantic_cache_enabled)
+        memory_menu.add_command(label="清空响应缓存", command=self.clear_response_cache)
         
         # 添加"知识库"菜单
         knowledge_menu = Menu(menubar, tearoff=0)
         menubar.add_cascade(label="知识库管理", menu=knowledge_menu)
         knowledge_menu.add_command(label="加载知识文档", command=self.load_knowledge_dialog)
+        knowledge_menu.add_command(label="取消导入", command=self.cancel_ingestion)
         knowledge_menu.add_command(label="清空知识库", command=self.clear_knowledge_base)
         knowledge_menu.add_command(label="查看知识库", command=self.view_knowledge_base)
         
@@ -363,6 +3306,22 @@ class ChatApp:
         )
         rag_switch.pack(side=tk.LEFT, padx=10, pady=5)
         
+        # 检索引擎选择
+        ttk.Label(
+            rag_frame, text="检索引擎:",
+            background="#FFFFFF", foreground="#333333",
+            font=(self.font_family[0], 9)
+        ).pack(side=tk.LEFT, padx=(10, 0), pady=5)
+        
+        self.rag_engine_var = tk.StringVar(value=self.tool_config.get("rag", {}).get("engine", "hybrid"))
+        ttk.Combobox(
+            rag_frame,
+            textvariable=self.rag_engine_var,
+            values=["hybrid", "tfidf", "bm25", "dense"],
+            state="readonly",
+            width=7
+        ).pack(side=tk.LEFT, padx=(0, 10), pady=5)
+        
         # RAG上下文长度
         ttk.Label(
             rag_frame, text="上下文片段:",
@@ -380,6 +3339,13 @@ class ChatApp:
         )
         rag_context_combo.pack(side=tk.LEFT, padx=(0, 10), pady=5)
         
+        # 每个文档只取一个片段
+        self.rag_unique_sources = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            rag_frame, text="每个文档仅取一段",
+            variable=self.rag_unique_sources
+        ).pack(side=tk.LEFT, padx=(0, 10), pady=5)
+        
         # 知识库状态
         self.knowledge_status = tk.StringVar(value="知识库: 0 个文档")
         ttk.Label(
@@ -393,7 +3359,7 @@ class ChatApp:
         memory_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
         
         # 左侧：记忆状态标签
-        self.memory_status = tk.StringVar(value=f"记忆状态: 保存了 {len(self.chat_history)//2} 轮对话")
+        self.memory_status = tk.StringVar(value="记忆状态: 保存了 0 轮对话")
         ttk.Label(
             memory_frame, textvariable=self.memory_status,
             background="#FFFFFF", foreground="#333333",
@@ -483,20 +3449,10 @@ class ChatApp:
         )
         self.file_status.pack(side=tk.LEFT, padx=10)
         
-        # 聊天历史显示区域 - 使用更清晰的背景和文本颜色对比
-        self.chat_display = scrolledtext.ScrolledText(
-            main_frame, wrap=tk.WORD, height=15,  # 高度减少以容纳新组件
-            bg="#FFFFFF", fg="#333333", insertbackground="#333333",
-            font=(self.font_family[0], 10)
-        )
-        self.chat_display.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.tag_config("user_header", foreground="#007ACC", font=(self.font_family[0], 10, "bold"))
-        self.chat_display.tag_config("user_message", foreground="#333333")
-        self.chat_display.tag_config("ai_header", foreground="#D83B01", font=(self.font_family[0], 10, "bold"))
-        self.chat_display.tag_config("ai_message", foreground="#333333")
-        self.chat_display.tag_config("tool_message", foreground="#006400", font=(self.font_family[0], 10, "italic"))
-        self.chat_display.tag_config("error_message", foreground="#D13438", font=(self.font_family[0], 10, "bold"))          
+        # 对话标签页：每个标签页是一个独立的会话，可以同时等待各自的回答
+        self.chat_notebook = ttk.Notebook(main_frame)
+        self.chat_notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        self.new_session()
         # RAG上下文显示区域
         rag_context_frame = tk.Frame(main_frame, bg="#FFFFFF", bd=1, relief=tk.SOLID)
         rag_context_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
@@ -536,15 +3492,33 @@ class ChatApp:
             style="Accent.TButton"
         )
         self.send_button.pack(side=tk.LEFT, padx=(0, 10), pady=10)
+        
+        # 停止按钮：取消当前会话的模型输出和工具调用
+        self.stop_button = ttk.Button(
+            input_frame, text="停止", command=self.stop_response, state=tk.DISABLED
+        )
+        self.stop_button.pack(side=tk.LEFT, padx=(0, 10), pady=10)
+        # 按钮创建之后再响应标签页切换
+        self.chat_notebook.bind("<<NotebookTabChanged>>", self._on_session_changed)
 
         # 状态栏
+        status_frame = tk.Frame(main_frame, bg="#333333")
+        status_frame.pack(fill=tk.X, side=tk.BOTTOM, pady=(0, 10))
         self.status_var = tk.StringVar(value="准备就绪")
         self.status_bar = ttk.Label(
-            main_frame, textvariable=self.status_var,
+            status_frame, textvariable=self.status_var,
             background="#333333", foreground="#FFFFFF",
             font=(self.font_family[0], 9)
         )
-        self.status_bar.pack(fill=tk.X, side=tk.BOTTOM, pady=(0, 10))
+        self.status_bar.pack(fill=tk.X, side=tk.LEFT, expand=True)
+        
+        # 响应缓存命中统计
+        self.cache_status = tk.StringVar(value="")
+        ttk.Label(
+            status_frame, textvariable=self.cache_status,
+            background="#333333", foreground="#AAAAAA",
+            font=(self.font_family[0], 9)
+        ).pack(side=tk.RIGHT, padx=10)
         
         # 配置主题样式
         self._setup_styles()
@@ -826,24 +3800,96 @@ class ChatApp:
             messagebox.showerror("输入错误", error)
             return
             
-        if self.is_waiting_response:
-            messagebox.showinfo("提示", "请等待当前响应完成")
+        session = self.session
+        if session.waiting:
+            messagebox.showinfo("提示", "当前对话正在等待响应，可以停止生成或新建对话")
             return
             
         # 清空输入框并记录问题
-        self.current_question = user_input
+        session.question = user_input
         self.input_box.delete("1.0", tk.END)
         
         # 更新UI
         self._append_message("user", user_input)
-        self.chat_history.append({"role": "user", "content": user_input})
-        self.memory_status.set(f"记忆状态: 保存了 {len(self.chat_history)//2} 轮对话")
+        session.history.append({"role": "user", "content": user_input})
+        self._update_memory_status()
         self.status_var.set(f"思考中... [{self.current_model}]")
-        self.send_button.config(state=tk.DISABLED)
-        self.is_waiting_response = True
         
-        # 在新线程中调用API
-        threading.Thread(target=self._process_user_question, daemon=True).start()
+        # 在后台的事件循环中处理，完成、停止或超时后恢复界面状态
+        session.future = self.engine.submit(session.id, self._process_user_question(session))
+        session.future.add_done_callback(
+            lambda future: self.root.after(0, self._on_request_done, session, future)
+        )
+        self._update_session_buttons()
+    
+    def new_session(self):
+        """新建一个对话标签页并切换过去"""
+        frame = tk.Frame(self.chat_notebook, bg="#FFFFFF")
+        chat_display = scrolledtext.ScrolledText(
+            frame, wrap=tk.WORD, height=15,  # 高度减少以容纳新组件
+            bg="#FFFFFF", fg="#333333", insertbackground="#333333",
+            font=(self.font_family[0], 10)
+        )
+        chat_display.pack(fill=tk.BOTH, expand=True)
+        chat_display.config(state=tk.DISABLED)
+        chat_display.tag_config("user_header", foreground="#007ACC", font=(self.font_family[0], 10, "bold"))
+        chat_display.tag_config("user_message", foreground="#333333")
+        chat_display.tag_config("ai_header", foreground="#D83B01", font=(self.font_family[0], 10, "bold"))
+        chat_display.tag_config("ai_message", foreground="#333333")
+        chat_display.tag_config("tool_message", foreground="#006400", font=(self.font_family[0], 10, "italic"))
+        chat_display.tag_config("error_message", foreground="#D13438", font=(self.font_family[0], 10, "bold"))
+        # 聊天记录只渲染可见窗口附近的消息，滚动时按需加载
+        ui_config = self.tool_config.get("ui", {})
+        transcript = TranscriptView(
+            chat_display,
+            window=ui_config.get("transcript_window", 200),
+            page=ui_config.get("transcript_page", 50)
+        )
+        session = ChatSession(transcript, frame)
+        self.sessions.append(session)
+        self.chat_notebook.add(frame, text=session.name)
+        self.session = session
+        self.chat_notebook.select(frame)
+        return session
+    
+    def close_session(self):
+        """关闭当前对话标签页，进行中的请求会被停止"""
+        session = self.session
+        if len(self.sessions) == 1:
+            messagebox.showinfo("提示", "至少需要保留一个对话")
+            return
+        if session.waiting:
+            self.engine.cancel(session.id)
+        self.sessions.remove(session)
+        self.chat_notebook.forget(session.frame)
+        session.frame.destroy()
+        self._on_session_changed()
+    
+    def _on_session_changed(self, event=None):
+        """切换标签页时切换当前会话"""
+        selected = self.chat_notebook.select()
+        for session in self.sessions:
+            if str(session.frame) == selected:
+                self.session = session
+                break
+        self._update_memory_status()
+        self._update_session_buttons()
+    
+    def _update_session_buttons(self):
+        """按当前会话是否在等待响应更新发送和停止按钮"""
+        waiting = self.session.waiting
+        self.send_button.config(state=tk.DISABLED if waiting else tk.NORMAL)
+        self.stop_button.config(state=tk.NORMAL if waiting else tk.DISABLED)
+    
+    def _update_memory_status(self):
+        self.memory_status.set(f"记忆状态: 保存了 {len(self.chat_history)//2} 轮对话")
+    
+    def stop_response(self):
+        """停止当前会话的模型输出和工具调用"""
+        if self.session.waiting:
+            print(f"stop_response: 停止 {self.session.name} 的请求")
+            self.engine.cancel(self.session.id)
+            self.status_var.set("正在停止...")
     def read_file(self, file_path:str):
         """读取文件内容"""
         if not self.file_enabled:
@@ -852,20 +3898,25 @@ class ChatApp:
             
         try:
             # 检查文件是否在允许的目录下
-            allowed_dirs = self.tool_config.get("file", {}).get("allowed_dirs", [os.getcwd()])
-            file_abs_path = os.path.abspath(file_path)
+            # 路径可能由模型给出，按解析符号链接后的真实路径比较，避免用 .. 或链接跳出目录
+            allowed_dirs = self.tool_config.get("file", {}).get("allowed_dirs") or [os.getcwd()]
+            file_abs_path = os.path.normcase(os.path.realpath(file_path))
             is_allowed = False
             
-            """for dir_path in allowed_dirs:
-                dir_abs_path = os.path.abspath(dir_path)
-                if file_abs_path.startswith(dir_abs_path):
-                    is_allowed = True
+            for dir_path in allowed_dirs:
+                dir_abs_path = os.path.normcase(os.path.realpath(dir_path))
+                try:
+                    is_allowed = os.path.commonpath([file_abs_path, dir_abs_path]) == dir_abs_path
+                except ValueError:
+                    # 不同盘符的路径没有公共前缀
+                    is_allowed = False
+                if is_allowed:
                     print("read_file: 文件在允许的目录下")
                     break
                     
             if not is_allowed:
                 print("read_file: 文件不在允许的目录中")
-                return {"tool": "file", "result": "文件不在允许的目录中", "success": False}"""
+                return {"tool": "file", "result": "文件不在允许的目录中", "success": False}
                 
             if not os.path.exists(file_path):
                 print("read_file: 文件不存在")
@@ -895,6 +3946,28 @@ class ChatApp:
             print(f"read_file: 文件读取失败: {str(e)}")
             return {"tool": "file", "result": f"文件读取失败: {str(e)}", "success": False}
     
+    def _normalize_location(self, location):
+        """规范化天气查询的地点：去掉"查询"、"的"、"今天/今日"，中文城市补全"市"
+
+        已规范化的地点再次调用结果不变，可直接用作缓存键。
+        """
+        location = location.strip()
+        location = location.removeprefix("查询")
+        location = location.removesuffix("的")
+        # 移除"今天"/"今日"前缀
+        if location.startswith(("今天", "今日")):
+            location = location[2:]
+
+        # 移除"今天"/"今日"后缀
+        if location.endswith(("今天", "今日")):
+            location = location[:-2]  # 注意这里是-2，删除两个字符
+
+        print(f"修改后 查询地点: {location}")
+        if (not (location.isalpha() and location.isascii())) and "市" not in location: #中文城市缺少"市"
+            print(f"{location}缺少'市'")
+            location += "市"
+        return location
+    
     def get_weather(self, location: str):
         """获取指定地点的天气信息"""
         if not self.weather_enabled:
@@ -905,6 +3978,17 @@ class ChatApp:
             print("get_weather: 未配置天气API密钥")
             return {"tool": "weather", "result": "未配置天气API密钥，请先在工具配置中设置", "success": False}
             
+        # 同一地点在有效期内直接复用，并发的相同查询只请求一次
+        location = self._normalize_location(location)
+        result, status = self.weather_cache.get_or_fetch(
+            location.lower(), lambda: self._fetch_weather(location),
+            should_cache=lambda r: r["success"]
+        )
+        print(f"get_weather: {location} 缓存状态: {status}")
+        return result
+    
+    def _fetch_weather(self, location):
+        """请求OpenWeatherMap获取天气"""
         try:
             # 使用OpenWeatherMap API获取天气信息
             base_url = "http://api.openweathermap.org/data/2.5/weather"
@@ -914,7 +3998,7 @@ class ChatApp:
                 "units": "metric"  # 摄氏温度
             }
             
-            response = requests.get(base_url, params=params)
+            response = self.http.get("weather", base_url, params=params)
             data = response.json()
             
             if response.status_code == 200:
@@ -926,16 +4010,16 @@ class ChatApp:
                 result = (f"当前{location}的天气状况：{weather_desc}。"
                          f"温度：{temperature}°C，湿度：{humidity}%，风速：{wind_speed}m/s。")
                 
-                print(f"get_weather: 天气查询成功: {result}")
+                print(f"_fetch_weather: 天气查询成功: {result}")
                 return {"tool": "weather", "result": result, "success": True}
             else:
                 error_msg = f"天气查询失败，错误码：{response.status_code}，原因：{data.get('message', '未知错误')}"
-                print(f"get_weather: {error_msg}")
+                print(f"_fetch_weather: {error_msg}")
                 return {"tool": "weather", "result": error_msg, "success": False}
                 
         except Exception as e:
-            print(f"get_weather: 天气查询异常: {str(e)}")
-            return {"tool": "weather", "result": f"天气查询异常: {str(e)}", "success": False}
+            print(f"_fetch_weather: 天气查询异常: {e}")
+            return {"tool": "weather", "result": f"天气查询异常: {e}", "success": False}
     
     def web_search(self, query: str, num_results=10):
         """执行网络搜索"""
@@ -947,6 +4031,12 @@ class ChatApp:
             print("web_search: 未配置搜索API密钥")
             return {"tool": "search", "result": "未配置搜索API密钥，请先在工具配置中设置", "success": False}
             
+        # 相同的查询在有效期内直接使用本地缓存
+        cached = self.search_store.get(self.search_provider, query, num_results)
+        if cached is not None:
+            print(f"web_search: 命中搜索缓存，{len(cached)}条结果")
+            return self._format_search_results(cached)
+        
         try:
             # 使用SerpAPI作为搜索后端
             #base_url = "https://serpapi.com/search"
@@ -988,32 +4078,23 @@ class ChatApp:
             full_url = f"{base_url}?{query_string}"
 
             print(f"web_search:实际搜索URL: {full_url}")            
-            response = requests.get(full_url)
+            response = self.http.get("search", full_url)
             data = response.json()
-            print("完整API响应:")
-            print(json.dumps(data, indent=2, ensure_ascii=False))  # 打印完整数据            
+            if self.verbosity >= 2:
+                print("完整API响应:")
+                print(json.dumps(data, indent=2, ensure_ascii=False))  # 打印完整数据
             if response.status_code == 200:
                 if 'error' in data:
                     error_msg = f"搜索失败: {data['error']}"
                     print(f"web_search: {error_msg}")
                     return {"tool": "search", "result": error_msg, "success": False}
                     
-                results = []
-                if 'organic_results' in data:
-                    for item in data['organic_results'][:num_results]:
-                        title = item.get('title', '')
-                        link = item.get('link', '')
-                        snippet = item.get('snippet', '')
-                        results.append(f"标题: {title}\n链接: {link}\n摘要: {snippet}\n\n")
-                
-                if results:
-                    result_text = "搜索结果:\n\n" + "\n".join(results)
-                    print(f"web_search: 搜索成功，返回{len(results)}条结果")
-                    print(f"web_search: \n{result_text}")
-                    return {"tool": "search", "result": result_text, "success": True}
-                else:
-                    print("web_search: 未找到搜索结果")
-                    return {"tool": "search", "result": "未找到相关搜索结果", "success": False}
+                # 只保存标题、链接和摘要，按链接去重
+                items = self.search_store.put(
+                    self.search_provider, query, num_results, data.get('organic_results', [])[:num_results]
+                )
+                print(f"web_search: 搜索成功，返回{len(items)}条结果")
+                return self._format_search_results(items)
             else:
                 error_msg = f"搜索请求失败，错误码：{response.status_code}"
                 print(f"web_search: {error_msg}")
@@ -1023,187 +4104,281 @@ class ChatApp:
             print(f"web_search: 搜索异常: {str(e)}")
             return {"tool": "search", "result": f"搜索异常: {str(e)}", "success": False}
     
+    def _format_search_results(self, items):
+        """把搜索结果列表整理成工具结果"""
+        if not items:
+            print("web_search: 未找到搜索结果")
+            return {"tool": "search", "result": "未找到相关搜索结果", "success": False}
+        results = [f"标题: {item['title']}\n链接: {item['link']}\n摘要: {item['snippet']}\n\n" for item in items]
+        result_text = "搜索结果:\n\n" + "\n".join(results)
+        if self.verbosity >= 1:
+            print(f"web_search: \n{result_text}")
+        return {"tool": "search", "result": result_text, "success": True}
+    
     def should_call_file_tool(self, text):
         """判断是否需要调用文件读取工具"""
         if not self.file_enabled:
             print("should_call_file_tool: 文件读取已禁用")
             return False
-            
-        # 检查是否需要文件读取
-        file_keywords = ["文件", "读取", "打开", "内容", "路径", "目录", ".txt", ".doc", ".pdf", ".docx"]
-        if any(keyword in text for keyword in file_keywords):
-            print("should_call_file_tool: 需要文件读取")
-            match = re.search(r'([\w\s/\\().+?\-]+?\.(txt|docx|pdf|md|doc))', text, re.IGNORECASE)
-            print(f"should_call_file_tool: 结果：{'success' if match is not None else 'failed'} match:", match)
-            return match is not None
-                
-        return False
+        return "file" in self.tool_router.route(text, {"file"})
     
     def should_call_weather_tool(self, text):
         """判断是否需要调用天气查询工具"""
         if not self.weather_enabled:
             print("should_call_weather_tool: 天气查询已禁用")
             return False
-            
-        # 检查是否需要天气查询
-        weather_keywords = ["天气", "温度", "气象", "预报", "晴", "雨", "风", "多云", "湿度", "气候", "weather", "temperature", "weather forecast", "sunny", "rain", "wind", "cloudy", "humidity"]
-        location_pattern = location_pattern = r'([\u4e00-\u9fa5]{2,5}(市|县|区|镇|村|乡)?|[A-Za-z]+)\s*(天气|气候|weather|forecast)' 
-        
-        if any(keyword in text for keyword in weather_keywords):
-            print("should_call_weather_tool: 需要天气查询")
-            match = re.search(location_pattern, text)
-            print(f"should_call_weather_tool: 结果：{'success' if match is not None else 'failed'} match:", match)
-            return match is not None
-                
-        return False
-    
-
+        return "weather" in self.tool_router.route(text, {"weather"})
     
     def should_call_search_tool(self, text):
         """判断是否需要调用网络搜索工具"""
         if not self.search_enabled:
             print("should_call_search_tool: 网络搜索已禁用")
             return False
-            
-        # 检查是否需要网络搜索
-        search_keywords = ["搜索", "查询", "查找", "最新", "新闻", "资讯", "信息", "知识", "了解", "什么是", "是谁", "哪里", "何时", "为什么", "怎么样", "告诉我", "是啥"]
-        
-        # 如果问题中包含这些关键词，并且不是明确的文件或天气查询
-        if any(keyword in text for keyword in search_keywords):
-            #if not self.should_call_file_tool(text) and not self.should_call_weather_tool(text):
-            print("should_call_search_tool: 需要网络搜索")
-            return True
-                
-        # 如果问题是一个简单疑问句，也触发搜索
-        question_patterns = [
-            r'^[\u4e00-\u9fa5a-zA-Z0-9\s]*[?？]$',  # 以问号结尾
-            r'^什么是[\u4e00-\u9fa5a-zA-Z0-9\s]+$',  # 以"什么是"开头
-            r'^谁是[\u4e00-\u9fa5a-zA-Z0-9\s]+$',    # 以"谁是"开头
-            r'^为什么[\u4e00-\u9fa5a-zA-Z0-9\s]+$',  # 以"为什么"开头
-            r'^如何[\u4e00-\u9fa5a-zA-Z0-9\s]+$',    # 以"如何"开头
-            r'^怎样[\u4e00-\u9fa5a-zA-Z0-9\s]+$',    # 以"怎样"开头
-            r'^哪里[\u4e00-\u9fa5a-zA-Z0-9\s]+$',    # 以"哪里"开头
-            r'^何时[\u4e00-\u9fa5a-zA-Z0-9\s]+$',    # 以"何时"开头
+        return "search" in self.tool_router.route(text, {"search"})
+    
+    def _tool_switches(self):
+        """各工具是否启用"""
+        return {"search": self.search_enabled, "weather": self.weather_enabled, "file": self.file_enabled}
+    
+    async def _answer_with_function_calling(self, session, offered):
+        """把候选工具作为函数定义随第一次请求流式发给模型，由模型决定是否调用工具
+
+        模型直接回答时，这次流式输出就是最终回答，不再请求第二次；模型请求
+        调用工具时，执行工具后把 assistant(tool_calls) 和对应 tool_call_id 的
+        tool 消息追加到对话中，再流式请求一次得到回答。
+        返回 (回答, RAG上下文, 工具结果列表)。请求在没有任何输出前失败（如接口
+        不支持函数调用）时回答为None，由调用方改用关键词规则：第一次请求失败时
+        工具结果为None，第二次请求失败时为已执行的工具结果，都不需要重新检索。
+        """
+        definitions = [
+            definition for tool, _, definition in TOOL_DEFINITIONS.values() if tool in offered
         ]
+        # RAG上下文在第一次请求前检索，模型直接回答时也能用上
+        _, rag_context = await self._run_tools_concurrently(session, [])
+        messages, rag_context = self._build_messages(session, session.question, rag_context=rag_context)
+        # 其他会话可能同时组装消息，先取出本次的token用量
+        used = self.last_context_usage.get("total", 0)
+        accumulator = ResponseAccumulator(TokenCounter(self.current_model))
+        try:
+            start = time.perf_counter()
+            await self._stream_response(
+                session, messages, lazy_header=True, accumulator=accumulator,
+                tools=definitions, tool_choice="auto"
+            )
+        except OpenAIError as e:
+            if accumulator.content or accumulator.tool_calls:
+                raise  # 已经有输出，不能再改用关键词规则重新回答
+            print(f"_answer_with_function_calling: 函数调用失败，使用关键词规则: {e}")
+            return None, rag_context, None
+        tool_calls = accumulator.tool_calls
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"_answer_with_function_calling: 模型选择了 {[c['name'] for c in tool_calls] or '不调用工具'}，耗时 {elapsed:.0f}ms")
+        if not tool_calls:
+            return accumulator.text(), rag_context, []
+        
+        handlers = {"search": self.web_search, "weather": self.get_weather, "file": self.read_file}
+        calls = []  # [(工具名, 调用函数)]
+        call_ids = []  # 与 calls 对应的 tool_call_id
+        replies = {}  # tool_call_id -> 无法执行时直接回复给模型的内容
+        for index, tool_call in enumerate(tool_calls):
+            tool_call["id"] = tool_call["id"] or f"call_{index}"
+            name = tool_call["name"]
+            if name not in TOOL_DEFINITIONS:
+                print(f"_answer_with_function_calling: 忽略未知的工具 {name}")
+                replies[tool_call["id"]] = f"未知的工具: {name}"
+                continue
+            tool, argument, _ = TOOL_DEFINITIONS[name]
+            try:
+                value = json.loads(tool_call["arguments"] or "{}").get(argument, "")
+            except (json.JSONDecodeError, AttributeError):
+                value = ""
+            if not value:
+                print(f"_answer_with_function_calling: {name} 缺少参数 {argument}，跳过")
+                replies[tool_call["id"]] = f"缺少参数 {argument}"
+                continue
+            calls.append((tool, lambda handler=handlers[tool], value=value: handler(value)))
+            call_ids.append(tool_call["id"])
+        
+        tool_results, _ = await self._run_tools_concurrently(session, calls, retrieve=False)
+        self._show_tool_results(session, tool_results)
+        
+        # 工具结果和已组装的消息一起受 token 预算约束
+        texts = self._context_packer().fit_tool_results(
+            [str(tool_result["result"]) for tool_result in tool_results], used=used
+        )
+        for call_id, tool_result, text in zip(call_ids, tool_results, texts):
+            replies[call_id] = ("" if tool_result["success"] else "（调用失败）") + text
+        
+        messages = messages + [{
+            "role": "assistant",
+            "content": accumulator.text() or None,
+            "tool_calls": [{
+                "id": tool_call["id"],
+                "type": "function",
+                "function": {"name": tool_call["name"], "arguments": tool_call["arguments"] or "{}"}
+            } for tool_call in tool_calls]
+        }] + [
+            {"role": "tool", "tool_call_id": tool_call["id"], "content": replies[tool_call["id"]]}
+            for tool_call in tool_calls
+        ]
+        accumulator = ResponseAccumulator(TokenCounter(self.current_model))
+        try:
+            await self._stream_response(
+                session, messages, lazy_header=True, accumulator=accumulator,
+                tools=definitions, tool_choice="none"
+            )
+        except OpenAIError as e:
+            if accumulator.content:
+                raise
+            print(f"_answer_with_function_calling: 回答请求失败，用已有的工具结果按关键词规则回答: {e}")
+            return None, rag_context, tool_results
+        return accumulator.text(), rag_context, tool_results
+    
+    def _plan_tool_calls(self, question):
+        """扫描一遍问题得到需要执行的工具及参数，返回 [(工具名, 调用函数)]"""
+        enabled = {tool for tool, on in self._tool_switches().items() if on}
+        routes = self.tool_router.route(question, enabled)
+        
+        calls = []
+        if "search" in routes:
+            search_query = routes["search"]["query"]
+            print(f"_plan_tool_calls: 搜索关键词: {search_query}")
+            calls.append(("search", lambda: self.web_search(search_query)))
+        
+        if "weather" in routes:
+            location = self._normalize_location(routes["weather"]["location"])
+            print(f"_plan_tool_calls: 地点: {location}")
+            calls.append(("weather", lambda: self.get_weather(location)))
+        
+        if "file" in routes:
+            if "error" in routes["file"]:
+                error_msg = routes["file"]["error"]
+                calls.append(("file", lambda: {"tool": "file", "result": error_msg, "success": False}))
+            else:
+                file_path = routes["file"]["file_path"]
+                print(f"_plan_tool_calls: 文件路径: {file_path}")
+                calls.append(("file", lambda: self.read_file(file_path)))
         
-        for pattern in question_patterns:
-            if re.match(pattern, text):
-                print("should_call_search_tool: 简单疑问句，需要网络搜索")
-                return True
-                
-        return False
+        print(f"_plan_tool_calls: 需要调用的工具: {[tool for tool, _ in calls] or '无'}")
+        return calls
     
-    def _process_user_question(self):
-        """处理用户问题，包括文件读取、天气查询和网络搜索工具调用"""
+    async def _run_tools_concurrently(self, session, calls, retrieve=True):
+        """在线程池中并行执行所有工具，同时检索RAG上下文（retrieve 为 False 时不检索）
+
+        所有任务共用一个截止时间（tools.deadline 秒），超时的工具按失败处理，
+        超时的RAG检索按无上下文处理。请求被停止时取消还没开始的任务。
+        返回 (工具结果列表, RAG上下文)。
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        futures = [(tool, loop.run_in_executor(self.tool_executor, func)) for tool, func in calls]
+        rag_future = None
+        if retrieve and self.rag_enabled.get() and self.knowledge_base:
+            rag_future = loop.run_in_executor(self.tool_executor, functools.partial(
+                self.retrieve_context,
+                session.question,
+                top_k=self.rag_context_var.get(),
+                unique_sources=self.rag_unique_sources.get()
+            ))
+        
+        pending = [future for _, future in futures] + ([rag_future] if rag_future else [])
         try:
-            # 判断是否需要调用工具
-            tool_used = "none"
-            tool_result = {"tool": "none", "result": "", "success": True}
-            rag_context = ""
-            # 优先级：搜索 > 天气 > 文件
-            if self.should_call_search_tool(self.current_question):
-                # 提取搜索关键词
-                print("_process_user_question: 提取搜索关键词")
-                # 移除可能的搜索指令前缀
-                search_query = self.current_question
-                prefixes = ["搜索", "查询", "查找", "告诉我", "了解", "什么是", "是谁", "哪里", "何时", "为什么", "怎么样"]
-                for prefix in prefixes:
-                    if search_query.startswith(prefix):
-                        search_query = search_query[len(prefix):].strip()
-                        break
-                
-                print(f"_process_user_question: 搜索关键词: {search_query}")
-                tool_result = self.web_search(search_query)
-                tool_used = "search"
-                
-                # 显示工具调用结果
-                self.root.after(0, self._append_message, "tool", f"[网络搜索] {tool_result['result']}")
-                
-                # 如果工具调用失败，告知用户并继续使用LLM
-                if not tool_result["success"]:
-                    print("_process_user_question: 网络搜索失败，使用LLM继续处理问题")  
-                    llm_response, rag_context = self._get_llm_response(f"网络搜索失败: {tool_result['result']}，请直接回答: {self.current_question}")
-                else:
-                    # 工具调用成功，使用工具结果生成最终回答
-                    print("_process_user_question: 网络搜索成功，生成最终回答")
-                    llm_response, rag_context = self._get_llm_response(f"根据网络搜索结果: {tool_result['result']}，回答用户问题: {self.current_question}")
-                    
-            elif self.should_call_weather_tool(self.current_question):
-                # 提取地点
-                print("_process_user_question: 提取地点")
-                #location_pattern = r'([\u4e00-\u9fa5]{2,5}(市|县|区|镇|村|乡)?)'
-                #location_pattern = r'([\u4e00-\u9fa5]{2,5}(市|县|区|镇|村|乡)?)\s*(天气|气候)'
-                location_pattern = r'([\u4e00-\u9fa5]{2,8}(市|县|区|镇|村|乡)?|[A-Za-z]+)\s*(天气|气候|weather|forecast)'
-                match = re.search(location_pattern, self.current_question)
-                if match:
-                    print(f"完整匹配: {match.group(0)}")   # 输出完整匹配内容
-                    print(f"捕获组1: {match.group(1)}")  # 输出第一个捕获组
-                location = match.group(1) if match else "北京市"  # 默认北京
-                if location.startswith("查询"):
-                    location = location[2:]
-                if location.endswith("的"):
-                    location = location[:-1]
-                # 移除"今天"/"今日"前缀
-                if location.startswith(("今天", "今日")):
-                    location = location[2:]
-
-                # 移除"今天"/"今日"后缀
-                if location.endswith(("今天", "今日")):
-                    location = location[:-2]  # 注意这里是-2，删除两个字符
-
-                print(f"修改后 查询地点: {location}")
-                if (not (location.isalpha() and location.isascii())) and "市" not in location: #中文城市缺少"市"
-                    print(f"{location}缺少'市'")
-                    location += "市"
-                print(f"_process_user_question: 地点: {location}")
-                tool_result = self.get_weather(location)
-                tool_used = "weather"
-                
-                # 显示工具调用结果
-                self.root.after(0, self._append_message, "tool", f"[天气查询] {tool_result['result']}")
-                
-                # 如果工具调用失败，告知用户并继续使用LLM
-                if not tool_result["success"]:
-                    print("_process_user_question: 天气查询失败，使用LLM继续处理问题")  
-                    llm_response, rag_context = self._get_llm_response(f"天气查询失败: {tool_result['result']}，请直接回答: {self.current_question}")
-                else:
-                    # 工具调用成功，使用工具结果生成最终回答
-                    print("_process_user_question: 天气查询成功，生成最终回答")
-                    llm_response, rag_context = self._get_llm_response(f"根据当前天气信息: {tool_result['result']}，回答用户问题: {self.current_question}")
-                    
-            elif self.should_call_file_tool(self.current_question):
-                # 提取文件路径
-                print("_process_user_question: 提取文件路径")
-                match = re.search(r'([\w\s/\\().+?:\-]+?\.(txt|docx|pdf|md|doc))', self.current_question, re.IGNORECASE)
-                file_path = match.group(1) if match else ""
-                
-                if file_path:
-                    idx = file_path.find(":")
-                    if idx == -1 or idx == 0:
-                        raise ValueError("文件路径格式错误")
-                    file_path = file_path[idx-1:]
-                    print(f"_process_user_question: 文件路径: {file_path}")
-                    tool_result = self.read_file(file_path)
-                    tool_used = "file"
-                    
-                    # 显示工具调用结果
-                    self.root.after(0, self._append_message, "tool", f"[文件读取] {tool_result['result']}")
-                    
-                    # 如果工具调用失败，告知用户并继续使用LLM
-                    if not tool_result["success"]:
-                        print("_process_user_question: 文件读取失败，使用LLM继续处理问题")  
-                        llm_response, rag_context = self._get_llm_response(f"文件读取失败: {tool_result['result']}，请直接回答: {self.current_question}")
-                    else:
-                        # 工具调用成功，使用工具结果生成最终回答
-                        print("_process_user_question: 文件读取成功，生成最终回答")
-                        llm_response, rag_context = self._get_llm_response(f"根据文件内容: {tool_result['result']}，回答用户问题: {self.current_question}")
+            if pending:
+                await asyncio.wait(pending, timeout=self.tool_deadline)
+        except asyncio.CancelledError:
+            for future in pending:
+                future.cancel()
+            raise
+        
+        results = []
+        for tool, future in futures:
+            label = TOOL_LABELS[tool][0]
+            if not future.done():
+                future.cancel()
+                print(f"_run_tools_concurrently: {label}超时")
+                results.append({"tool": tool, "result": f"{label}超时（超过{self.tool_deadline}秒）", "success": False})
+                continue
+            try:
+                results.append(future.result())
+            except (OSError, ValueError, KeyError, RuntimeError, CircuitOpenError) as e:
+                print(f"_run_tools_concurrently: {label}异常: {e}")
+                results.append({"tool": tool, "result": f"{label}异常: {e}", "success": False})
+        
+        rag_context = ""
+        if rag_future is not None:
+            if not rag_future.done():
+                print("_run_tools_concurrently: RAG检索超时，不使用知识库上下文")
+            else:
+                try:
+                    rag_context = rag_future.result()
+                except (OSError, ValueError, RuntimeError) as e:
+                    print(f"_run_tools_concurrently: RAG检索异常: {e}")
+        
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"_run_tools_concurrently: {len(calls)} 个工具和RAG检索耗时 {elapsed:.0f}ms")
+        return results, rag_context
+    
+    def _show_tool_results(self, session, tool_results):
+        """在会话的聊天记录中显示工具调用结果"""
+        for tool_result in tool_results:
+            label = TOOL_LABELS[tool_result["tool"]][0]
+            self.root.after(0, self._append_message, "tool", f"[{label}] {tool_result['result']}", False, session)
+    
+    def _compose_tool_prompt(self, question, tool_results):
+        """把工具结果合并成提示词，返回 (带 {tool_result} 占位符的提示词, 工具结果文本)"""
+        if not tool_results:
+            return question, None
+        if len(tool_results) == 1:
+            tool_result = tool_results[0]
+            _, success_prefix, failure_prefix = TOOL_LABELS[tool_result["tool"]]
+            if tool_result["success"]:
+                return f"{success_prefix}: {{tool_result}}，回答用户问题: {question}", tool_result["result"]
+            return f"{failure_prefix}: {{tool_result}}，请直接回答: {question}", tool_result["result"]
+        
+        tool_text = "\n\n".join(
+            f"[{TOOL_LABELS[r['tool']][0]}{'' if r['success'] else '（失败）'}] {r['result']}"
+            for r in tool_results
+        )
+        return f"根据以下工具调用结果（失败的结果请忽略）:\n{{tool_result}}\n回答用户问题: {question}", tool_text
+    
+    async def _process_user_question(self, session):
+        """处理用户问题，包括文件读取、天气查询和网络搜索工具调用
+
+        在请求引擎的事件循环中运行；停止或超时时任务被取消，由 _on_request_done 提示。
+        """
+        try:
+            # 判断需要调用的工具，全部并行执行，同时进行RAG检索
+            calls = self._plan_tool_calls(session.question)
+            router = self.tool_router_var.get()
+            llm_response, rag_context, tool_results = None, None, None
+            if router != "heuristic":
+                # hybrid 模式下关键词规则作为预筛选：没有命中任何工具时不再询问模型
+                if router == "hybrid":
+                    offered = [tool for tool, _ in calls]
                 else:
-                    print("_process_user_question: 文件读取失败，使用原始问题生成最终回答")
-                    llm_response, rag_context = self._get_llm_response(self.current_question)
+                    offered = [tool for tool, enabled in self._tool_switches().items() if enabled]
+                if offered:
+                    llm_response, rag_context, tool_results = await self._answer_with_function_calling(session, offered)
+            
+            if llm_response is None:
+                # 函数调用失败时沿用已经检索的上下文和已经执行的工具结果
+                if tool_results is None:
+                    tool_results, retrieved = await self._run_tools_concurrently(
+                        session, calls, retrieve=rag_context is None
+                    )
+                    if rag_context is None:
+                        rag_context = retrieved
+                    self._show_tool_results(session, tool_results)
+                # 合并所有工具结果生成最终回答
+                prompt, tool_text = self._compose_tool_prompt(session.question, tool_results)
+                llm_response, rag_context = await self._get_llm_response(session, prompt, tool_text, rag_context)
+            
+            if not tool_results:
+                tool_used = "none"
+            elif len(tool_results) == 1:
+                tool_used = tool_results[0]["tool"]
             else:
-                # 不需要调用工具，直接使用LLM
-                print("_process_user_question: 不需要调用工具,直接使用LLM")
-                llm_response, rag_context = self._get_llm_response(self.current_question)
+                tool_used = "multiple"
                 
             # 格式化输出
             output_data = self.format_output(llm_response, rag_context = rag_context,tool_used=tool_used,)
@@ -1211,11 +4386,11 @@ class ChatApp:
             # 校验输出
             if not self.validate_output(output_data):
                 print("_process_user_question: 输出格式校验失败")
-                self.root.after(0, self._append_message, "error", "输出格式校验失败")
+                self.root.after(0, self._append_message, "error", "输出格式校验失败", False, session)
                 return
                 
             # 更新聊天历史
-            self.chat_history.append({
+            session.history.append({
                 "role": "assistant", 
                 "content": output_data["content"],
                 "model": output_data["model"],
@@ -1224,190 +4399,256 @@ class ChatApp:
                 "tool_used": output_data["tool_used"]
             })
             # 限制历史记录长度
-            if len(self.chat_history) > self.max_history_length * 2:
+            if len(session.history) > self.max_history_length * 2:
                 # 保留最近的对话
-                self.chat_history = self.chat_history[-self.max_history_length*2:]
-                
-            self.root.after(0, lambda: self.memory_status.set(
-                f"记忆状态: 保存了 {len(self.chat_history)//2} 轮对话"))
+                session.history = session.history[-self.max_history_length*2:]
             
         except Exception as e:
             print(f"_process_user_question: 处理用户问题时发生错误: {str(e)}")
             error_msg = f"处理用户问题时发生错误: {str(e)}"
             error_output = self.format_output(error_msg, status="error", tool_used="none")
             self.validate_output(error_output)
-            self.root.after(0, self._append_message, "error", error_msg)
-            
-        finally:
-            # 恢复UI状态
-            self.root.after(0, self._update_ui_after_response)
-    def _get_llm_response(self, prompt):
-        """获取LLM响应"""
+            self.root.after(0, self._append_message, "error", error_msg, False, session)
+    
+    def _on_request_done(self, session, future):
+        """请求结束（完成、停止或超时）后在界面线程中恢复状态"""
+        if future.cancelled():
+            print(f"_on_request_done: {session.name} 的请求已停止")
+            self._append_message("error", "[已停止生成]", session=session)
+        elif isinstance(future.exception(), TimeoutError):
+            print(f"_on_request_done: {session.name} 的请求超时")
+            self._append_message("error", f"请求超过 {self.request_deadline} 秒，已取消", session=session)
+        elif future.exception() is not None:
+            self._append_message("error", f"发生错误: {future.exception()}", session=session)
+        self._update_ui_after_response(session)
+    
+    async def _get_llm_response(self, session, prompt, tool_result=None, rag_context=None):
+        """获取LLM响应
+
+        prompt 中的 "{tool_result}" 占位符替换为工具结果，工具结果过长时按预算截断。
+        rag_context 为已并行检索好的上下文，为None时在这里检索。
+        """
         try:
-            messages = self._prepare_chat_history()
-            # 如果启用了RAG且有知识库，检索相关上下文
-            rag_context = ""
-            if self.rag_enabled.get() and self.knowledge_base:
-                rag_context = self.retrieve_context(self.current_question, top_k=self.rag_context_var.get())
-                
-                # 更新RAG上下文显示
-                self.root.after(0, self._update_rag_display, rag_context)
-                # 将上下文添加到消息中
-                if rag_context:
-                    messages.insert(0, {
-                        "role": "system",
-                        "content": f"根据以下上下文回答问题:\n{rag_context}\n\n如果上下文没有相关信息，请根据你的知识回答。"
-                    })
-            
-            # 特殊处理多模态模型
-            if self.current_model == "Qwen/QVQ-72B-Preview" and self.current_image:
-                # 构造多模态消息
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{self.current_image}"
-                            }
-                        }
-                    ]
-                })
-            else:
-                # 普通文本消息
-                messages.append({
-                    "role": "user",
-                    "content": prompt
-                })
+            messages, rag_context = self._build_messages(session, prompt, tool_result, rag_context)
             # 创建API请求
             print("_get_llm_response触发:正在获取LLM响应...")
-            response = self.client.chat.completions.create(
-                model=self.current_model,
-                messages=messages,
-                stream=True,  # 启用流式响应
-                temperature=self.current_temperature
-            )
-
-            # 开始流式显示响应
-            self.root.after(0, self._append_message, "assistant", "")            
-            full_response = ""
-            for chunk in response:
-                if hasattr(chunk, "choices") and chunk.choices:
-                    delta = chunk.choices[0].delta
-                    content = getattr(delta, "content", "")
-                    if content:
-                        full_response += content
-                        # 实时更新UI
-                        self.root.after(0, self._append_message, "assistant", content, True)
-            print(f"_get_llm_response: 响应结果full_response: {full_response}")
+            full_response = await self._stream_chat_completion(session, messages, rag_context, tool_result)
+            if self.verbosity >= 2:
+                print(f"_get_llm_response: 响应结果full_response: {full_response}")
             return full_response, rag_context
         except Exception as e:
             print(f"_get_llm_response: 获 {str(e)}")
             return f"获取AI响应失败: {str(e)}" , ""       
-        
-    def _get_ai_response(self):
-        """获取AI响应并流式显示"""
-        try:
-            # 创建API请求 - 使用完整的对话历史
-            messages = self._prepare_chat_history()
-            
-            # 如果启用了RAG且有知识库，检索相关上下文
-            rag_context = ""
-            if self.rag_enabled.get() and self.knowledge_base:
-                rag_context = self.retrieve_context(self.current_question, top_k=self.rag_context_var.get())
-                
-                # 更新RAG上下文显示
-                self.root.after(0, self._update_rag_display, rag_context)
-                # 将上下文添加到消息中
-                if rag_context:
-                    messages.insert(0, {
-                        "role": "system",
-                        "content": f"根据以下上下文回答问题:\n{rag_context}\n\n如果上下文没有相关信息，请根据你的知识回答。"
-                    })
-            
-            # 特殊处理多模态模型
-            if self.current_model == "Qwen/QVQ-72B-Preview" and self.current_image:
-                # 构造多模态消息
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": self.current_question},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{self.current_image}"
-                            }
-                        }
-                    ]
-                })
-            else:
-                # 普通文本消息
-                messages.append({
-                    "role": "user",
-                    "content": self.current_question
-                })
             
-            # 调用API
-            response = self.client.chat.completions.create(
+    async def _stream_chat_completion(self, session, messages, rag_context="", tool_result=None):
+        """流式调用模型并实时显示，返回完整响应
+
+        启用响应缓存时，相同的请求直接按界面速度重放之前的流式输出；
+        启用语义缓存时，意思相近且工具结果、RAG上下文和对话历史相同的问题复用之前的回答。
+        """
+        key = None
+        if self.response_cache_enabled.get():
+            key = ResponseCache.make_key(self.current_model, self.current_temperature, messages, rag_context)
+            cached = self.response_cache.get(key)
+            self.root.after(0, self._update_cache_status)
+            if cached is not None:
+                print("_stream_chat_completion: 命中响应缓存，重放输出")
+                return await self._replay_cached_stream(session, cached)
+        
+        semantic_key = None
+        if self.semantic_cache_enabled.get():
+            # 上下文键包含问题之前的全部消息（系统提示、RAG上下文和对话历史），
+            # 追问只会命中同一段对话中的回答
+            context_key = ResponseCache.make_key(
+                self.current_model, self.current_temperature, messages[:-1], rag_context
+            )
+            semantic_key = hashlib.sha1(json.dumps(
+                [context_key, tool_result or ""], ensure_ascii=False
+            ).encode("utf-8")).hexdigest()
+            try:
+                # 向量化可能请求远程接口，放到线程池中避免阻塞其他会话
+                question_vector = await asyncio.get_running_loop().run_in_executor(
+                    self.tool_executor, self._question_vector, session.question
+                )
+            except EmbeddingUnavailableError as e:
+                # 嵌入接口不可用时本次不查也不写语义缓存
+                print(f"_stream_chat_completion: 问题向量化失败，跳过语义缓存: {e}")
+                semantic_key = None
+        if semantic_key is not None:
+            cached, similarity = self.semantic_cache.lookup(
+                question_vector, semantic_key, session.question, self.embedder.name
+            )
+            self.root.after(0, self._update_cache_status)
+            if cached is not None:
+                print(f"_stream_chat_completion: 命中语义缓存，相似度 {similarity:.3f}")
+                if key is not None:
+                    self.response_cache.put(key, cached)
+                return await self._replay_cached_stream(session, cached)
+        
+        accumulator = await self._stream_response(session, messages)
+        
+        # 缓存直接保存累加器中的片段列表
+        chunks = accumulator.content
+        if key is not None and chunks:
+            self.response_cache.put(key, chunks)
+        if semantic_key is not None and chunks:
+            self.semantic_cache.add(
+                question_vector, session.question, chunks, semantic_key, self.embedder.name
+            )
+        return accumulator.text()
+    
+    async def _stream_response(self, session, messages, lazy_header=False, accumulator=None, **request):
+        """流式调用模型并按帧显示到会话的聊天记录中，返回 ResponseAccumulator
+
+        request 为额外的请求参数（如 tools）；lazy_header 为 True 时等到第一段
+        正文到达才显示回答标题，模型只返回函数调用时不留下空的回答。
+        """
+        renderer = self._begin_stream(session, lazy_header, accumulator)
+        try:
+            # 正文和推理过程分开累加，渲染器按帧读取新增的正文片段
+            await stream_chat_completion(
+                self.async_client, renderer.accumulator,
                 model=self.current_model,
                 messages=messages,
-                stream=True,
-                temperature=self.current_temperature
+                temperature=self.current_temperature,
+                **request
             )
-            
-            # 开始流式显示响应
-            self.root.after(0, self._append_message, "assistant", "")
-            full_response = ""
-            
-            for chunk in response:
-                if hasattr(chunk, "choices") and chunk.choices:
-                    delta = chunk.choices[0].delta
-                    content = getattr(delta, "content", None)
-                    if content:
-                        full_response += content
-                        self.root.after(0, self._append_message, "assistant", content, True)
-            
-            # 格式化最终输出并校验
-            output_data = self.format_output(full_response, rag_context=rag_context)
-            if not self.validate_output(output_data):
-                self.root.after(0, self._append_message, "error", "输出格式校验失败")
-                return
-                
-            # 更新聊天历史
-            self.chat_history.append({
-                "role": "assistant", 
-                "content": full_response,
-                "model": self.current_model,
-                "timestamp": output_data["timestamp"],
-                "rag_context": rag_context,
-                "tool_used": output_data.get("tool_used", "")
-            })
-            
-            # 限制历史记录长度
-            if len(self.chat_history) > self.max_history_length * 2:
-                # 保留最近的对话
-                self.chat_history = self.chat_history[-self.max_history_length*2:]
-                
-            self.root.after(0, lambda: self.memory_status.set(
-                f"记忆状态: 保存了 {len(self.chat_history)//2} 轮对话"))
-            
-        except Exception as e:
-            error_msg = f"发生错误: {str(e)}"
-            error_output = self.format_output(error_msg, status="error")
-            self.validate_output(error_output)  # 校验错误输出
-            self.root.after(0, self._append_message, "error", error_msg)
-            
         finally:
-            # 恢复UI状态
-            self.root.after(0, self._update_ui_after_response)
-            
-    def _prepare_chat_history(self):
+            self._end_stream(session, renderer)
+        return renderer.accumulator
+    
+    async def _replay_cached_stream(self, session, chunks):
+        """按界面速度重放缓存的流式输出"""
+        renderer = self._begin_stream(session)
+        try:
+            for content in chunks:
+                await asyncio.sleep(self.cache_replay_interval)
+                renderer.push(content)
+        finally:
+            self._end_stream(session, renderer)
+        return renderer.accumulator.text()
+    
+    def _begin_stream(self, session, lazy_header=False, accumulator=None):
+        """在会话的聊天记录中显示回答的标题并创建本次响应的渲染器
+
+        lazy_header 为 True 时等到第一段正文到达才显示回答标题；
+        accumulator 为调用方提供的累加器（出错时调用方仍能读到已有输出）。
+        """
+        shown = [not lazy_header]
+        if shown[0]:
+            self.root.after(0, self._append_message, "assistant", "", False, session)
+        
+        def flush(text):
+            # 延迟显示标题时，第一段正文连同标题一起写入
+            self._append_message("assistant", text, shown[0], session)
+            shown[0] = True
+        
+        renderer = StreamRenderer(
+            self.root,
+            flush,
+            interval_ms=self.stream_frame_ms,
+            counter=TokenCounter(self.current_model),
+            on_finish=lambda: self.console_sink.emit("stream", "\n"),
+            accumulator=accumulator
+        )
+        renderer.start()
+        return renderer
+    
+    def _end_stream(self, session, renderer):
+        """结束渲染并记录首字延迟和输出速度"""
+        stats = renderer.finish()
+        session.last_stream_stats = stats
+        self.stream_stats_log.append(stats)
+        if self.verbosity >= 1 and stats["ttft"] is not None:
+            print(f"_end_stream: 首字延迟 {stats['ttft']:.2f}s，正文 {stats['chars']} 字符，"
+                  f"推理 {stats['reasoning_chars']} 字符，约 {stats['tokens']} token，"
+                  f"{stats['tokens_per_second']:.1f} token/s，总耗时 {stats['total']:.2f}s")
+    
+    def _question_vector(self, question):
+        """语义缓存使用的问题向量：去掉停用词和口语化词后再向量化"""
+        text = question.lower()
+        for word in SEMANTIC_FILLER_WORDS:
+            text = text.replace(word, "")
+        return self._embed_texts(["".join(self.chinese_tokenizer(text)) or question.lower()])[0]
+    
+    def _update_cache_status(self):
+        """在状态栏显示响应缓存的命中统计"""
+        cache = self.response_cache
+        status = f"响应缓存: 命中 {cache.hits} / 未命中 {cache.misses}"
+        if self.semantic_cache_enabled.get():
+            semantic = self.semantic_cache
+            status += f" | 语义缓存: 命中 {semantic.hits} / 未命中 {semantic.misses}"
+            if semantic.hit_log:
+                status += f"（最近相似度 {semantic.hit_log[-1][3]:.2f}）"
+        self.cache_status.set(status)
+    
+    def clear_response_cache(self):
+        """清空响应缓存和语义缓存"""
+        self.response_cache.clear()
+        self.semantic_cache.clear()
+        self._update_cache_status()
+        self.status_var.set("响应缓存已清空")
+    
+    def _build_messages(self, session, prompt, tool_result=None, rag_context=None):
+        """检索RAG上下文（未提供时），并按token预算组装发送给模型的消息
+
+        返回 (messages, 实际发送的RAG上下文)，各部分的token用量记录在
+        self.last_context_usage 中。
+        """
+        history = self._prepare_chat_history(session)
+        # 当前问题在发送时已写入历史，这里作为最后一条消息单独发送
+        if history and history[-1]["role"] == "user" and history[-1]["content"] == session.question:
+            history = history[:-1]
+        
+        # 如果启用了RAG且有知识库，检索相关上下文
+        if rag_context is None:
+            rag_context = ""
+            if self.rag_enabled.get() and self.knowledge_base:
+                rag_context = self.retrieve_context(
+                    session.question,
+                    top_k=self.rag_context_var.get(),
+                    unique_sources=self.rag_unique_sources.get()
+                )
+        
+        packer = self._context_packer()
+        messages, rag_context = packer.pack(prompt, history, rag_context, tool_result)
+        self.last_context_usage = packer.usage
+        print(f"_build_messages: token用量 {packer.usage}")
+        
+        if self.rag_enabled.get() and self.knowledge_base:
+            # 更新RAG上下文显示
+            self.root.after(0, self._update_rag_display, rag_context)
+        
+        # 特殊处理多模态模型
+        if self.current_model == "Qwen/QVQ-72B-Preview" and self.current_image:
+            # 构造多模态消息
+            messages[-1]["content"] = [
+                {"type": "text", "text": messages[-1]["content"]},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{self.current_image}"
+                    }
+                }
+            ]
+        return messages, rag_context
+    
+    def _context_packer(self):
+        """按 context 配置创建当前模型的 ContextPacker"""
+        context_config = self.tool_config.get("context", {})
+        return ContextPacker(
+            self.current_model,
+            budget=context_config.get("max_prompt_tokens", 8000),
+            rag_ratio=context_config.get("rag_ratio", 0.5),
+            tool_ratio=context_config.get("tool_ratio", 0.3)
+        )
+    
+    def _prepare_chat_history(self, session):
         """准备用于API调用的对话历史"""
         # 如果历史记录太长，只保留最近的几轮对话
         try:
-            max_history = min(len(self.chat_history), self.max_history_length * 2)
-            messages = self.chat_history[-max_history:]
+            max_history = min(len(session.history), self.max_history_length * 2)
+            messages = session.history[-max_history:]
             # 确保角色名称符合API要求
             for msg in messages:
                 if msg["role"] == "ai":
@@ -1418,67 +4659,74 @@ class ChatApp:
 
         return messages
         
-    def _append_message(self, role, message, append=False):
-        """向聊天窗口添加消息，并使用rich输出Markdown格式"""
-        self.chat_display.config(state=tk.NORMAL)
-        
+    def _append_message(self, role, message, append=False, session=None):
+        """向会话（默认为当前会话）的聊天窗口添加消息，并镜像到控制台"""
+        session = session or self.session
+        if session not in self.sessions:
+            return  # 标签页已关闭
         if not append:
             # 添加新消息
+            session.transcript.add(*self._transcript_entry(role, message))
+            # 镜像到控制台（后台线程渲染）
             if role == "user":
-                self.chat_display.insert(tk.END, "\n\n你:\n", "user_header")
-                self.chat_display.insert(tk.END, message + "\n\n", "user_message")
-                # 使用rich输出Markdown格式
-                console.print(Markdown(f"**你**:\n{message}"))
+                self.console_sink.emit("markdown", f"**你**:\n{message}")
             elif role == "assistant":
-                self.chat_display.insert(tk.END, f"AI ({self.current_model}):\n", "ai_header")
-                self.chat_display.insert(tk.END, message, "ai_message")
-                # 使用rich输出Markdown格式
-                console.print(Markdown(f"**AI ({self.current_model})**:\n{message}"))
-            elif role == "tool":
-                self.chat_display.insert(tk.END, f"[工具] {message}\n\n", "tool_message")
+                self.console_sink.emit("markdown", f"**AI ({self.current_model})**:")
+                if message:
+                    self.console_sink.emit("stream", message)
             elif role == "error":
-                self.chat_display.insert(tk.END, message + "\n\n", "error")
-                console.print(f"[bold red]错误:[/bold red] {message}")
+                self.console_sink.emit("markup", f"[bold red]错误:[/bold red] {message}")
         else:
             # 追加到现有消息
-            self.chat_display.insert(tk.END, message, "ai_message")
-            #self.chat_display.insert(tk.END, message)
-            
-        # 滚动到底部
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+            session.transcript.extend_last(message)
+            self.console_sink.emit("stream", message)
+    
+    def _transcript_entry(self, role, message, model=None):
+        """消息在聊天窗口中的显示形式：(标题, 标题标签, 正文, 正文标签)"""
+        if role == "user":
+            return "\n\n你:\n", "user_header", message + "\n\n", "user_message"
+        if role == "assistant":
+            return f"AI ({model or self.current_model}):\n", "ai_header", message, "ai_message"
+        if role == "tool":
+            return "", "", f"[工具] {message}\n\n", "tool_message"
+        return "", "", message + "\n\n", "error"
         
     def _update_rag_display(self, context):
-        """更新RAG上下文显示，并使用rich输出Markdown格式"""
+        """更新RAG上下文显示，并镜像到控制台"""
         self.rag_context_display.config(state=tk.NORMAL)
         self.rag_context_display.delete(1.0, tk.END)
         
         if context:
             self.rag_context_display.insert(tk.END, "检索到的相关上下文:\n\n", "rag_header")
             self.rag_context_display.insert(tk.END, context, "rag_content")
-            # 使用rich输出Markdown格式
-            console.print(Markdown("**检索到的相关上下文**:\n" + context))
+            # 镜像到控制台（后台线程渲染）
+            self.console_sink.emit("markdown", "**检索到的相关上下文**:\n" + context, level=2)
         else:
             self.rag_context_display.insert(tk.END, "未检索到相关上下文\n", "rag_header")
-            console.print("[italic]未检索到相关上下文[/italic]")
+            self.console_sink.emit("markup", "[italic]未检索到相关上下文[/italic]", level=2)
         
         self.rag_context_display.config(state=tk.DISABLED)
         self.rag_context_display.tag_config("rag_header", foreground="#5D4037", font=(self.font_family[0], 9, "bold"))
         self.rag_context_display.tag_config("rag_content", foreground="#5D4037", font=(self.font_family[0], 9))
     
-    def _update_ui_after_response(self):
-        """响应完成后更新UI状态"""
-        self.status_var.set("准备就绪")
-        self.send_button.config(state=tk.NORMAL)
-        self.is_waiting_response = False
+    def _update_ui_after_response(self, session):
+        """响应完成后更新UI状态，状态栏和按钮只反映当前显示的会话"""
+        stats = session.last_stream_stats
+        session.last_stream_stats = {}
+        if session is not self.session:
+            return
+        if stats and stats["ttft"] is not None:
+            self.status_var.set(f"准备就绪 | 首字 {stats['ttft']:.2f}s · {stats['tokens_per_second']:.1f} token/s")
+        else:
+            self.status_var.set("准备就绪")
+        self._update_memory_status()
+        self._update_session_buttons()
         
     def clear_memory(self):
         """清除对话记忆"""
         if messagebox.askyesno("确认", "确定要清除所有对话记忆吗？"):
             self.chat_history = []
-            self.chat_display.config(state=tk.NORMAL)
-            self.chat_display.delete(1.0, tk.END)
-            self.chat_display.config(state=tk.DISABLED)
+            self.transcript.clear()
             self.memory_status.set("记忆状态: 记忆已清除")
             self.status_var.set("记忆已清除")
             
@@ -1536,18 +4784,11 @@ class ChatApp:
             with open(filename, "r", encoding="utf-8") as f:
                 self.chat_history = json.load(f)
                 
-            # 更新UI显示
-            self.chat_display.config(state=tk.NORMAL)
-            self.chat_display.delete(1.0, tk.END)
-            
-            # 重新显示所有历史消息
-            for msg in self.chat_history:
-                if msg["role"] == "user":
-                    self._append_message("user", msg["content"])
-                elif msg["role"] == "assistant":
-                    self._append_message("assistant", msg["content"])
-            
-            self.chat_display.config(state=tk.DISABLED)
+            # 更新UI显示：只渲染最近的消息，更早的消息在向上滚动时加载
+            self.transcript.load([
+                self._transcript_entry(msg["role"], msg["content"], msg.get("model"))
+                for msg in self.chat_history if msg["role"] in ("user", "assistant")
+            ])
             self.memory_status.set(f"记忆状态: 已加载 {len(self.chat_history)//2} 轮对话")
             self.status_var.set(f"已从文件加载记忆: {os.path.basename(filename)}")
             
@@ -1573,6 +4814,42 @@ class ChatApp:
         if filename:
             self.load_memory(filename)
             
+    def view_http_stats(self):
+        """查看各工具的网络请求耗时分布和熔断状态"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("网络请求统计")
+        dialog.geometry("560x420")
+        dialog.resizable(True, True)
+        dialog.transient(self.root)
+        
+        text = scrolledtext.ScrolledText(dialog, wrap=tk.WORD, font=(self.font_family[0], 10))
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        def refresh():
+            text.config(state=tk.NORMAL)
+            text.delete(1.0, tk.END)
+            stats = self.http.stats()
+            if not stats:
+                text.insert(tk.END, "暂无网络请求记录")
+            for tool, item in stats.items():
+                text.insert(tk.END, (
+                    f"[{tool}] 请求 {item['count']} 次，失败 {item['errors']} 次，熔断状态: {item['breaker']}\n"
+                    f"  平均 {item['avg_ms']:.0f}ms  P50 ≤{item['p50_ms']:.0f}ms  "
+                    f"P95 ≤{item['p95_ms']:.0f}ms  P99 ≤{item['p99_ms']:.0f}ms\n"
+                ))
+                for bound, count in item["buckets"]:
+                    if count:
+                        label = f"≤{bound:.0f}ms" if bound != float("inf") else ">10000ms"
+                        text.insert(tk.END, f"  {label:>10}: {'█' * min(count, 40)} {count}\n")
+                text.insert(tk.END, "\n")
+            text.config(state=tk.DISABLED)
+        
+        btn_frame = ttk.Frame(dialog)
+        btn_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+        ttk.Button(btn_frame, text="刷新", command=refresh).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="关闭", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+        refresh()
+    
     def view_saved_memories(self):
         """查看已保存的记忆文件"""
         # 获取当前目录下所有记忆文件
@@ -1679,142 +4956,516 @@ class ChatApp:
         )
         
         if filenames:
-            for filename in filenames:
-                self.load_knowledge_file(filename)
+            self.ingest_knowledge_files(filenames)
     
-    def load_knowledge_file(self, filename):
-        """加载知识文档到知识库"""
+    def ingest_knowledge_files(self, filenames):
+        """在后台批量导入知识文档：进程池负责读取/分块/分词，单线程合并进索引"""
+        if self.ingest_thread is not None and self.ingest_thread.is_alive():
+            messagebox.showinfo("提示", "请等待当前知识文档导入完成")
+            return False
+        
+        self.ingest_cancel.clear()
+        self.ingest_thread = threading.Thread(
+            target=self._run_ingestion, args=(list(filenames),), daemon=True
+        )
+        self.ingest_thread.start()
+        return True
+    
+    def cancel_ingestion(self):
+        """取消正在进行的知识文档导入"""
+        if self.ingest_thread is not None and self.ingest_thread.is_alive():
+            self.ingest_cancel.set()
+            self.status_var.set("正在取消知识文档导入...")
+    
+    def _run_ingestion(self, filenames):
+        """后台导入线程：分发文件、按完成顺序合并结果，最后只保存一次索引
+
+        单个文件失败（文件被删除、子进程崩溃等）只记入失败列表，不影响其余文件；
+        无论如何都会在主线程结束导入状态。
+        """
+        loaded, skipped, failed = 0, 0, []
         try:
-            # 检测文件编码
-            with open(filename, 'rb') as f:
-                raw_data = f.read()
-                result = chardet.detect(raw_data)
-                encoding = result['encoding'] or 'utf-8'
-            
-            # 读取文件内容
-            if filename.lower().endswith('.pdf'):
-                # PDF文件处理
+            paths = []
+            for filename in filenames:
+                path = os.path.abspath(filename)
                 try:
-                    with open(filename, 'rb') as f:
-                        pdf_reader = PyPDF2.PdfReader(f)
-                        text = ""
-                        for page in pdf_reader.pages:
-                            text += page.extract_text() + "\n"
-                except Exception as e:
-                    messagebox.showerror("PDF读取错误", f"读取PDF文件失败: {str(e)}")
-                    return False
-            else:
-                # 文本文件处理
-                with open(filename, 'r', encoding=encoding, errors='replace') as f:
-                    text = f.read()
-            
-            # 分块处理文档
-            chunks = self.chunk_text(text)
-            
-            # 添加到知识库
-            for chunk in chunks:
-                self.knowledge_base.append({
-                    "source": os.path.basename(filename),
-                    "content": chunk
-                })
+                    if self._is_source_unchanged(path):
+                        skipped += 1
+                    else:
+                        paths.append(path)
+                except OSError as e:
+                    failed.append(f"{os.path.basename(path)}: {e}")
             
-            # 更新向量索引
-            self.update_vector_index()
+            total = len(paths)
+            if paths:
+                self.root.after(0, self.status_var.set, f"正在导入知识文档 0/{total}...")
+                with self.knowledge_lock:
+                    known = {path: self.knowledge_sources.get(path) for path in paths}
+                # 应用里有多个后台线程，fork 出的子进程可能继承被其它线程持有的锁，改用 spawn
+                executor = ProcessPoolExecutor(
+                    max_workers=min(total, os.cpu_count() or 1),
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                try:
+                    futures = {
+                        executor.submit(
+                            ingest_knowledge_file, path, known[path],
+                            self.chunk_size, self.chunk_overlap, frozenset(self.stopwords)
+                        ): path
+                        for path in paths
+                    }
+                    for done, future in enumerate(as_completed(futures), start=1):
+                        if self.ingest_cancel.is_set():
+                            break
+                        source = os.path.basename(futures[future])
+                        try:
+                            result = future.result()
+                            if result["status"] == "error":
+                                failed.append(f"{result['source']}: {result['error']}")
+                            else:
+                                self._merge_ingest_result(result)
+                                loaded += 1
+                        except (OSError, ValueError, RuntimeError) as e:
+                            # 子进程崩溃时是 BrokenProcessPool（RuntimeError 的子类）
+                            print(f"_run_ingestion: 导入失败: {source}: {e}")
+                            failed.append(f"{source}: {str(e) or type(e).__name__}")
+                        self.root.after(
+                            0, self.status_var.set,
+                            f"正在导入知识文档 {done}/{total}: {source}"
+                        )
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
             
-            # 更新状态
-            doc_count = len(set(doc['source'] for doc in self.knowledge_base))
-            self.knowledge_status.set(f"知识库: {len(self.knowledge_base)} 个片段 ({doc_count} 个文档)")
-            self.status_var.set(f"已加载知识文档: {os.path.basename(filename)}")
-            return True
-        except Exception as e:
-            messagebox.showerror("加载错误", f"加载知识文档失败: {str(e)}")
+            # 整批只落盘一次
+            if loaded:
+                with self.knowledge_lock:
+                    self._save_knowledge_index()
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"_run_ingestion: 导入中断: {e}")
+            failed.append(f"导入中断: {e}")
+        finally:
+            cancelled = self.ingest_cancel.is_set()
+            summary = f"{'已取消导入，' if cancelled else ''}已导入 {loaded} 个知识文档"
+            if skipped:
+                summary += f"，{skipped} 个未变化已跳过"
+            if failed:
+                summary += f"，{len(failed)} 个失败"
+            print(f"_run_ingestion: {summary}")
+            self.root.after(0, self._finish_ingestion, summary, failed)
+    
+    def _finish_ingestion(self, summary, failed):
+        """导入结束后在主线程更新界面"""
+        self._update_knowledge_status()
+        self.status_var.set(summary)
+        if failed:
+            messagebox.showerror("加载错误", "以下知识文档加载失败:\n" + "\n".join(failed))
+    
+    def _is_source_unchanged(self, path):
+        """按 mtime 和大小判断源文件是否未变化（文件不存在时抛出 OSError）"""
+        with self.knowledge_lock:
+            entry = self.knowledge_sources.get(path)
+        if not entry:
             return False
+        stat = os.stat(path)
+        return entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
     
-    def chunk_text(self, text, chunk_size=500):
-        """将文本分割成较小的块，使用中文分词"""
-        # 使用jieba进行分词
-        words = list(jieba.cut(text))
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for word in words:
-            word_length = len(word)
-            # 如果当前块长度加上新词长度超过阈值，并且当前块不为空
-            if current_length + word_length > chunk_size and current_chunk:
-                chunks.append("".join(current_chunk))
-                current_chunk = []
-                current_length = 0
+    def _merge_ingest_result(self, result, batch_size=256):
+        """把单个文档的导入结果合并进知识库和索引（调用方负责保存）
+
+        按批写入索引；中途出错时撤销该文档已写入的片段。
+        """
+        path = result["path"]
+        with self.knowledge_lock:
+            if result["status"] == "ok":
+                # 文件已变化，先移除旧的片段
+                if path in self.knowledge_sources:
+                    self._remove_knowledge_source(path)
+                
+                try:
+                    batch = []
+                    for chunk in result["chunks"]:
+                        batch.append(chunk)
+                        if len(batch) >= batch_size:
+                            self._append_knowledge_chunks(result["source"], path, batch)
+                            batch = []
+                    if batch:
+                        self._append_knowledge_chunks(result["source"], path, batch)
+                except Exception:
+                    self._remove_knowledge_source(path)
+                    raise
             
-            current_chunk.append(word)
-            current_length += word_length
-        
-        # 添加最后一个块
-        if current_chunk:
-            chunks.append("".join(current_chunk))
+            # 记录源文件（内容未变时只刷新mtime），文本文件同时记录检测出的编码
+            self.knowledge_sources[path] = {
+                key: result[key]
+                for key in ("mtime", "size", "sha1", "encoding", "encoding_key")
+                if key in result
+            }
+    
+    def _append_knowledge_chunks(self, source, path, chunks):
+        """追加一批片段，直接使用分块时的分词结果更新索引"""
+        for chunk in chunks:
+            doc = {
+                "source": source,
+                "path": path,
+                "content": chunk["content"]
+            }
+            if chunk["page"] is not None:
+                doc["page"] = chunk["page"]
+            self.knowledge_base.append(doc)
         
-        return chunks
+        self.update_vector_index([chunk["tokens"] for chunk in chunks])
+        self.token_cache.put_many((chunk["content"].lower(), chunk["tokens"]) for chunk in chunks)
+    
+    def load_knowledge_file(self, filename):
+        """导入单个知识文档
+
+        与批量导入走同一个后台流程，读取、分块和写索引都不占用界面线程。
+        返回是否已开始导入。
+        """
+        return self.ingest_knowledge_files([filename])
+    
+    def _remove_knowledge_source(self, path):
+        """从知识库和索引中移除某个源文件的全部片段"""
+        rows = self.knowledge_base.remove_path(path)
+        for index in self._knowledge_indexes().values():
+            index.remove_documents(rows)
+        self.knowledge_sources.pop(path, None)
+    
+    def _update_knowledge_status(self):
+        """更新知识库状态标签"""
+        doc_count = len(self.knowledge_base.sources())
+        self.knowledge_status.set(f"知识库: {len(self.knowledge_base)} 个片段 ({doc_count} 个文档)")
+    
+    def _load_knowledge_index(self):
+        """启动时从本地目录加载知识库索引"""
+        if not self.knowledge_store.exists():
+            return
+        try:
+            start = time.perf_counter()
+            self.knowledge_base, self.knowledge_sources, indexes = self.knowledge_store.load()
+            self.vector_index = indexes.get("tfidf", IncrementalTfidfIndex())
+            self.bm25_index = indexes.get("bm25", self.bm25_index)
+            self.dense_index = indexes.get("dense", self.dense_index)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"_load_knowledge_index: 已加载 {len(self.knowledge_base)} 个片段，耗时 {elapsed:.1f}ms")
+            # 缺失的词法索引从已保存的片段补建，稠密向量在检索时按需补建
+            if not all(name in indexes for name in self._lexical_indexes()):
+                self.update_vector_index()
+                self._save_knowledge_index()
+            self._update_knowledge_status()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"_load_knowledge_index: 加载知识库索引失败: {e}")
+            self.knowledge_base = KnowledgeChunks()
+            self.knowledge_sources = {}
+            self.vector_index = IncrementalTfidfIndex()
+            self.bm25_index = BM25Index()
+            self.dense_index.clear()
+    
+    def _lexical_indexes(self):
+        """基于分词结果的检索索引"""
+        return {"tfidf": self.vector_index, "bm25": self.bm25_index}
+    
+    def _knowledge_indexes(self):
+        """所有需要与知识库同步的检索索引"""
+        indexes = self._lexical_indexes()
+        indexes["dense"] = self.dense_index
+        return indexes
+    
+    def _create_embedder(self, embedding_config):
+        """按配置创建向量化方式，未配置嵌入模型时使用本地哈希向量"""
+        model = embedding_config.get("model", "")
+        if model:
+            return RemoteEmbedder(
+                self.client, model, embedding_config.get("batch_size", 32),
+                retries=embedding_config.get("retries", 2),
+                backoff=embedding_config.get("retry_backoff", 0.5),
+                cooldown=embedding_config.get("cooldown", 30)
+            )
+        return HashingEmbedder(embedding_config.get("dim", 512))
+    
+    def _embed_texts(self, texts):
+        """计算文本向量，嵌入接口不可用时抛出 EmbeddingUnavailableError
+
+        失败只影响本次调用：检索改用词法索引，后台同步中止并在下次调度时重试。
+        向量化方式保持不变，已有的稠密索引也不会因此重建。
+        """
+        return self.embedder.embed(texts)
+    
+    def _sync_dense_index(self, batch_size=256):
+        """为尚未向量化的片段计算向量并加入稠密索引
+
+        向量化（可能请求远程接口）在知识库锁之外进行，写入前确认这批片段和
+        向量化方式在此期间没有变化，否则重新读取。
+        """
+        with self.dense_sync_lock:
+            try:
+                while True:
+                    with self.knowledge_lock:
+                        # 向量化方式变化后旧向量不可比较，整体重建
+                        if self.dense_index.embedder_name not in (None, self.embedder.name):
+                            print(f"_sync_dense_index: 向量化方式由 {self.dense_index.embedder_name} 变为 {self.embedder.name}，重建稠密索引")
+                            self.dense_index.clear()
+                        start = len(self.dense_index)
+                        texts = [doc["content"] for doc in self.knowledge_base[start:start + batch_size]]
+                    if not texts:
+                        return True
+                    
+                    vectors = self._embed_texts(texts)
+                    with self.knowledge_lock:
+                        current = [doc["content"] for doc in self.knowledge_base[start:start + len(texts)]]
+                        if len(self.dense_index) != start or current != texts:
+                            # 知识库在此期间发生变化，重新开始这一批
+                            continue
+                        self.dense_index.add_vectors(vectors, self.embedder.name)
+            except (EmbeddingUnavailableError, ValueError) as e:
+                # 已写入的向量保留，下次调度时从断点继续
+                print(f"_sync_dense_index: 更新稠密索引失败: {e}")
+                return False
+    
+    def _dense_synced(self):
+        """稠密索引是否已包含全部知识片段"""
+        with self.knowledge_lock:
+            return (len(self.dense_index) == len(self.knowledge_base)
+                    and self.dense_index.embedder_name in (None, self.embedder.name))
+    
+    def _schedule_dense_sync(self):
+        """在后台线程中补齐稠密索引，已有同步在进行时不再启动"""
+        if not self.dense_enabled or self.dense_sync_lock.locked() or self._dense_synced():
+            return
+        threading.Thread(target=self._sync_dense_index, name="dense-sync", daemon=True).start()
+    
+    def _save_knowledge_index(self):
+        """把知识库索引写入本地目录"""
+        try:
+            self.knowledge_store.save(self.knowledge_base, self.knowledge_sources, self._knowledge_indexes())
+        except OSError as e:
+            print(f"_save_knowledge_index: 保存知识库索引失败: {e}")
+    
+    def chunk_text(self, text, chunk_size=None, with_tokens=False):
+        """将文本分割成较小的块，使用中文分词
+
+        with_tokens 为 True 时返回 (片段, 分词结果) 列表，索引时无需再次分词。
+        """
+        # 使用jieba进行分词
+        chunks = list(iter_chunks(
+            [(None, text)], chunk_size or self.chunk_size, self.chunk_overlap,
+            self.stopwords if with_tokens else None
+        ))
+        if not with_tokens:
+            return [chunk["content"] for chunk in chunks]
+        
+        # 片段的分词结果写入缓存，之后重建索引或重复加载时可直接命中
+        self.token_cache.put_many((chunk["content"].lower(), chunk["tokens"]) for chunk in chunks)
+        return [(chunk["content"], chunk["tokens"]) for chunk in chunks]
     
-    def update_vector_index(self):
-        """更新向量索引，使用中文分词"""
+    def update_vector_index(self, token_lists=None):
+        """更新向量索引，只对尚未入索引的新片段进行分词
+
+        token_lists 为分块时得到的新片段分词结果，提供时不再重新分词。
+        """
+        indexes = self._lexical_indexes().values()
         if not self.knowledge_base:
-            self.tfidf_matrix = None
+            for index in self._knowledge_indexes().values():
+                index.clear()
             return
+        # 稠密索引在后台补齐，不在持有知识库锁时请求嵌入接口
+        self._schedule_dense_sync()
         
-        # 提取所有知识片段内容
-        documents = [doc["content"] for doc in self.knowledge_base]
+        # 只处理新增的知识片段，各索引共用同一份分词结果
+        start = min(len(index) for index in indexes)
+        new_docs = self.knowledge_base[start:]
+        if not new_docs:
+            return
         
-        # 使用自定义的中文分词器
-        self.vectorizer = TfidfVectorizer(tokenizer=self.chinese_tokenizer)
-        self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        # 与 TfidfVectorizer 默认行为一致，先转小写再分词
+        if token_lists is None or len(token_lists) != len(new_docs):
+            token_lists = [self.chinese_tokenizer(doc["content"].lower()) for doc in new_docs]
+        for index in indexes:
+            index.add_documents(token_lists[len(index) - start:])
     
-    def retrieve_context(self, query, top_k=3):
-        """检索与查询最相关的上下文，使用中文分词"""
-        if not self.knowledge_base or self.tfidf_matrix is None:
+    def retrieve_context(self, query, top_k=3, unique_sources=False):
+        """检索与查询最相关的上下文，使用中文分词
+
+        unique_sources 为 True 时每个源文件只取得分最高的一个片段。
+        查询向量（可能请求远程接口）在知识库锁之外计算。
+        """
+        engine = self.rag_engine_var.get()
+        if not self.knowledge_base:
             return ""
         
-        # 对查询进行分词处理
-        tokenized_query = " ".join(self.chinese_tokenizer(query))
-        
-        # 向量化查询
-        query_vec = self.vectorizer.transform([tokenized_query])
-        
-        # 计算余弦相似度
-        similarities = cosine_similarity(query_vec, self.tfidf_matrix).flatten()
-        
-        # 将片段按相似度降序排序，并记录索引
-        sorted_indices = np.argsort(similarities)[::-1]
-        
-        # 初始化
-        selected_contexts = []
-        selected_sources = set()
-        
-        # 遍历排序后的索引
-        for idx in sorted_indices:
-            # 如果已经选够了，则退出
-            if len(selected_contexts) >= top_k:
-                break
-                
-            doc = self.knowledge_base[idx]
+        if engine == "hybrid":
+            # 混合检索：多路召回融合后再精排
+            selected_contexts = self._hybrid_select(query, top_k, unique_sources)
+        else:
+            query_vector = None
+            if engine == "dense":
+                # 稠密检索只有这一路，先在锁外计算查询向量
+                try:
+                    query_vector = self._embed_texts([query])[0]
+                except EmbeddingUnavailableError as e:
+                    # 嵌入接口不可用时只有本次改用 TF-IDF
+                    print(f"retrieve_context: 查询向量化失败，本次改用 TF-IDF: {e}")
+                    engine = "tfidf"
             
-            # 确保每个文档只选一个片段
-                
-            # 否则，选取该片段
-            selected_contexts.append(doc)
-            selected_sources.add(doc['source'])
+            # 导入线程可能正在合并新片段，检索期间持有锁
+            with self.knowledge_lock:
+                if not self.knowledge_base:
+                    return ""
+                if engine == "dense" and self._dense_synced():
+                    retriever, query_repr = self.dense_index, query_vector
+                else:
+                    if engine == "dense":
+                        print("retrieve_context: 稠密索引尚未同步完成，本次改用 TF-IDF")
+                        self._schedule_dense_sync()
+                        engine = "tfidf"
+                    # 对查询进行分词处理
+                    retriever = self._lexical_indexes().get(engine, self.vector_index)
+                    query_repr = self.chinese_tokenizer(query.lower())
+                if not len(retriever):
+                    return ""
+                # 由所选检索引擎给出得分最高的片段
+                rows = self._select_top_chunks(retriever, query_repr, top_k, unique_sources)
+                selected_contexts = [self.knowledge_base[idx] for idx in rows]
         
         # 构建上下文
         context = ""
         for doc in selected_contexts:
-            context += f"来源: {doc['source']}\n内容: {doc['content']}\n\n"
+            source = doc['source'] if "page" not in doc else f"{doc['source']} 第{doc['page']}页"
+            context += f"来源: {source}\n内容: {doc['content']}\n\n"
         
         return context.strip()
     
+    def _hybrid_select(self, query, top_k, unique_sources=False):
+        """两阶段检索：BM25/TF-IDF/稠密向量多路召回并做倒数排名融合，再用本地打分器精排
+
+        查询向量在线程池中计算，最多等到召回预算（candidate_budget_ms）用完，
+        来不及、嵌入接口不可用或稠密索引尚未同步完成时只用词法召回。召回阶段
+        超出预算后跳过剩余的检索路，精排阶段超出 rerank_budget_ms 后未打分的
+        候选按融合顺序排在后面。返回选中的知识片段，各阶段耗时记录在
+        self.last_retrieval_timings 中。
+        """
+        timings = {}
+        start = time.perf_counter()
+        deadline = start + self.candidate_budget_ms / 1000.0
+        
+        vector_future = None
+        if self.dense_enabled:
+            if self._dense_synced():
+                vector_future = self.embed_executor.submit(self._embed_texts, [query])
+            else:
+                self._schedule_dense_sync()
+        query_tokens = self.chinese_tokenizer(query.lower())
+        
+        query_vector = None
+        if vector_future is not None:
+            stage_start = time.perf_counter()
+            try:
+                query_vector = vector_future.result(timeout=max(0.0, deadline - stage_start))[0]
+            except FuturesTimeoutError:
+                print("_hybrid_select: 查询向量超出召回预算，跳过 dense")
+            except EmbeddingUnavailableError as e:
+                print(f"_hybrid_select: 查询向量化失败，本次跳过 dense: {e}")
+            timings["embed"] = (time.perf_counter() - stage_start) * 1000
+        
+        # 导入线程可能正在合并新片段，检索期间持有锁
+        with self.knowledge_lock:
+            if not self.knowledge_base:
+                return []
+            
+            # 第一阶段：多路召回，按开销从低到高排列
+            rankings = []
+            for name in ("bm25", "tfidf", "dense"):
+                if rankings and time.perf_counter() > deadline:
+                    print(f"_hybrid_select: 召回超出预算，跳过 {name}")
+                    continue
+                stage_start = time.perf_counter()
+                if name == "dense":
+                    if query_vector is None or not self._dense_synced():
+                        continue
+                    index, query_repr = self.dense_index, query_vector
+                else:
+                    index, query_repr = self._lexical_indexes()[name], query_tokens
+                if not len(index):
+                    continue
+                rows, scores = index.search(query_repr, self.candidate_k)
+                if name != "dense":
+                    # 词法检索中得分为0的片段与查询无关
+                    rows = rows[scores > 0]
+                rankings.append(rows)
+                timings[name] = (time.perf_counter() - stage_start) * 1000
+            
+            stage_start = time.perf_counter()
+            candidates, fused_scores = reciprocal_rank_fusion(rankings, self.rrf_k, self.rerank_candidates)
+            timings["fusion"] = (time.perf_counter() - stage_start) * 1000
+            
+            # 第二阶段：只对融合后的少量候选精排
+            stage_start = time.perf_counter()
+            order = self.reranker.rerank(
+                query, query_tokens, self.vector_index.term_idf(query_tokens),
+                [self.knowledge_base[row]["content"] for row in candidates], fused_scores,
+                deadline=stage_start + self.rerank_budget_ms / 1000.0
+            )
+            timings["rerank"] = (time.perf_counter() - stage_start) * 1000
+            
+            selected = []
+            selected_sources = set()
+            for i in order:
+                doc = self.knowledge_base[int(candidates[i])]
+                if unique_sources:
+                    source = doc.get("path", doc["source"])
+                    if source in selected_sources:
+                        continue
+                    selected_sources.add(source)
+                selected.append(doc)
+                if len(selected) >= top_k:
+                    break
+        
+        timings["total"] = (time.perf_counter() - start) * 1000
+        self.last_retrieval_timings = timings
+        print("_hybrid_select: " + ", ".join(f"{name}={ms:.1f}ms" for name, ms in timings.items())
+              + f", 候选={len(candidates)}")
+        return selected
+    
+    def _select_top_chunks(self, retriever, query, top_k, unique_sources=False):
+        """用检索引擎选出 top_k 个片段下标，可选按源文件去重
+
+        query 为词法索引的分词结果或稠密索引的查询向量。
+        """
+        if not unique_sources:
+            rows, _ = retriever.search(query, top_k)
+            return rows
+        
+        # 按源文件去重时先取少量候选，不够再逐步扩大
+        n = len(retriever)
+        k = min(top_k * 4, n)
+        while True:
+            selected = []
+            selected_sources = set()
+            rows, _ = retriever.search(query, k)
+            for idx in rows:
+                doc = self.knowledge_base[idx]
+                source = doc.get("path", doc["source"])
+                if source in selected_sources:
+                    continue
+                selected.append(idx)
+                selected_sources.add(source)
+                if len(selected) >= top_k:
+                    return selected
+            # 检索引擎已没有更多候选
+            if len(rows) < k or k >= n:
+                return selected
+            k = min(k * 4, n)
+    
     def clear_knowledge_base(self):
         """清空知识库"""
         if messagebox.askyesno("确认", "确定要清空知识库吗？"):
-            self.knowledge_base = []
-            self.tfidf_matrix = None
+            self.cancel_ingestion()
+            with self.knowledge_lock:
+                self.knowledge_base = KnowledgeChunks()
+                for index in self._knowledge_indexes().values():
+                    index.clear()
+                self.knowledge_sources = {}
+                self.knowledge_store.clear()
             self.knowledge_status.set("知识库: 0 个文档")
             self.status_var.set("知识库已清空")
             self._update_rag_display("")
@@ -2023,7 +5674,117 @@ class ChatApp:
         
         ttk.Button(config_window, text="保存配置", command=save_config).pack(padx=10, pady=10)
 
+class HeadlessChat:
+    """无界面模式：从标准输入逐行读取问题，回答通过 ConsoleSink 输出
+
+    不创建Tk窗口，只保留对话历史、按token预算组装消息和流式调用模型；
+    工具调用和知识库检索依赖图形界面中的状态，在这里不可用。请求同样在
+    RequestEngine 中执行，回答过程中按 Ctrl+C 停止生成。
+    """
+
+    def __init__(self, tool_config=None, sink=None):
+        if tool_config is None:
+            tool_config = {}
+            if os.path.exists(TOOL_CONFIG_FILE):
+                with open(TOOL_CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    tool_config = yaml.safe_load(f) or {}
+        self.tool_config = tool_config
+        headless_config = tool_config.get("headless", {})
+        self.current_model = headless_config.get("model", "Pro/deepseek-ai/DeepSeek-R1")
+        self.current_temperature = headless_config.get("temperature", 0.7)
+        self.max_history_length = headless_config.get("max_history_length", 5)
+        self.chat_history = []
+        self.last_stream_stats = {}  # 最近一次响应的字符数、首字延迟和输出速度
+        self.async_client = AsyncOpenAI(
+            api_key=tool_config.get("openai", {}).get("api_key", ""),
+            base_url=tool_config.get("openai", {}).get("base_url", "https://api.siliconflow.cn/v1")
+        )
+        self.request_deadline = tool_config.get("requests", {}).get("deadline", 300)
+        self.engine = RequestEngine(deadline=self.request_deadline)
+        if sink is None:
+            console_config = tool_config.get("console", {})
+            sink = ConsoleSink(console, verbosity=max(1, console_config.get("verbosity", 1)))
+        self.console_sink = sink
+
+    def ask(self, question):
+        """流式输出一个问题的回答并写入对话历史，返回完整回答"""
+        future = self.engine.submit("headless", self._ask(question))
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            self.engine.cancel("headless")
+            message = "[已停止生成]"
+        except CancelledError:
+            message = "[已停止生成]"
+        except TimeoutError:
+            message = f"请求超过 {self.request_deadline} 秒，已取消"
+        # 等待任务真正结束，保证停止提示在已输出的内容之后
+        wait([future], timeout=5)
+        self.console_sink.emit("markup", f"[bold red]{message}[/bold red]")
+        return ""
+
+    async def _ask(self, question):
+        self.console_sink.emit("markdown", f"**你**:\n{question}")
+        context_config = self.tool_config.get("context", {})
+        packer = ContextPacker(
+            self.current_model,
+            budget=context_config.get("max_prompt_tokens", 8000),
+            rag_ratio=context_config.get("rag_ratio", 0.5),
+            tool_ratio=context_config.get("tool_ratio", 0.3)
+        )
+        messages, _ = packer.pack(question, self.chat_history[-self.max_history_length * 2:], "", None)
+        
+        self.console_sink.emit("markdown", f"**AI ({self.current_model})**:")
+        accumulator = ResponseAccumulator(TokenCounter(self.current_model))
+        accumulator.start()
+        try:
+            await stream_chat_completion(
+                self.async_client, accumulator,
+                on_content=functools.partial(self.console_sink.emit, "stream"),
+                model=self.current_model,
+                messages=messages,
+                temperature=self.current_temperature
+            )
+        except OpenAIError as e:
+            self.console_sink.emit("markup", f"[bold red]错误:[/bold red] 获取AI响应失败: {e}")
+            return ""
+        finally:
+            self.console_sink.emit("stream", "\n")
+            self.last_stream_stats = accumulator.finish()
+        
+        full_response = accumulator.text()
+        self.chat_history.append({"role": "user", "content": question})
+        self.chat_history.append({"role": "assistant", "content": full_response})
+        self.chat_history = self.chat_history[-self.max_history_length * 2:]
+        return full_response
+
+    def run(self, stream=None):
+        """逐行读取问题直到输入结束或输入 exit/quit"""
+        stream = stream or sys.stdin
+        interactive = stream.isatty()
+        try:
+            while True:
+                if interactive:
+                    self.console_sink.flush()
+                    print("> ", end="", flush=True)
+                line = stream.readline()
+                if not line:
+                    break
+                question = line.strip()
+                if not question:
+                    continue
+                if question in ("exit", "quit"):
+                    break
+                self.ask(question)
+        finally:
+            self.engine.close()
+            self.console_sink.close()
+
+
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = ChatApp(root)
-    root.mainloop()
\ No newline at end of file
+    if "--headless" in sys.argv[1:]:
+        HeadlessChat().run()
+    else:
+        root = tk.Tk()
+        app = ChatApp(root)
+        root.mainloop()
\ No newline at end of file
@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+import pytest
+
+from merged import BM25Index
+
+
+def make_corpus(seed=0, docs=300, vocab=80):
+    """随机生成已分词的片段，高频词和低频词混合，片段长度不一"""
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(vocab)]
+    weights = [1.0 / (i + 1) for i in range(vocab)]
+    return [rng.choices(words, weights, k=rng.randint(1, 40)) for _ in range(docs)]
+
+
+def brute_force_scores(corpus, query, k1=1.5, b=0.75):
+    """逐个片段按BM25公式打分，不做任何剪枝"""
+    n = len(corpus)
+    avgdl = sum(len(tokens) for tokens in corpus) / n
+    scores = np.zeros(n)
+    for term in set(query):
+        df = sum(1 for tokens in corpus if term in tokens)
+        if not df:
+            continue
+        idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+        for row, tokens in enumerate(corpus):
+            tf = tokens.count(term)
+            if tf:
+                scores[row] += query.count(term) * idf * tf * (k1 + 1) / (
+                    tf + k1 * (1 - b + b * len(tokens) / avgdl)
+                )
+    return scores
+
+
+QUERIES = [["w0"], ["w1", "w50"], ["w3", "w3", "w70", "w0"], ["w79", "w2", "w11", "w40", "unknown"]]
+
+
+def assert_matches_brute_force(index, corpus, query, top_k):
+    rows, scores = index.search(query, top_k)
+    expected = brute_force_scores(corpus, query)
+    top = np.sort(expected[expected > 0])[::-1][:top_k]
+    # 得分相同的片段顺序可以不同，只比较得分
+    np.testing.assert_allclose(scores, top, rtol=1e-5)
+    np.testing.assert_allclose(expected[rows], scores, rtol=1e-5)
+
+
+@pytest.mark.parametrize("top_k", [1, 5, 20, 1000])
+@pytest.mark.parametrize("query", QUERIES)
+def test_maxscore_matches_brute_force(query, top_k):
+    corpus = make_corpus()
+    index = BM25Index()
+    for start in range(0, len(corpus), 70):
+        index.add_documents(corpus[start:start + 70])
+    assert_matches_brute_force(index, corpus, query, top_k)
+
+
+def test_remove_and_reload_match_brute_force(tmp_path):
+    corpus = make_corpus(seed=1)
+    index = BM25Index()
+    index.add_documents(corpus)
+    removed = set(range(0, len(corpus), 7))
+    index.remove_documents(removed)
+    kept = [tokens for row, tokens in enumerate(corpus) if row not in removed]
+    index.save(tmp_path)
+    reloaded = BM25Index.load(tmp_path)
+    extra = make_corpus(seed=2, docs=20)
+    reloaded.add_documents(extra)
+    for query in QUERIES:
+        assert_matches_brute_force(index, kept, query, 10)
+        assert_matches_brute_force(reloaded, kept + extra, query, 10)
@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+from merged import iter_chunks
+
+
+def make_text(seed=0, sentences=60):
+    """随机生成不重复的中英文混合文本，句子以中文或英文标点结束"""
+    rng = random.Random(seed)
+    chars = [chr(code) for code in range(0x4E00, 0x4E00 + 400)]
+    parts = []
+    for i in range(sentences):
+        if i % 5 == 4:
+            words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 8)))
+                     for _ in range(rng.randint(3, 8))]
+            parts.append(" ".join(words) + ". ")
+        else:
+            parts.append("".join(rng.choice(chars) for _ in range(rng.randint(8, 30))) + rng.choice("。！？，"))
+    return "".join(parts)
+
+
+TEXT = make_text()
+
+
+@pytest.mark.parametrize("chunk_size, overlap", [(50, 25), (20, 10), (100, 30), (30, 0), (500, 100)])
+@pytest.mark.parametrize("sentence_aware", [True, False])
+def test_chunks_are_bounded_and_unique(chunk_size, overlap, sentence_aware):
+    chunks = [c["content"] for c in iter_chunks([(None, TEXT)], chunk_size, overlap, sentence_aware=sentence_aware)]
+    assert len(chunks) > 1
+    assert len(chunks) == len(set(chunks))
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+
+
+@pytest.mark.parametrize("sentence_aware", [True, False])
+def test_chunks_without_overlap_cover_text(sentence_aware):
+    chunks = [c["content"] for c in iter_chunks([(None, TEXT)], 50, 0, sentence_aware=sentence_aware)]
+    assert "".join(chunks) == TEXT
@@ -0,0 +1,64 @@
+import numpy as np
+
+from merged import IncrementalTfidfIndex, KnowledgeChunks, KnowledgeIndexStore
+
+
+def make_docs(path, source, count):
+    return [{"source": source, "path": path, "content": f"{source} 片段{i} content"} for i in range(count)]
+
+
+def build(docs):
+    chunks = KnowledgeChunks()
+    index = IncrementalTfidfIndex()
+    for doc in docs:
+        chunks.append(doc)
+    index.add_documents([doc["content"].split() for doc in docs])
+    return chunks, index
+
+
+def test_round_trip(tmp_path):
+    docs = make_docs("/a.txt", "a.txt", 3) + make_docs("/b.md", "b.md", 2)
+    docs[3]["page"] = 7
+    chunks, index = build(docs)
+    sources = {
+        "/a.txt": {"mtime": 1.5, "size": 10, "sha1": "aa", "encoding": "gb18030", "encoding_key": "k"},
+        "/b.md": {"mtime": 2.0, "size": 20, "sha1": "bb"},
+    }
+    store = KnowledgeIndexStore(str(tmp_path))
+    store.save(chunks, sources, {"tfidf": index})
+
+    loaded, loaded_sources, indexes = store.load()
+    assert isinstance(loaded._text, np.memmap)
+    assert list(loaded) == docs
+    assert loaded[-1] == docs[-1]
+    assert loaded[1:3] == docs[1:3]
+    assert loaded.sources() == {"a.txt", "b.md"}
+    assert loaded_sources == sources
+    assert len(indexes["tfidf"]) == len(docs)
+
+
+def test_remove_and_append_after_load(tmp_path):
+    docs = make_docs("/a.txt", "a.txt", 3) + make_docs("/b.md", "b.md", 2)
+    store = KnowledgeIndexStore(str(tmp_path))
+    chunks, index = build(docs)
+    store.save(chunks, {}, {"tfidf": index})
+    chunks, _, indexes = store.load()
+    index = indexes["tfidf"]
+
+    extra = make_docs("/c.txt", "c.txt", 2)
+    for doc in extra:
+        chunks.append(doc)
+    index.add_documents([doc["content"].split() for doc in extra])
+    rows = chunks.remove_path("/a.txt")
+    assert rows == [0, 1, 2]
+    index.remove_documents(rows)
+    rows = chunks.remove_path("/c.txt")
+    assert rows == [2, 3]
+    index.remove_documents(rows)
+    assert chunks.sources() == {"b.md"}
+
+    # 保存时覆盖的是当前正在映射的文件
+    store.save(chunks, {}, {"tfidf": index})
+    reloaded, _, indexes = store.load()
+    assert list(reloaded) == docs[3:]
+    assert len(indexes["tfidf"]) == 2
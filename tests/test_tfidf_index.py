@@ -0,0 +1,102 @@
+import random
+import weakref
+
+import numpy as np
+import pytest
+
+import merged
+from merged import IncrementalTfidfIndex
+
+
+def make_corpus(seed=0, docs=80, vocab=60):
+    """随机生成已分词的片段，词频分布不均匀"""
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(vocab)]
+    weights = [1.0 / (i + 1) for i in range(vocab)]
+    return [rng.choices(words, weights, k=rng.randint(1, 30)) for _ in range(docs)]
+
+
+def brute_force_similarities(corpus, query):
+    """按 TfidfVectorizer 默认参数（smooth_idf、L2归一化）逐个片段计算余弦相似度"""
+    terms = sorted({token for tokens in corpus for token in tokens})
+    col = {term: i for i, term in enumerate(terms)}
+    n = len(corpus)
+    df = np.zeros(len(terms))
+    for tokens in corpus:
+        for token in set(tokens):
+            df[col[token]] += 1
+    idf = np.log((1.0 + n) / (1.0 + df)) + 1.0
+
+    def vector(tokens):
+        vec = np.zeros(len(terms))
+        for token in tokens:
+            if token in col:
+                vec[col[token]] += 1
+        vec *= idf
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    query_vec = vector(query)
+    return np.array([vector(tokens).dot(query_vec) for tokens in corpus])
+
+
+QUERIES = [["w0"], ["w3", "w7", "w7"], ["w12", "w40", "unknown"], ["w59", "w1", "w2", "w30"]]
+
+
+def build(corpus, batches=4):
+    index = IncrementalTfidfIndex()
+    step = len(corpus) // batches + 1
+    for start in range(0, len(corpus), step):
+        index.add_documents(corpus[start:start + step])
+    return index
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_incremental_matches_brute_force(query):
+    corpus = make_corpus()
+    index = build(corpus)
+    np.testing.assert_allclose(index.similarities(query), brute_force_similarities(corpus, query), atol=1e-6)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_matches_sklearn(query):
+    feature_extraction = pytest.importorskip("sklearn.feature_extraction.text")
+    corpus = make_corpus(seed=1)
+    vectorizer = feature_extraction.TfidfVectorizer(analyzer=lambda tokens: tokens)
+    matrix = vectorizer.fit_transform(corpus)
+    expected = (matrix @ vectorizer.transform([query]).T).toarray().ravel()
+    np.testing.assert_allclose(build(corpus).similarities(query), expected, atol=1e-6)
+
+
+def test_remove_documents_matches_rebuild():
+    corpus = make_corpus(seed=2)
+    index = build(corpus)
+    removed = {0, 5, 6, 41, len(corpus) - 1}
+    index.remove_documents(removed)
+    kept = [tokens for i, tokens in enumerate(corpus) if i not in removed]
+    for query in QUERIES:
+        np.testing.assert_allclose(index.similarities(query), brute_force_similarities(kept, query), atol=1e-6)
+
+
+@pytest.mark.parametrize("add_more", [False, True])
+def test_save_releases_memory_map(tmp_path, monkeypatch, add_more):
+    corpus = make_corpus(seed=3)
+    build(corpus).save(tmp_path)
+    index = IncrementalTfidfIndex.load(tmp_path)
+    before = index.similarities(QUERIES[1])
+    mapped = [weakref.ref(array) for array in (index._indptr, index._indices, index._data)]
+    if add_more:
+        index.add_documents(make_corpus(seed=4, docs=5))
+
+    # 替换文件时不能还有映射着它的数组（Windows 上 os.replace 会失败）
+    atomic_write = merged._atomic_write
+
+    def checked_write(path, write_func):
+        assert all(ref() is None for ref in mapped), f"{path} is still memory-mapped"
+        atomic_write(path, write_func)
+
+    monkeypatch.setattr(merged, "_atomic_write", checked_write)
+    index.save(tmp_path)
+    reloaded = IncrementalTfidfIndex.load(tmp_path)
+    assert len(reloaded) == len(corpus) + (5 if add_more else 0)
+    np.testing.assert_allclose(reloaded.similarities(QUERIES[1])[:len(corpus)] > 0, before > 0)
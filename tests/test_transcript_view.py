@@ -0,0 +1,163 @@
+import tkinter as tk
+
+import pytest
+
+from merged import TranscriptView
+
+
+class FakeText:
+    """按字符偏移模拟 Text 控件的插入、删除、mark 和滚动位置，不需要显示器"""
+
+    def __init__(self):
+        self.buf = ""
+        self.marks = {}
+        self.gravity = {}
+        self.top = 0  # 可见区域第一个字符的偏移
+        self.idle = []
+
+    def configure(self, **kwargs):
+        pass
+
+    config = configure
+
+    def _pos(self, index):
+        if index == tk.END:
+            return len(self.buf)
+        if index == "1.0":
+            return 0
+        if index == "@0,0":
+            return self.top
+        if index.startswith("o:"):
+            return int(index[2:])
+        return self.marks[index]
+
+    def index(self, index):
+        return f"o:{self._pos(index)}"
+
+    def mark_set(self, name, index):
+        self.marks[name] = self._pos(index)
+        self.gravity.setdefault(name, tk.RIGHT)
+
+    def mark_gravity(self, name, gravity):
+        self.gravity[name] = gravity
+
+    def mark_unset(self, name):
+        del self.marks[name]
+        del self.gravity[name]
+
+    def mark_names(self):
+        return list(self.marks)
+
+    def insert(self, index, chars, tag=None):
+        pos = self._pos(index)
+        self.buf = self.buf[:pos] + chars + self.buf[pos:]
+        for name, offset in self.marks.items():
+            if offset > pos or (offset == pos and self.gravity[name] == tk.RIGHT):
+                self.marks[name] = offset + len(chars)
+        if self.top > pos:
+            self.top += len(chars)
+
+    def delete(self, start, stop):
+        a, b = self._pos(start), self._pos(stop)
+        self.buf = self.buf[:a] + self.buf[b:]
+
+        def shift(offset):
+            return a if a <= offset < b else (offset - (b - a) if offset >= b else offset)
+
+        self.marks = {name: shift(offset) for name, offset in self.marks.items()}
+        self.top = shift(self.top)
+
+    def see(self, index):
+        pass
+
+    def yview(self, index):
+        self.top = self._pos(index)
+
+    def after_idle(self, func):
+        self.idle.append(func)
+
+    def run_idle(self):
+        while self.idle:
+            self.idle.pop(0)()
+
+
+def make_entries(count):
+    return [(f"H{i}:", "header", f"body{i}\n", "body") for i in range(count)]
+
+
+def assert_window(view, text):
+    """控件内容正好是 [first, last) 的消息，每条消息的 mark 指向其起点"""
+    assert 0 <= view.first <= view.last <= len(view.entries)
+    assert view.last - view.first <= view.window
+    rendered = [view.entries[i] for i in range(view.first, view.last)]
+    assert text.buf == "".join(header + "".join(parts) for header, _, _, parts in rendered)
+    for i in range(view.first, view.last):
+        header, _, _, parts = view.entries[i]
+        assert text.buf[text.marks[f"msg{i}"]:].startswith(header + "".join(parts))
+    assert sorted(name for name in text.marks if name.startswith("msg")) == \
+        sorted(f"msg{i}" for i in range(view.first, view.last))
+
+
+@pytest.fixture
+def view():
+    text = FakeText()
+    view = TranscriptView(text, window=20, page=7)
+    view.load(make_entries(1000))
+    return view
+
+
+def test_load_renders_only_last_window(view):
+    assert (view.first, view.last) == (980, 1000)
+    assert_window(view, view.text)
+
+
+def test_scrolling_keeps_window_bounded(view):
+    text = view.text
+    for _ in range(200):
+        view._on_scroll("0.0", "0.1")
+        text.run_idle()
+        assert_window(view, text)
+    assert (view.first, view.last) == (0, 20)
+
+    for _ in range(200):
+        view._on_scroll("0.9", "1.0")
+        text.run_idle()
+        assert_window(view, text)
+    assert (view.first, view.last) == (980, 1000)
+
+
+def test_loading_older_keeps_visible_message(view):
+    text = view.text
+    text.top = text.marks["msg985"]
+    view._on_scroll("0.0", "0.1")
+    text.run_idle()
+    assert view.first == 973
+    assert text.buf[text.top:].startswith("H985:")
+
+
+def test_add_and_stream_jump_to_tail(view):
+    text = view.text
+    for _ in range(10):
+        view._on_scroll("0.0", "0.1")
+        text.run_idle()
+    assert view.last < len(view.entries)
+
+    view.add("你:", "header", "问题\n", "body")
+    assert (view.first, view.last) == (981, 1001)
+    view.add("AI:", "header", "", "body")
+    for part in ("部分", "回答"):
+        view.extend_last(part)
+    assert text.buf.endswith("AI:部分回答")
+    assert_window(view, text)
+
+    for i in range(50):
+        view.add(f"N{i}:", "header", "z", "body")
+        assert_window(view, text)
+    assert view.last == len(view.entries)
+
+
+def test_clear_removes_text_and_marks(view):
+    view.clear()
+    assert view.text.buf == ""
+    assert not [name for name in view.text.marks if name.startswith("msg")]
+    assert (view.first, view.last) == (0, 0)
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from merged import TTLCache
+
+
+def test_concurrent_misses_fetch_once():
+    cache = TTLCache(ttl=60)
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return "晴"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_fetch("北京", fetch)))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    # 等所有线程都进入 get_or_fetch 后再让唯一的请求返回
+    deadline = time.time() + 5
+    while cache.stats["miss"] + cache.stats["coalesced"] < 10 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(status for _, status in results) == ["coalesced"] * 9 + ["miss"]
+    assert all(value == "晴" for value, _ in results)
+    assert cache.get_or_fetch("北京", fetch) == ("晴", "hit")
+    assert len(calls) == 1
+
+
+def test_failed_fetch_is_shared_and_not_cached():
+    cache = TTLCache(ttl=60)
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError("服务不可用")
+
+    def call():
+        try:
+            cache.get_or_fetch("上海", fail)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while cache.stats["miss"] + cache.stats["coalesced"] < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors == ["服务不可用"] * 5
+    assert cache.get_or_fetch("上海", lambda: "多云") == ("多云", "miss")
+
+
+def test_should_cache_false_is_not_stored():
+    cache = TTLCache(ttl=60)
+    assert cache.get_or_fetch("广州", lambda: {"success": False}, should_cache=lambda r: r["success"])[1] == "miss"
+    assert cache.get_or_fetch("广州", lambda: {"success": True}, should_cache=lambda r: r["success"])[1] == "miss"
+    assert cache.get_or_fetch("广州", lambda: {"success": True})[1] == "hit"
+
+
+def test_stale_value_returned_while_refreshing():
+    cache = TTLCache(ttl=0.05, stale_ttl=60, stale_while_revalidate=True)
+    cache.get_or_fetch("深圳", lambda: "旧")
+    time.sleep(0.1)
+    refreshed = threading.Event()
+
+    def refresh():
+        refreshed.set()
+        return "新"
+
+    assert cache.get_or_fetch("深圳", refresh) == ("旧", "stale")
+    assert refreshed.wait(5)
+    deadline = time.time() + 5
+    while cache.get_or_fetch("深圳", refresh)[0] != "新":
+        if time.time() > deadline:
+            pytest.fail("后台刷新没有写入新值")
+        time.sleep(0.01)